@@ -0,0 +1,40 @@
+"""
+Drive the bot with the offline console backend and report dispatch
+throughput and latency percentiles.
+
+Needs a bot_config.json in the current directory (plugins are loaded
+from its plugin_paths). Run from the repository root:
+    python -m benchmarks.dispatch_load --events 20000 --servers 10
+
+Plugin storage for the fake servers is written under storage_data/.
+"""
+import argparse
+
+from spanky.bot import Bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int)
+    parser.add_argument("--members", type=int)
+    parser.add_argument("--roles", type=int)
+    parser.add_argument("--channels", type=int)
+    parser.add_argument("--events", type=int)
+    parser.add_argument("--rate", type=float, help="events per second, 0 for as fast as possible")
+    parser.add_argument("--command-ratio", type=float)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", default=None)
+    args = parser.parse_args()
+
+    bot = Bot("console")
+
+    console_cfg = bot.config.setdefault("console", {})
+    for key, value in vars(args).items():
+        if value is not None:
+            console_cfg[key] = value
+
+    bot.loop.run_until_complete(bot.start())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Cost of wrapping a gateway event in the discord backend.
+
+Compares the old wrappers, which copied every attribute (and every member
+role) when created, against the lazy slotted wrappers in
+spanky.inputs.discord_py. Each event is built and then read the way a
+typical hook does: text, author id, channel id and server id.
+
+Needs discord.py installed. Run from the repository root:
+    python -m benchmarks.event_wrappers
+"""
+import random
+import sys
+import timeit
+import tracemalloc
+
+from spanky.inputs import console
+from spanky.inputs import discord_py
+from spanky.plugin.event import EventType
+
+EVENTS = 20000
+BULK_SIZE = 50
+REPEAT = 5
+
+
+class BenchBot():
+    config = {"bot_owners": []}
+
+
+class BenchMessage(console.FakeMessage):
+    def __init__(self, author, channel, content):
+        super().__init__(author, channel, content)
+        self.clean_content = content
+        self.reference = None
+
+#
+# The wrappers as they were before, attributes copied in __init__
+#
+class EagerServer():
+    def __init__(self, obj):
+        self.name = obj.name
+        self.id = str(obj.id)
+        self._raw = obj
+
+
+class EagerRole():
+    def __init__(self, obj):
+        self.name = obj.name
+        self.id = str(obj.id)
+        self.position = obj.position
+        self._raw = obj
+
+
+class EagerUser():
+    def __init__(self, obj):
+        self.nick = obj.display_name
+        self.name = obj.name
+        self.id = str(obj.id)
+        self.bot = obj.bot
+
+        self.avatar_url = obj.avatar.url
+
+        self.roles = []
+        if hasattr(obj, "roles"):
+            for role in obj.roles:
+                if role.name == '@everyone':
+                    continue
+                self.roles.append(EagerRole(role))
+
+        self.bot_owner = False
+        if "bot_owners" in BenchBot.config and self.id in BenchBot.config["bot_owners"]:
+            self.bot_owner = True
+
+        self._raw = obj
+
+
+class EagerChannel():
+    def __init__(self, obj):
+        self.name = getattr(obj, "name", None)
+        self.id = str(obj.id)
+        self.position = getattr(obj, "position", None)
+        self.server = EagerServer(obj.guild) if hasattr(obj, "guild") else None
+        self.topic = getattr(obj, "topic", None)
+        self.is_nsfw = obj.is_nsfw() if hasattr(obj, "is_nsfw") else None
+        self.is_thread = False
+        self._raw = obj
+
+
+class EagerMessage():
+    def __init__(self, obj, timeout=0):
+        self.text = obj.content
+        self.id = str(obj.id)
+        self.author = EagerUser(obj.author)
+        self.clean_content = obj.clean_content
+        self._raw = obj
+        self.reference_info = obj.reference
+        self.timeout = timeout
+
+
+class EagerEventMessage():
+    def __init__(self, event_type, message, before=None, deleted=False, messages=[]):
+        self.type = event_type
+
+        if message is not None:
+            self.msg = EagerMessage(message)
+        else:
+            self.msg = EagerMessage(messages[0])
+        self.msgs = [EagerMessage(message) for message in messages]
+
+        self.channel = EagerChannel(message.channel)
+        self.author = EagerUser(message.author)
+        self.server = EagerServer(message.guild)
+        self.source = self.channel
+        self.text = self.msg.text
+
+        if before:
+            self.before = EagerEventMessage(-1, message=before)
+            self.after = EagerEventMessage(-1, message=message)
+        else:
+            self.before = None
+            self.after = None
+
+#
+# Benchmark
+#
+def make_messages(count):
+    loader = console.Init.__new__(console.Init)
+    loader.config = dict(console.DEFAULT_CONFIG, members=200, roles=40, member_roles=8)
+    loader.rnd = random.Random(1)
+    guild = loader._make_guild(0)
+
+    members = list(guild.members.values())
+    return [
+        BenchMessage(members[idx % len(members)], guild.channels[idx % len(guild.channels)], "hello there %d" % idx)
+        for idx in range(count)]
+
+
+def scenarios(messages):
+    pairs = list(zip(messages[::2], messages[1::2]))
+    bulks = [messages[idx:idx + BULK_SIZE] for idx in range(0, len(messages), BULK_SIZE)]
+
+    return [
+        ("message", lambda cls: [cls(EventType.message, msg) for msg in messages]),
+        ("edit", lambda cls: [cls(EventType.message_edit, after, before) for before, after in pairs]),
+        ("bulk delete", lambda cls: [
+            cls(EventType.msg_bulk_del, bulk[0], deleted=True, messages=bulk) for bulk in bulks]),
+    ], {"message": len(messages), "edit": len(pairs), "bulk delete": len(bulks)}
+
+
+def read_fields(events):
+    for event in events:
+        event.text, event.author.id, event.channel.id, event.server.id
+
+
+def measure(build, cls, count):
+    # time, with the fields a hook usually reads
+    elapsed = min(timeit.repeat(lambda: read_fields(build(cls)), number=1, repeat=REPEAT))
+
+    # allocations still alive while the events are being handled
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    before, _ = tracemalloc.get_traced_memory()
+    events = build(cls)
+    read_fields(events)
+    after, _ = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    del events
+
+    return elapsed / count * 1e6, blocks / count, (after - before) / count
+
+
+def main():
+    discord_py.bot = BenchBot()
+    messages = make_messages(EVENTS)
+    cases, counts = scenarios(messages)
+
+    print("%-12s %-6s %12s %14s %14s" % ("event", "impl", "us/event", "blocks/event", "bytes/event"))
+    for name, build in cases:
+        for impl, cls in (("eager", EagerEventMessage), ("lazy", discord_py.EventMessage)):
+            per_event, blocks, size = measure(build, cls, counts[name])
+            print("%-12s %-6s %12.2f %14.1f %14.0f" % (name, impl, per_event, blocks, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Per-message cost of matching regex hooks, as the number of hooks grows.
+
+Compares searching every hook regex one by one (the old Bot.do_text_event
+loop) against RegexMatcher.
+
+Run from the repository root:
+    python -m benchmarks.regex_hooks
+"""
+import re
+import random
+import string
+import timeit
+
+from spanky.plugin.regex_matcher import RegexMatcher
+
+HOOK_COUNTS = [1, 5, 10, 25, 50, 100, 250]
+MESSAGES = 2000
+REPEAT = 5
+
+
+def random_word(rnd, min_len=2, max_len=9):
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(min_len, max_len)))
+
+
+def make_hooks(count):
+    rnd = random.Random(count)
+    hooks = []
+    triggers = []
+    for idx in range(count):
+        trigger = random_word(rnd, 4, 8)
+        flags = re.IGNORECASE if idx % 2 else 0
+        regex = re.compile(r"\b(%s)\b(\s+\w+)?" % trigger, flags)
+        hooks.append((regex, "hook%d" % idx))
+        triggers.append(trigger)
+
+    return hooks, triggers
+
+
+def make_messages(triggers, hit_ratio=0.05):
+    rnd = random.Random(len(triggers))
+    messages = []
+
+    for _ in range(MESSAGES):
+        words = [random_word(rnd) for _ in range(rnd.randint(3, 25))]
+
+        if rnd.random() < hit_ratio:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(triggers))
+
+        messages.append(" ".join(words))
+
+    return messages
+
+
+def naive(hooks, messages):
+    for text in messages:
+        for regex, hook in hooks:
+            regex.search(text)
+
+
+def combined(matcher, messages):
+    for text in messages:
+        matcher.matches(text)
+
+
+def main():
+    print("%6s %14s %14s %8s" % ("hooks", "naive us/msg", "matcher us/msg", "speedup"))
+
+    for count in HOOK_COUNTS:
+        hooks, triggers = make_hooks(count)
+        messages = make_messages(triggers)
+        matcher = RegexMatcher(hooks)
+
+        t_naive = min(timeit.repeat(lambda: naive(hooks, messages), number=1, repeat=REPEAT))
+        t_comb = min(timeit.repeat(lambda: combined(matcher, messages), number=1, repeat=REPEAT))
+
+        per_naive = t_naive / len(messages) * 1e6
+        per_comb = t_comb / len(messages) * 1e6
+
+        print("%6d %14.2f %14.2f %7.1fx" % (count, per_naive, per_comb, per_naive / per_comb))
+
+
+if __name__ == "__main__":
+    main()
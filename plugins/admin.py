@@ -13,48 +13,88 @@ free_to_use_cmds = {}
 superpower = {}  # Assign superpowers to bot owners on servers
 
 
+# Compiled permissions per server, invalidated when the admin commands change the storage
+acl_cache = {}
+acl_stats = {"hits": 0, "misses": 0}
+
+
 class CmdPerms():
-    def __init__(self, storage, cmd):
+    def __init__(self, storage, cmd, admin_roles=frozenset()):
         self.cmd = cmd
 
         self.is_customized = False
-        self.owner_groups = []
-        self.owners_ids = []
-        self.chgroups = []
-        self.channel_ids = []
-        self.forbid_chgroups = []
-        self.forbid_channel_ids = []
-
-        if not storage["commands"]:
-            return
+        self.unrestricted = False
+        self.allowed_roles = admin_roles
 
-        if cmd in storage["commands"]:
-            self.is_customized = True
-        else:
+        # Tuples keep the configured order for messages, sets are used for checks
+        self.channel_ids = ()
+        self.forbid_channel_ids = ()
+        self.channel_set = frozenset()
+        self.forbid_channel_set = frozenset()
+
+        if not storage["commands"] or cmd not in storage["commands"]:
             return
 
-        if "owner" in storage["commands"][cmd].keys():
-            self.owners_ids.extend(storage["commands"][cmd]["owner"])
+        self.is_customized = True
+        cmd_data = storage["commands"][cmd]
 
-        if "groups" in storage["commands"][cmd].keys():
-            self.chgroups.extend(storage["commands"][cmd]["groups"])
+        owners_ids = cmd_data.get("owner", [])
+        self.allowed_roles = admin_roles | frozenset(owners_ids)
 
-            for chgroup in storage["commands"][cmd]["groups"]:
-                if "channels" in storage["chgroups"][chgroup].keys():
-                    self.channel_ids.extend(
-                        storage["chgroups"][chgroup]["channels"])
+        # A deleted chgroup doesn't restrict anything
+        chgroups = storage["chgroups"] or {}
 
-        if "fgroups" in storage["commands"][cmd].keys():
-            self.forbid_chgroups.extend(storage["commands"][cmd]["fgroups"])
+        channel_ids = []
+        for chgroup in cmd_data.get("groups", []):
+            channel_ids.extend(chgroups.get(chgroup, {}).get("channels", []))
 
-            for chgroup in storage["commands"][cmd]["fgroups"]:
-                self.forbid_channel_ids.extend(
-                    storage["chgroups"][chgroup]["channels"])
+        forbid_channel_ids = []
+        for chgroup in cmd_data.get("fgroups", []):
+            forbid_channel_ids.extend(chgroups.get(chgroup, {}).get("channels", []))
 
-        self.unrestricted = False
-        if "unrestricted" in storage["commands"][cmd].keys() and \
-                storage["commands"][cmd]["unrestricted"] == "Yes":
-            self.unrestricted = True
+        self.channel_ids = tuple(channel_ids)
+        self.forbid_channel_ids = tuple(forbid_channel_ids)
+        self.channel_set = frozenset(channel_ids)
+        self.forbid_channel_set = frozenset(forbid_channel_ids)
+
+        self.unrestricted = cmd_data.get("unrestricted") == "Yes"
+
+
+class ServerACL():
+    """
+    Permissions of a server compiled from the admin storage
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.admin_roles = frozenset(storage["admin_roles"] or [])
+        self.default_bot_chan = storage["default_bot_chan"]
+
+        # Compiled on first use, so that a broken command setting only affects that command
+        self.commands = {}
+
+    def get_cmd(self, cmd):
+        perms = self.commands.get(cmd)
+        if perms is None:
+            perms = self.commands.setdefault(cmd, CmdPerms(self.storage, cmd, self.admin_roles))
+
+        return perms
+
+
+def get_acl(server_id, storage):
+    acl = acl_cache.get(server_id)
+    if acl is not None:
+        acl_stats["hits"] += 1
+        return acl
+
+    acl_stats["misses"] += 1
+    acl = ServerACL(storage)
+    acl_cache[server_id] = acl
+
+    return acl
+
+
+def invalidate_acl(server_id):
+    acl_cache.pop(server_id, None)
 
 
 @hook.sieve
@@ -63,12 +103,14 @@ def check_permissions(bot, bot_event, storage):
         invalidate_caches(bot, bot_event.event.server)
         return True, None
 
-    cmd = CmdPerms(storage, bot_event.triggered_command)
+    acl = get_acl(bot_event.event.server.id, storage)
+    cmd = acl.get_cmd(bot_event.triggered_command)
+
     # Get a list of user roles
     user_roles = set([i.id for i in bot_event.event.author.roles])
 
-    # Get a list of administrator roles
-    allowed_roles = set(storage['admin_roles'] + cmd.owners_ids)
+    # Administrator roles plus the command owners
+    allowed_roles = cmd.allowed_roles
 
     # Check if either of the categories works
     # If permissions is not empty, then we must restrict to an OR expression of all permission types
@@ -98,27 +140,29 @@ def check_permissions(bot, bot_event, storage):
     if cmd.is_customized:
         if cmd.unrestricted:
             return True, None
-        if len(cmd.forbid_channel_ids) > 0 and bot_event.event.channel.id in cmd.forbid_channel_ids:
+        if bot_event.event.channel.id in cmd.forbid_channel_set:
             bot_event.event.msg.delete_message()
             return False, "Command can't be used in " + \
                 ", ".join(bot_event.event.id_to_chan(i)
                           for i in cmd.forbid_channel_ids)
 
-        if len(cmd.channel_ids) > 0 and bot_event.event.channel.id not in cmd.channel_ids:
+        if cmd.channel_set and bot_event.event.channel.id not in cmd.channel_set:
             bot_event.event.msg.delete_message()
             return False, "Command can't be used here. Try using it in " + \
                 ", ".join(bot_event.event.id_to_chan(i)
                           for i in cmd.channel_ids)
 
-    elif storage["default_bot_chan"] and bot_event.event.channel.id != storage["default_bot_chan"]:
+    elif acl.default_bot_chan and bot_event.event.channel.id != acl.default_bot_chan:
         bot_event.event.msg.delete_message()
-        return False, "Command can only be used in " + bot_event.event.id_to_chan(storage["default_bot_chan"])
+        return False, "Command can only be used in " + bot_event.event.id_to_chan(acl.default_bot_chan)
 
     return True, None
 
 
 @hook.on_ready
 def map_objects_to_servers(server, storage):
+    invalidate_acl(server.id)
+
     chgroups[server.id] = SetClearFactory(name="chgroups",
                                           description="Manages groups of channels.\
 A group of channels can be associated to a command, so that the command can be used only in the channels listed in the group of channels.",
@@ -184,6 +228,7 @@ def irbaboon(server):
 @hook.command(permissions=Permission.bot_owner)
 def invalidate_caches(bot, server):
     bot.server_permissions[server.id] = PermissionMgr(server)
+    invalidate_acl(server.id)
 
     return "Done"
 #
@@ -192,7 +237,9 @@ def invalidate_caches(bot, server):
 @hook.command(permissions=Permission.admin, format="chan")
 def add_channel_group(send_message, text, server):
     """<group-name> - Create a group of channels"""
-    send_message(chgroups[server.id].add_thing(text))
+    result = chgroups[server.id].add_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin)
@@ -215,7 +262,9 @@ def del_channel_group(send_message, text, server, storage):
     for cmd in storage["commands"]:
         del_chgroup_from_cmd(dummy_send, cmd + " " + text, server)
 
-    send_message(chgroups[server.id].del_thing(text))
+    result = chgroups[server.id].del_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # Channels in channel groups
@@ -223,7 +272,9 @@ def del_channel_group(send_message, text, server, storage):
 @hook.command(permissions=Permission.admin, format="channel channel-group")
 def add_chan_to_chgroup(send_message, text, server, str_to_id):
     """<channel channel-group> - Add channel to channel group"""
-    send_message(channels_in_chgroups[server.id].add_thing(str_to_id(text)))
+    result = channels_in_chgroups[server.id].add_thing(str_to_id(text))
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin, format="cgroup")
@@ -240,7 +291,9 @@ def list_chans_in_chgroup(send_message, text, server, id_to_chan):
 @hook.command(permissions=Permission.admin, format="channel channel-group")
 def del_chan_from_chgroup(send_message, text, server, str_to_id):
     """<channel channel-group> - Delete channel from channel group"""
-    send_message(channels_in_chgroups[server.id].del_thing(str_to_id(text)))
+    result = channels_in_chgroups[server.id].del_thing(str_to_id(text))
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # Channels that own commands
@@ -248,7 +301,9 @@ def del_chan_from_chgroup(send_message, text, server, str_to_id):
 @hook.command(permissions=Permission.admin, format="command channel-group")
 def add_chgroup_to_cmd(send_message, text, server):
     """<command channel-group> - Add a channel-group to a command. The command will only be usable in that channel."""
-    send_message(cgroups_own_cmds[server.id].add_thing(text))
+    result = cgroups_own_cmds[server.id].add_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin, format="cmd")
@@ -264,7 +319,9 @@ def list_chgroups_for_cmd(send_message, text, server):
 @hook.command(permissions=Permission.admin, format="command channel-group")
 def del_chgroup_from_cmd(send_message, text, server):
     """<command channel-group> - Delete a user-group from a command's ownership"""
-    send_message(cgroups_own_cmds[server.id].del_thing(text))
+    result = cgroups_own_cmds[server.id].del_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # Channels that forbid commands
@@ -272,7 +329,9 @@ def del_chgroup_from_cmd(send_message, text, server):
 @hook.command(permissions=Permission.admin, format="command channel-group")
 def add_fchgroup_to_cmd(send_message, text, server):
     """<command channel-group> - Add a forbidden channel-group to command"""
-    send_message(cgroups_forbid_cmds[server.id].add_thing(text))
+    result = cgroups_forbid_cmds[server.id].add_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin, format="cmd")
@@ -289,7 +348,9 @@ def list_fchgroups_for_cmd(send_message, text, server):
 @hook.command(permissions=Permission.admin, format="command channel-group")
 def del_fchgroup_from_cmd(send_message, text, server):
     """<command channel-group> - Delete a user-group from a command's forbidden list"""
-    send_message(cgroups_forbid_cmds[server.id].del_thing(text))
+    result = cgroups_forbid_cmds[server.id].del_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # User groups that own commands
@@ -298,7 +359,9 @@ def del_fchgroup_from_cmd(send_message, text, server):
 def add_owner_to_cmd(send_message, text, server, str_to_id):
     """<command user-group> - Add a user-group to own a command"""
     text = str_to_id(text)
-    send_message(ugroups_own_cmds[server.id].add_thing(text))
+    result = ugroups_own_cmds[server.id].add_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin, format="cmd")
@@ -314,7 +377,9 @@ def list_owners_for_cmd(send_message, text, server, id_to_role_name):
 @hook.command(permissions=Permission.admin, format="cmd owner")
 def del_owner_from_cmd(send_message, text, server):
     """<command user-group> - Delete user-group from command ownership list"""
-    send_message(ugroups_own_cmds[server.id].del_thing(text))
+    result = ugroups_own_cmds[server.id].del_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # Commands that have no channel restrictions
@@ -322,7 +387,9 @@ def del_owner_from_cmd(send_message, text, server):
 @hook.command(permissions=Permission.admin, format="cmd")
 def remove_restrictions_for_cmd(send_message, text, server, str_to_id):
     """<command> - Remove channel restrictions for a command to make it usable on the whole server"""
-    send_message(free_to_use_cmds[server.id].add_thing(text + " Yes"))
+    result = free_to_use_cmds[server.id].add_thing(text + " Yes")
+    invalidate_acl(server.id)
+    send_message(result)
 
 
 @hook.command(permissions=Permission.admin, format="cmd")
@@ -340,7 +407,9 @@ def is_cmd_unrestricted(send_message, text, server):
 @hook.command(permissions=Permission.admin, format="cmd")
 def restore_restrictions_for_cmd(send_message, text, server):
     """<command user-group> - Restore channel restrictions for command"""
-    send_message(free_to_use_cmds[server.id].del_thing(text))
+    result = free_to_use_cmds[server.id].del_thing(text)
+    invalidate_acl(server.id)
+    send_message(result)
 
 #
 # Admin
@@ -371,6 +440,7 @@ def add_admin_role(text, str_to_id, storage, send_message, server):
 
     storage["admin_roles"].append(drole.id)
     storage.sync()
+    invalidate_acl(server.id)
 
     send_message("Done")
 
@@ -394,7 +464,7 @@ def get_admin_roles(send_message, id_to_role_name, storage):
 
 
 @hook.command(permissions=Permission.admin, format="role")
-def remove_admin_role(send_message, str_to_id, storage, text):
+def remove_admin_role(send_message, str_to_id, storage, text, server):
     role_id = str_to_id(text)
     roles = storage["admin_roles"]
 
@@ -406,6 +476,7 @@ def remove_admin_role(send_message, str_to_id, storage, text):
     if roles and role_id in roles:
         roles.remove(role_id)
         storage.sync()
+        invalidate_acl(server.id)
         send_message("Done.")
     else:
         send_message("Could not find role in admin list.")
@@ -414,23 +485,25 @@ def remove_admin_role(send_message, str_to_id, storage, text):
 # Bot channel
 #
 @hook.command(permissions=Permission.admin, format="chan")
-def set_default_bot_channel(text, str_to_id, storage, send_message):
+def set_default_bot_channel(text, str_to_id, storage, send_message, server):
     """
     <channel> - Configure a channel where any bot command can be used, unless otherwise specified by other rules.
     """
     channel_id = str_to_id(text)
 
     storage["default_bot_chan"] = channel_id
+    invalidate_acl(server.id)
 
     send_message("Done")
 
 
 @hook.command(permissions=Permission.admin)
-def clear_default_bot_channel(storage, send_message):
+def clear_default_bot_channel(storage, send_message, server):
     """
     <channel> - Configure a channel where any bot command can be used, unless otherwise specified.
     """
     storage["default_bot_chan"] = None
+    invalidate_acl(server.id)
 
     send_message("Done")
 
@@ -455,3 +528,13 @@ def list_bot_servers(bot):
         msg += "Name: %s, ID: %s\n" % (server.name, server.id)
 
     return msg
+
+
+@hook.command(permissions=Permission.bot_owner)
+def acl_cache_stats():
+    """Show permission cache statistics"""
+    total = acl_stats["hits"] + acl_stats["misses"]
+    hit_rate = 100.0 * acl_stats["hits"] / total if total else 0
+
+    return "Servers cached: %d, hits: %d, misses: %d, hit rate: %.1f%%" % (
+        len(acl_cache), acl_stats["hits"], acl_stats["misses"], hit_rate)
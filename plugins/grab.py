@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import re
 import random
 import plugins.paged_content as paged
@@ -9,6 +10,13 @@ from spanky.plugin.permissions import Permission
 import discord
 
 
+async def open_grabs(storage):
+    """
+    Open the grabs journal in the default executor, the first open replays its log
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, storage.journal, "grabs")
+
+
 @hook.command()
 async def grab(text, channel, storage, reply, event):
     """<user> - grab user's last message. If <user> is empty, it will try to grab the message you're replying to"""
@@ -56,10 +64,8 @@ async def grab(text, channel, storage, reply, event):
         reply("Couldn't find anything.")
         return
 
-    if not storage["grabs"]:
-        storage["grabs"] = []
-
-    for elem in storage["grabs"]:
+    grabs = await open_grabs(storage)
+    for elem in grabs:
         if elem["id"] == to_grab.id:
             reply("Message already grabbed")
             return
@@ -70,16 +76,16 @@ async def grab(text, channel, storage, reply, event):
     grab_data["author_id"] = to_grab.author.id
     grab_data["author_name"] = to_grab.author.name
 
-    storage["grabs"].append(grab_data)
-    storage.sync()
+    # appending writes to the journal log
+    await asyncio.get_event_loop().run_in_executor(None, grabs.append, grab_data)
 
     reply("Done.")
 
 
-def get_data(func, storage):
+def get_data(func, grabs):
     content = []
 
-    for msg in storage["grabs"]:
+    for msg in grabs:
         if func == None or func(msg):
             content.append("<%s> %s" % (msg["author_name"], msg["text"]))
 
@@ -89,7 +95,7 @@ def get_data(func, storage):
 def get_all_data(func, storage):
     content = []
 
-    for msg in storage["grabs"]:
+    for msg in storage.journal("grabs"):
         if func == None or func(msg):
             content.append(msg)
 
@@ -101,7 +107,7 @@ def grabr(storage):
     """
     Grab random quote
     """
-    item = random.choice(storage["grabs"])
+    item = random.choice(storage.journal("grabs"))
 
     return "<%s> %s" % (item["author_name"], item["text"])
 
@@ -114,7 +120,7 @@ def grabu(text, storage, str_to_id):
 
     user = str_to_id(text)
     content = []
-    for msg in storage["grabs"]:
+    for msg in storage.journal("grabs"):
         if msg["author_id"] == user:
             content.append(msg["text"])
 
@@ -130,11 +136,12 @@ async def grabl(event, storage, async_send_message, str_to_id, user_id_to_name,
     <user> - List quotes for user. If no user is specified, it lists everything on the server.
     """
     text = str_to_id(text)
+    grabs = await open_grabs(storage)
     if text != "":
-        content = get_data(lambda m: m["author_id"] == text, storage)
+        content = get_data(lambda m: m["author_id"] == text, grabs)
         description = "Grabs for %s:" % user_id_to_name(text)
     else:
-        content = get_data(None, storage)
+        content = get_data(None, grabs)
         description = "All server grabs:"
 
     if len(content) == 0:
@@ -151,10 +158,11 @@ async def grabs(event, storage, async_send_message):
     <expression> - Search for 'expression' in grab texts.
     """
     text = event.msg.clean_content.split(" ", maxsplit=1)[1]
-    content = get_data(lambda m: text in m["text"], storage)
+    grabs = await open_grabs(storage)
+    content = get_data(lambda m: text in m["text"], grabs)
 
     if len(content) == 0:
-        content = get_data(lambda m: text == m["id"], storage)
+        content = get_data(lambda m: text == m["id"], grabs)
 
     if len(content) == 0:
         await async_send_message("Nothing found.")
@@ -183,12 +191,10 @@ def del_grab(text, storage):
 
         return msg
     elif len(to_delete) == 1:
-        storage["grabs"].remove(to_delete[0])
-        storage.sync()
+        storage.journal("grabs").remove(to_delete[0])
         return "Deleted %s" % to_delete[0]["id"]
     else:
         to_delete_by_id = get_all_data(lambda m: text == m["id"], storage)
         if len(to_delete_by_id) == 1:
-            storage["grabs"].remove(to_delete_by_id[0])
-            storage.sync()
+            storage.journal("grabs").remove(to_delete_by_id[0])
             return "Deleted %s" % text
@@ -7,10 +7,11 @@ from spanky.plugin.permissions import Permission
 @hook.command
 def help(bot, text, event, send_embed):
     """Get help for a command or the help document"""
-    if text in bot.plugin_manager.commands:
+    commands = bot.plugin_manager.get_routes(event.server.id)
+    if text in commands:
         send_embed(
             text, "",
-            {"Usage:": bot.plugin_manager.commands[text].function.__doc__})
+            {"Usage:": commands[text].function.__doc__})
         return
 
     send_embed("Bot help:", "",
@@ -27,6 +28,7 @@ def prepare_repo(storage_loc):
 
 
 def gen_doc(files, fname, header, bot, storage_loc, server_id):
+    commands = bot.plugin_manager.get_routes(server_id)
     doc = header + "\n"
     for file in sorted(files):
         if len(files[file]) == 0:
@@ -35,10 +37,10 @@ def gen_doc(files, fname, header, bot, storage_loc, server_id):
         doc += "------\n"
         doc += "### %s \n" % file
         for cmd in sorted(files[file]):
-            hook = bot.plugin_manager.commands[cmd]
+            hook = commands[cmd]
             hook_name = " / ".join(i for i in hook.aliases)
 
-            help_str = bot.plugin_manager.commands[cmd].function.__doc__
+            help_str = hook.function.__doc__
 
             if help_str:
                 help_str = help_str.lstrip("\n").lstrip(
@@ -72,7 +74,7 @@ def gen_documentation(bot, storage_loc, event):
         files = {}
         admin_files = {}
 
-        cmd_dict = bot.plugin_manager.commands
+        cmd_dict = bot.plugin_manager.get_routes(server.id)
         for cmd_str in cmd_dict:
             cmd = cmd_dict[cmd_str]
             file_name = cmd.plugin.name.split("/")[-1].replace(".py", "")
@@ -84,14 +86,13 @@ def gen_documentation(bot, storage_loc, event):
             if file_name not in admin_files:
                 admin_files[file_name] = []
 
-            if bot.plugin_manager.commands[cmd.name].server_id and not \
-                    bot.plugin_manager.commands[cmd.name].has_server_id(server.id):
-                print(cmd.name)
+            # Aliases resolve to the same hook, document it once
+            if cmd_str != cmd.name:
                 continue
 
-            if Permission.admin in bot.plugin_manager.commands[cmd.name].permissions:
+            if Permission.admin in cmd.permissions:
                 admin_files[file_name].append(cmd.name)
-            elif Permission.bot_owner in bot.plugin_manager.commands[cmd.name].permissions:
+            elif Permission.bot_owner in cmd.permissions:
                 continue
             else:
                 files[file_name].append(cmd.name)
@@ -217,7 +217,7 @@ def remove_bad_word(storage, text):
     return "Couldn't find it."
 
 
-@hook.event(EventType.message)
+@hook.event(EventType.message, work_class="moderation")
 def check_bad_words(storage, event, bot):
     if event.channel.id == storage["evt_chan"]:
         return
@@ -1,3 +1,4 @@
+import asyncio
 import plugins.selector as selector
 import spanky.utils.carousel as carousel
 import spanky.utils.discord_utils as dutils
@@ -55,7 +56,7 @@ class Poll(carousel.Selector):
                     "Thank you for voting!",
                     timeout=MSG_TIMEOUT,
                     check_old=False)
-                sync_polls(self.storage)
+                await sync_polls(self.storage)
 
             item_dict[item] = add_vote
 
@@ -178,15 +179,27 @@ async def parse_react(bot, event):
     await event.msg.async_remove_reaction(event.reaction.emoji.name, event.author)
 
 
-def sync_polls(storage):
-    if "polls" not in storage:
-        storage["polls"] = {}
+def store_polls(storage, polls):
+    with storage.transaction():
+        if "polls" not in storage:
+            storage["polls"] = {}
+
+        storage["polls"].update(polls)
+
 
+def drop_poll(storage, key):
+    with storage.transaction():
+        storage["polls"].pop(key, None)
+
+
+async def sync_polls(storage):
+    # Polls change on the loop, serialize them here and wait for the store lock in the executor
+    polls = {}
     for poll_list in active_polls.values():
         for poll in poll_list:
-            elem = poll.serialize()
-            storage["polls"][poll.get_link()] = elem
-            storage.sync()
+            polls[poll.get_link()] = poll.serialize()
+
+    await asyncio.get_event_loop().run_in_executor(None, store_polls, storage, polls)
 
 
 @hook.command(permissions=Permission.admin)
@@ -211,7 +224,7 @@ async def create_poll(text, event, storage, async_send_message):
     await poll.do_send(event, cache_it=False)
 
     # Sync all polls
-    sync_polls(storage)
+    await sync_polls(storage)
 
 
 @hook.command(permissions=Permission.admin)
@@ -257,7 +270,7 @@ async def close_poll(text, storage, async_send_message, server):
 
         if text == poll.get_link():
             poll.is_active = False
-            sync_polls(storage)
+            await sync_polls(storage)
             await poll.get_results(async_send_message)
             return
 
@@ -276,8 +289,7 @@ async def rebuild_poll_selectors(bot):
             try:
                 await Poll.deserialize(bot, poll, storage)
             except Poll.InvalidMessage:
-                del storage["polls"][key]
-                storage.sync()
+                await asyncio.get_event_loop().run_in_executor(None, drop_poll, storage, key)
             except Exception as e:
                 print(e)
 
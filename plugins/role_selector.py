@@ -5,19 +5,22 @@ import spanky.utils.discord_utils as dutils
 
 from spanky.plugin import hook
 from spanky.plugin.permissions import Permission
-from spanky.utils.volatile import set_vdata, get_vdata
 
 
 # selector.py is the generic implementation of the selector
 # role_selector.py is the plugin that manages the selectors
 
+# TODO: use unified way of identifying plugins
+PLUGIN_NAME = os.path.basename(os.path.dirname(os.path.abspath(__file__))) + "/" + \
+    os.path.basename(os.path.abspath(__file__))
+
 #
 # Selector registration
 #
 
 
-def register_cmd(cmd, server):
-    """Register a user defined command"""
+def register_cmd(bot, cmd, server):
+    """Register a user defined command, or update it after its selector changed"""
 
     def create_it(cmd):
         async def do_cmd(text, server, storage, event, send_embed, reply):
@@ -39,15 +42,7 @@ def register_cmd(cmd, server):
         do_cmd.__name__ = cmd["name"]
         return do_cmd
 
-    globals()[cmd["name"]] = hook.command(server_id=server.id)(create_it(cmd))
-
-
-def reload_file(bot):
-    dirname = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
-    fname = os.path.basename(os.path.abspath(__file__))
-
-    # TODO: use unified way of identifying plugins
-    bot.plugin_manager.load_plugin(dirname + "/" + fname)
+    bot.plugin_manager.register_command(PLUGIN_NAME, create_it(cmd), cmd["name"], server.id)
 
 
 @hook.on_connection_ready()
@@ -63,13 +58,7 @@ def init_cmds(bot):
 
         for cmd in storage["selectors"]:
             print(f"[{server.id}] Registering {cmd}")
-            register_cmd(storage["selectors"][cmd], server)
-
-    # TODO: workaround - look into adding commands dinamically
-    if not get_vdata("selector_reload"):
-        print("selector_reload")
-        set_vdata("selector_reload", True)
-        reload_file(bot)
+            register_cmd(bot, storage["selectors"][cmd], server)
 
 
 #
@@ -93,7 +82,7 @@ def set_selector_description(server, storage, text, bot):
     storage["selectors"][text[0]]["description"] = text[1]
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][text[0]], server)
 
     return "Done"
 
@@ -117,7 +106,7 @@ def set_selector_max_selectable(server, storage, text, bot):
     storage["selectors"][text[0]]["maxSelectable"] = int(text[1])
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][text[0]], server)
 
     return "Done"
 
@@ -138,7 +127,7 @@ def set_selector_title(server, storage, text, bot):
     storage["selectors"][text[0]]["title"] = text[1]
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][text[0]], server)
 
     return "Done"
 
@@ -171,7 +160,7 @@ def add_selector_roles(server, storage, text, bot, str_to_id):
 
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][selector], server)
 
     return "Done"
 
@@ -205,7 +194,7 @@ def add_selector_role_interval(server, storage, text, bot, str_to_id):
 
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][selector], server)
 
     return "Done"
 
@@ -243,7 +232,7 @@ def remove_selector_role_interval(server, storage, text, bot, str_to_id):
 
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][selector], server)
 
     return "Done"
 
@@ -278,7 +267,7 @@ def remove_selector_roles(server, storage, text, bot, str_to_id):
 
     storage.sync()
 
-    reload_file(bot)
+    register_cmd(bot, storage["selectors"][selector], server)
 
     return "Done"
 
@@ -305,7 +294,7 @@ def create_selector(text, str_to_id, server, bot, storage):
         return "Selector command length needs to be at least 5 characters long."
 
     # Check that command exists
-    if cmd in bot.plugin_manager.commands:
+    if cmd in bot.plugin_manager.get_routes(server.id):
         return f"Command {cmd} already exists. Try using another name."
 
     # initialize command
@@ -323,8 +312,7 @@ def create_selector(text, str_to_id, server, bot, storage):
     storage["selectors"][cmd] = new_cmd
     storage.sync()
 
-    register_cmd(new_cmd, server)
-    reload_file(bot)
+    register_cmd(bot, new_cmd, server)
 
     return f"Created selector {cmd}."
 
@@ -341,22 +329,19 @@ def list_selectors(storage):
 
 
 @hook.command(permissions=Permission.admin)
-def delete_selector(storage, text, bot):
+def delete_selector(storage, text, bot, server):
     """<command_name> - delete a temporary selector command"""
     if "selectors" not in storage or storage["selectors"] == {}:
         return "No selectors available"
 
     for cmd in storage["selectors"].values():
         if cmd["name"] == text:
-            # Remove plugin entry from the bot and globals
-            # del bot.plugin_manager.commands[text]
-            del globals()[cmd["name"]]
+            # Remove the command from the bot
+            bot.plugin_manager.unregister_command(PLUGIN_NAME, cmd["name"], server.id)
             del storage["selectors"][cmd["name"]]
 
             storage.sync()
 
-            reload_file(bot)
-
             return f"Selector {text} removed."
 
     return "Selector not found."
@@ -7,7 +7,7 @@ import linecache
 import subprocess
 from datetime import timedelta
 from spanky.utils.filesize import size as format_bytes
-from spanky.plugin.permissions import Permission
+from spanky.plugin.permissions import Permission, store_cache
 from spanky.plugin import hook
 from spanky.utils.discord_utils import get_user_by_id
 
@@ -19,7 +19,7 @@ def debugme(bot, send_pm):
     for server in bot.backend.get_servers():
         if server.id == "287285563118190592":
             plp = get_user_by_id(server, "278247547838136320")
-            if "bulau" not in bot.plugin_manager.commands.keys():
+            if "bulau" not in bot.plugin_manager.get_routes(server.id):
                 send_pm("temp plugins missing", plp)
 
 
@@ -151,3 +151,90 @@ def system(send_message):
             memory_usage)
 
     return msg
+
+
+@hook.command(permissions=Permission.bot_owner)
+def periodic_stats(bot):
+    """
+    Show run statistics for periodic hooks.
+    """
+    msg = ""
+    for periodic, stats in bot.plugin_manager.scheduler.get_stats():
+        msg += "%s (%ss): %s\n" % (periodic.description, periodic.interval, stats)
+
+    return msg or "No periodic hooks."
+
+
+@hook.command(permissions=Permission.bot_owner)
+def executor_stats(bot):
+    """
+    Show queue lengths and shed work for each hook work class.
+    """
+    msg = ""
+    for name, stats in bot.executor.stats().items():
+        msg += "%s: queued %d, deferred %d, accepted %d, dropped %d, sampled out %d, deferred total %d\n" % (
+            name, stats["queued"], stats["deferred"], stats["accepted"],
+            stats["dropped"], stats["sampled_out"], stats["deferred_total"])
+
+    return msg
+
+
+@hook.command(permissions=Permission.bot_owner)
+def slow_hooks(bot, text):
+    """
+    [count] - Show the hooks with the highest average execution time.
+    """
+    count = 10
+    if text.strip().isdigit():
+        count = int(text.strip())
+
+    msg = ""
+    for metrics in bot.plugin_manager.metrics.top(count):
+        exec_hist = metrics.phases["exec"]
+        wait_hist = metrics.phases["queue_wait"]
+        msg += "%s: calls %d, errors %d, exec avg/max %.3f/%.3fs, queue wait avg %.3fs\n" % (
+            metrics.description, metrics.calls, metrics.errors,
+            exec_hist.avg, exec_hist.max, wait_hist.avg)
+
+    return msg or "No hook runs recorded."
+
+
+@hook.command(permissions=Permission.bot_owner)
+def plugin_load_times(bot):
+    """
+    Show how long each plugin took to load, slowest first.
+    """
+    load_times = bot.plugin_manager.load_times
+    msg = ""
+    for name, (seconds, how) in sorted(load_times.items(), key=lambda item: item[1][0], reverse=True)[:25]:
+        msg += "%.3fs %s %s\n" % (seconds, how, name)
+
+    return msg or "Nothing loaded."
+
+
+@hook.command(permissions=Permission.bot_owner)
+def storage_stats():
+    """
+    Show how many plugin stores are in memory and how long they take to load.
+    """
+    stats = store_cache.stats()
+    return "resident %d (%d bytes), hits %d, reused %d, loads %d, evictions %d, load avg/max %.3f/%.3fs" % (
+        stats["resident"], stats["bytes"], stats["hits"], stats["reused"], stats["loads"],
+        stats["evictions"], stats["load_avg"], stats["load_max"])
+
+
+@hook.command(permissions=Permission.bot_owner)
+def cache_stats(bot):
+    """
+    Show the size and hit rate of the backend message caches.
+    """
+    if not hasattr(bot.backend, "get_cache_stats"):
+        return "This backend has no message caches."
+
+    msg = ""
+    for name, stats in bot.backend.get_cache_stats().items():
+        msg += "%s: %s\n" % (name, ", ".join(
+            "%s %.2f" % (key, value) if isinstance(value, float) else "%s %d" % (key, value)
+            for key, value in stats.items()))
+
+    return msg
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import datetime
 import spanky.utils.discord_utils as dutils
 import plugins.paged_content as paged
@@ -10,7 +11,6 @@ import sys
 from spanky.plugin import hook, permissions
 from spanky.plugin.permissions import Permission
 from spanky.utils import time_utils
-from spanky.utils.volatile import set_vdata, get_vdata
 from collections import OrderedDict
 from spanky.plugin.permissions import Permission
 
@@ -19,6 +19,10 @@ SEC_IN_MIN = 60
 SEC_IN_HOUR = SEC_IN_MIN * 60
 SEC_IN_DAY = SEC_IN_HOUR * 24
 
+# TODO: use unified way of identifying plugins
+PLUGIN_NAME = os.path.basename(os.path.dirname(os.path.abspath(__file__))) + "/" + \
+    os.path.basename(os.path.abspath(__file__))
+
 
 def log_action(storage, ret_val, send_embed, title):
     # If the command is set to log the action onto a channel
@@ -35,7 +39,7 @@ def log_action(storage, ret_val, send_embed, title):
             target=storage["modlog_chan"])
 
 
-def register_cmd(cmd, server):
+def register_cmd(bot, cmd, server):
     """
     Register a user defined command
     """
@@ -68,16 +72,8 @@ def register_cmd(cmd, server):
         do_cmd.__name__ = cmd_name
         return do_cmd
 
-    globals()[cmd["name"]] = hook.command(server_id=server.id,
-                                          permissions=Permission.admin)(create_it(cmd["name"]))
-
-
-def reload_file(bot):
-    dirname = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
-    fname = os.path.basename(os.path.abspath(__file__))
-
-    # TODO: use unified way of identifying plugins
-    bot.plugin_manager.load_plugin(dirname + "/" + fname)
+    bot.plugin_manager.register_command(PLUGIN_NAME, create_it(cmd["name"]), cmd["name"], server.id,
+                                        permissions=Permission.admin)
 
 
 @hook.on_connection_ready()
@@ -95,13 +91,7 @@ def init_cmds(bot):
 
         for cmd in storage["cmds"]:
             print("[%s] Registering %s" % (server.id, cmd))
-            register_cmd(storage["cmds"][cmd], server)
-
-    # TODO: workaround - look into adding commands dinamically
-    if not get_vdata("temp_role_reload"):
-        print("temp_role_reload")
-        set_vdata("temp_role_reload", True)
-        reload_file(bot)
+            register_cmd(bot, storage["cmds"][cmd], server)
 
 
 @hook.command(permissions=Permission.admin)
@@ -123,7 +113,7 @@ def create_temp_role_cmd(text, str_to_id, server, bot, storage):
         return "Command length needs to be at least 5."
 
     # Check that command exists
-    if cmd in bot.plugin_manager.commands:
+    if cmd in bot.plugin_manager.get_routes(server.id):
         return "Command `%s` already exists. Try using another name." % cmd
 
     # Get the given role
@@ -147,8 +137,7 @@ def create_temp_role_cmd(text, str_to_id, server, bot, storage):
     storage["cmds"][cmd] = new_cmd
     storage.sync()
 
-    register_cmd(new_cmd, server)
-    reload_file(bot)
+    register_cmd(bot, new_cmd, server)
 
     return "Done"
 
@@ -165,7 +154,7 @@ def list_temp_role_cmds(storage):
 
 
 @hook.command(permissions=Permission.admin)
-def delete_temp_role_cmd(storage, text, bot):
+def delete_temp_role_cmd(storage, text, bot, server):
     """
     <command_name> - delete a temporary role command
     """
@@ -174,15 +163,12 @@ def delete_temp_role_cmd(storage, text, bot):
 
     for cmd in storage["cmds"].values():
         if cmd["name"] == text:
-            # Remove plugin entry from the bot and globals
-            #del bot.plugin_manager.commands[text]
-            del globals()[cmd["name"]]
+            # Remove the command from the bot
+            bot.plugin_manager.unregister_command(PLUGIN_NAME, cmd["name"], server.id)
             del storage["cmds"][cmd["name"]]
 
             storage.sync()
 
-            reload_file(bot)
-
             return "Done"
 
     return "Command not registered"
@@ -382,11 +368,13 @@ def give_temp_role(text, server, command_name, storage, event):
     if role is None:
         return "Could not find given role"
 
-    if "temp_roles" not in storage:
-        storage["temp_roles"] = {}
+    # check_expired_roles walks this dict from another thread
+    with storage.lock:
+        if "temp_roles" not in storage:
+            storage["temp_roles"] = {}
 
-    if command_name not in storage["temp_roles"]:
-        storage["temp_roles"][command_name] = []
+        if command_name not in storage["temp_roles"]:
+            storage["temp_roles"][command_name] = []
 
     # Check if user is already in temp role
     extra = False
@@ -638,48 +626,82 @@ def ban(user_id_to_object, str_to_id, text, storage, event, send_embed, server,
     user.ban(server)
     return "User banned permanently." if permanent else "User banned temporarily."
 
-def check_expired_roles(server, storage):
-    tnow = datetime.datetime.now().timestamp()
-    # Go through each command
-    for cmd_name, cmd_list in storage["temp_roles"].items():
-        # Go through each element in the command
-        for cmd_element in cmd_list:
-            to_del = []
-            # If timeout has expired
-            if cmd_element["expire"] < tnow:
-                # Make a list of elements to remove
-                to_del.append(cmd_element)
-
-            # For each element replace the roles
+def take_expired_roles(storage, tnow):
+    # Take the expired elements out under the store lock, commands may add new ones meanwhile
+    expired = []
+    with storage.lock:
+        # Go through each command
+        for cmd_list in storage["temp_roles"].values():
+            to_del = [elem for elem in cmd_list if elem["expire"] < tnow]
             for elem in to_del:
-                member = dutils.get_user_by_id(server, elem["user_id"])
+                cmd_list.remove(elem)
+            expired.extend(to_del)
 
-                new_roles = []
-                for role_id in elem['crt_roles']:
-                    role = dutils.get_role_by_id(server, role_id)
-                    if role:
-                        new_roles.append(role)
+    if expired:
+        storage.sync()
 
-                if member:
-                    member.replace_roles(new_roles)
+    return expired
 
-                storage["temp_roles"][cmd_name].remove(elem)
-                storage.sync()
+
+async def check_expired_roles(server, storage):
+    tnow = datetime.datetime.now().timestamp()
+
+    # The store lock may be held by a flush, don't wait for it on the loop
+    expired = await asyncio.get_event_loop().run_in_executor(None, take_expired_roles, storage, tnow)
+
+    # For each element replace the roles
+    for elem in expired:
+        member = dutils.get_user_by_id(server, elem["user_id"])
+
+        new_roles = []
+        for role_id in elem['crt_roles']:
+            role = dutils.get_role_by_id(server, role_id)
+            if role:
+                new_roles.append(role)
+
+        if member:
+            member.replace_roles(new_roles)
+
+
+def find_expired_bans(storage, tnow):
+    with storage.lock:
+        return [elem for elem in storage["temp_bans"] if elem["expire"] is None or elem["expire"] < tnow]
+
+
+def remove_bans(storage, done):
+    with storage.lock:
+        for elem in done:
+            if elem in storage["temp_bans"]:
+                storage["temp_bans"].remove(elem)
+
+    storage.sync()
 
 
 async def check_expired_bans(server, storage):
     tnow = datetime.datetime.now().timestamp()
-    for elem in storage["temp_bans"]:
-        if elem["expire"] == None:
-            storage["temp_bans"].remove(elem)
-            storage.sync()
-        if elem["expire"] < tnow:
-            for user in await server.get_bans():
-                if elem["user_id"] == str(user.id):
-                    user.unban(server)
+    loop = asyncio.get_event_loop()
 
-            storage["temp_bans"].remove(elem)
-            storage.sync()
+    expired = await loop.run_in_executor(None, find_expired_bans, storage, tnow)
+    if not expired:
+        return
+
+    # Entries are only removed once handled, a failed unban is retried on the next check
+    done = []
+    bans = {user.id: user for user in await server.get_bans()}
+    for elem in expired:
+        user = bans.get(elem["user_id"])
+        if elem["expire"] is not None and user:
+            try:
+                await user.async_unban(server)
+            except:
+                import traceback
+                traceback.print_exc()
+                continue
+
+        done.append(elem)
+
+    if done:
+        await loop.run_in_executor(None, remove_bans, storage, done)
 
 
 @hook.periodic(1)
@@ -690,7 +712,7 @@ async def check_expired_time(bot):
             "plugins_temp_role.json")
 
         if "temp_roles" in storage:
-            check_expired_roles(server, storage)
+            await check_expired_roles(server, storage)
 
         if "temp_bans" in storage:
             try:
@@ -703,53 +725,54 @@ async def check_expired_time(bot):
 def adjust_user_reason(rstorage, author, user_id, command_name, new_time, message_link):
     reason_id = None
     reason = None
-    for entry in rstorage["temp_roles"][command_name]:
-        if entry["user_id"] == user_id:
-            entry["expire"] = new_time
-            reason_id = entry["reason_id"]
+    with rstorage.transaction():
+        for entry in rstorage["temp_roles"][command_name]:
+            if entry["user_id"] == user_id:
+                entry["expire"] = new_time
+                reason_id = entry["reason_id"]
 
-    for reason in rstorage["reasons"][user_id]:
-        if reason["Case ID"] == reason_id:
-            reason["Modified by"] = "%s / %s" % (author.name, str(author.id))
-            reason["Modified expire time"] = message_link
+        for reason in rstorage["reasons"][user_id]:
+            if reason["Case ID"] == reason_id:
+                reason["Modified by"] = "%s / %s" % (author.name, str(author.id))
+                reason["Modified expire time"] = message_link
 
-    rstorage.sync()
     return reason
 
 
 def create_user_reason(storage, user, author, reason, message_link, expire, reason_type):
-    # Add 'reasons' key
-    if "reasons" not in storage:
-        storage["reasons"] = {}
-
-    # Set case ID to 0 if not set
-    if "case_id" not in storage:
-        storage["case_id"] = 0
-
-    # Add user ID as list
-    if user.id not in storage["reasons"]:
-        storage["reasons"][str(user.id)] = []
-
-    user_lst = storage["reasons"][str(user.id)]
-
-    # Create new element
-    new_elem = OrderedDict()
-    new_elem["Type"] = reason_type
-    new_elem["Case ID"] = storage["case_id"]
-    new_elem["Reason"] = reason
-    new_elem["Date"] = datetime.datetime.now().strftime("%H:%M:%S %d-%m-%Y")
-    if expire:
-        new_elem["Expire date"] = datetime.datetime.fromtimestamp(
-            expire).strftime("%H:%M:%S %d-%m-%Y")
-    new_elem["Link"] = message_link
-    new_elem["Author"] = "%s / %s" % (author.name, str(author.id))
-    new_elem["User"] = "%s / %s" % (user.name, str(user.id))
-    new_elem["Case ID"] = storage["case_id"]
-
-    user_lst.append(new_elem)
-
-    storage["case_id"] += 1
-    storage.sync()
+    # Case IDs must stay unique when several commands run at once
+    with storage.transaction():
+        # Add 'reasons' key
+        if "reasons" not in storage:
+            storage["reasons"] = {}
+
+        # Set case ID to 0 if not set
+        if "case_id" not in storage:
+            storage["case_id"] = 0
+
+        # Add user ID as list
+        if user.id not in storage["reasons"]:
+            storage["reasons"][str(user.id)] = []
+
+        user_lst = storage["reasons"][str(user.id)]
+
+        # Create new element
+        new_elem = OrderedDict()
+        new_elem["Type"] = reason_type
+        new_elem["Case ID"] = storage["case_id"]
+        new_elem["Reason"] = reason
+        new_elem["Date"] = datetime.datetime.now().strftime("%H:%M:%S %d-%m-%Y")
+        if expire:
+            new_elem["Expire date"] = datetime.datetime.fromtimestamp(
+                expire).strftime("%H:%M:%S %d-%m-%Y")
+        new_elem["Link"] = message_link
+        new_elem["Author"] = "%s / %s" % (author.name, str(author.id))
+        new_elem["User"] = "%s / %s" % (user.name, str(user.id))
+        new_elem["Case ID"] = storage["case_id"]
+
+        user_lst.append(new_elem)
+
+        storage["case_id"] += 1
 
     return new_elem
 
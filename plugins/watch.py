@@ -46,7 +46,7 @@ def do_it(thread):
     return prefix + " " + message
 
 
-@hook.periodic(30)
+@hook.periodic(30, singlethread=True)
 def checker(bot, send_message):
     auth = bot.config.get("reddit_auth")
     reddit_inst = praw.Reddit(
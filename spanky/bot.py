@@ -7,10 +7,12 @@ import time
 import asyncio
 
 from spanky.plugin.plugin_manager import PluginManager
-from spanky.plugin.event import EventType, TextEvent, TimeEvent, RegexEvent, HookEvent, OnReadyEvent, OnConnReadyEvent
+from spanky.plugin.event import EventType, TextEvent, RegexEvent, HookEvent
 from spanky.database.db import db_data
-from spanky.plugin.permissions import PermissionMgr
+from spanky.plugin.permissions import PermissionMgr, store_cache
 from spanky.plugin.hook_logic import OnStartHook
+from spanky.plugin.executor import HookExecutor
+from spanky.utils import storage
 
 logger = logging.getLogger("spanky")
 logger.setLevel(logging.DEBUG)
@@ -32,17 +34,17 @@ class Bot():
         with open('bot_config.json') as data_file:
             self.config = json.load(data_file)
 
+        storage.configure(self.config.get("storage", {}))
+        store_cache.configure(self.config.get("storage", {}))
+
         db_path = self.config.get('database', 'sqlite:///cloudbot.db')
         self.logger = logger
 
         # Open the database first
         self.db = db_data(db_path)
 
-        # Create the plugin manager instance
-        self.plugin_manager = PluginManager(
-            self.config.get("plugin_paths", ""), self, self.db)
-
-        self._prefix = self.config.get("command_prefix")
+        # Worker pool that runs the hooks
+        self.executor = HookExecutor.from_config(self.config)
 
         # Import the backend
         try:
@@ -54,27 +56,22 @@ class Bot():
             print(traceback.format_exc())
             sys.exit(1)
 
+        # Create the plugin manager instance
+        self.plugin_manager = PluginManager(
+            self.config.get("plugin_paths", ""), self, self.db)
+
+        self._prefix = self.config.get("command_prefix")
+
     async def start(self):
         # Initialize the backend module
         self.backend = self.input.Init(self)
         await self.backend.do_init()
 
-    def run_on_ready_work(self):
-        for server in self.backend.get_servers():
-            for on_ready in self.plugin_manager.run_on_ready:
-                self.plugin_manager.launch(
-                    OnReadyEvent(
-                        bot=self,
-                        hook=on_ready,
-                        permission_mgr=self.get_pmgr(server.id),
-                        server=server))
-
-        # Run on connection ready hooks
-        for on_conn_ready in self.plugin_manager.run_on_conn_ready:
-            self.plugin_manager.launch(
-                    OnConnReadyEvent(
-                        bot=self,
-                        hook=on_conn_ready))
+    def on_ready_events(self):
+        # Plugins that are still warming up run their on_ready hooks once they're done
+        return self.plugin_manager.ready_events(
+            [hook for hook in self.plugin_manager.run_on_ready if hook.plugin.ready],
+            [hook for hook in self.plugin_manager.run_on_conn_ready if hook.plugin.ready])
 
     def ready(self):
         # Initialize per server permissions
@@ -82,9 +79,22 @@ class Bot():
         for server in self.backend.get_servers():
             self.server_permissions[server.id] = PermissionMgr(server)
 
-        self.run_on_ready_work()
+        # A plugin that gets ready meanwhile runs its own on_ready hooks.
+        # The hooks run after the locks are released, they may register commands.
+        with self.plugin_manager.lock, self.plugin_manager.ready_lock:
+            self.is_ready = True
+            events = self.on_ready_events()
+
+        self.plugin_manager.launch_all(events)
+
+        self.plugin_manager.scheduler.start()
 
-        self.is_ready = True
+        # Dump hook metrics for a local scraper
+        metrics_cfg = self.config.get("metrics", {})
+        if metrics_cfg.get("dump_file"):
+            self.plugin_manager.metrics.add_collector(store_cache.to_prometheus)
+            self.plugin_manager.metrics.start_dump(
+                metrics_cfg["dump_file"], metrics_cfg.get("dump_interval", 30))
 
     def get_servers(self):
         return self.backend.get_servers()
@@ -117,8 +127,7 @@ class Bot():
         return self.backend.get_bot_roles_in_server(server)
 
     def run_in_thread(self, target, args=()):
-        thread = threading.Thread(target=target, args=args)
-        thread.start()
+        return self.executor.submit(target, *args)
 
 # ---------------
 # Server events
@@ -137,40 +146,40 @@ class Bot():
         """On message delete external hook"""
         evt = self.input.EventMessage(EventType.message_del, message, deleted=True)
 
-        self.do_text_event(evt)
+        return self.do_text_event(evt)
 
     def on_bulk_message_delete(self, messages):
         """On message bulk delete external hook"""
         evt = self.input.EventMessage(EventType.msg_bulk_del, messages[0], deleted=True, messages=messages)
 
-        self.do_text_event(evt)
+        return self.do_text_event(evt)
 
     def on_message_edit(self, before, after):
         """On message edit external hook"""
         evt = self.input.EventMessage(EventType.message_edit, after, before)
 
-        self.do_text_event(evt)
+        return self.do_text_event(evt)
 
     def on_message(self, message):
         """On message external hook"""
         evt = self.input.EventMessage(EventType.message, message)
 
-        self.do_text_event(evt)
+        return self.do_text_event(evt)
 
 # ----------------
 # Member events
 # ----------------
     def on_member_update(self, before, after):
         evt = self.input.EventMember(EventType.member_update, member=before, member_after=after)
-        self.do_non_text_event(evt)
+        return self.do_non_text_event(evt)
 
     def on_member_join(self, member):
         evt = self.input.EventMember(EventType.join, member)
-        self.do_non_text_event(evt)
+        return self.do_non_text_event(evt)
 
     def on_member_remove(self, member):
         evt = self.input.EventMember(EventType.part, member)
-        self.do_non_text_event(evt)
+        return self.do_non_text_event(evt)
 
     def on_member_ban(self, server, member):
         pass
@@ -183,67 +192,72 @@ class Bot():
 # ----------------
     def on_reaction_add(self, reaction, user):
         evt = self.input.EventReact(EventType.reaction_add, user=user, reaction=reaction)
-        self.do_non_text_event(evt)
+        return self.do_non_text_event(evt)
 
     def on_reaction_remove(self, reaction, user):
         evt = self.input.EventReact(EventType.reaction_remove, user=user, reaction=reaction)
-        self.do_non_text_event(evt)
+        return self.do_non_text_event(evt)
 
 
     def run_type_events(self, event):
-        # Raw hooks
+        """
+        Dispatch an event to the raw and event hooks. Returns the futures of the hook runs.
+        """
+        futures = []
 
+        # Raw hooks
         pmgr = None
         # Handle PMs
         if hasattr(event, "server"):
             pmgr = self.get_pmgr(event.server.id)
 
         for raw_hook in self.plugin_manager.catch_all_triggers:
-            self.run_in_thread(self.plugin_manager.launch, (
+            futures.append(self.plugin_manager.dispatch(
                 HookEvent(
                     bot=self,
                     hook=raw_hook,
                     event=event,
-                    permission_mgr=pmgr),))
+                    permission_mgr=pmgr)))
 
         # Event hooks
         if event.type in self.plugin_manager.event_type_hooks:
             for event_hook in self.plugin_manager.event_type_hooks[event.type]:
-                self.run_in_thread(
-                    self.plugin_manager.launch, (
-                        HookEvent(bot=self,
-                                  hook=event_hook,
-                                  event=event,
-                                  permission_mgr=pmgr),))
+                futures.append(self.plugin_manager.dispatch(
+                    HookEvent(bot=self,
+                              hook=event_hook,
+                              event=event,
+                              permission_mgr=pmgr)))
+
+        return futures
 
     def do_non_text_event(self, event):
         if not self.is_ready:
-            return
+            return []
 
-        self.run_type_events(event)
+        return self.run_type_events(event)
 
     def do_text_event(self, event):
-        """Process a text event"""
+        """Process a text event. Returns the futures of the hook runs."""
         # Don't do anything if bot is not connected
         if not self.is_ready:
-            return
+            return []
 
         # Let's not
         # Ignore private messages
         #if event.is_pm and event.msg.text.split(maxsplit=1)[0] != ".accept_invite":
         #    return
 
-        self.run_type_events(event)
+        futures = self.run_type_events(event)
 
         # Don't answer to own commands and don't trigger invalid events
         if event.author.bot or not event.do_trigger:
-            return
+            return futures
 
         cmd_text = event.msg.text.lstrip()
 
         # Check if the command starts with .
         if not (len(cmd_text) > 1 and cmd_text[0] == self._prefix):
-            return
+            return futures
 
         # Get the actual command
         cmd_split = cmd_text[1:].split(maxsplit=1)
@@ -251,16 +265,14 @@ class Bot():
         command = cmd_split[0]
         logger.debug("Got command %s" % str(command))
 
-        # Check if it's in the command list
-        if command in self.plugin_manager.commands.keys():
-            hook = self.plugin_manager.commands[command]
-
-            # Test if we can actually send a PM with the command
-            if event.is_pm and not hook.can_pm:
-                return
-            if not event.is_pm and hook.pm_only:
-                return
+        # Resolve the command through the server (or PM) routing table
+        if event.is_pm:
+            routes = self.plugin_manager.get_routes(is_pm=True)
+        else:
+            routes = self.plugin_manager.get_routes(event.server.id)
 
+        hook = routes.get(command)
+        if hook:
             if len(cmd_split) > 1:
                 event_text = cmd_split[1]
             else:
@@ -295,27 +307,11 @@ class Bot():
                     event.channel.name,
                     event.author.name + "/" + str(event.author.id) + "/" + event.author.nick,
                     event.text))
-            self.run_in_thread(target=self.plugin_manager.launch, args=(text_event,))
+            futures.append(self.plugin_manager.dispatch(text_event))
 
         # Regex hooks
-        for regex, regex_hook in self.plugin_manager.regex_hooks:
-            regex_match = regex.search(event.msg.text)
-            if regex_match:
-                regex_event = RegexEvent(bot=self, hook=regex_hook, match=regex_match, event=event)
-                thread = threading.Thread(target=self.plugin_manager.launch, args=(regex_event,))
-                thread.start()
-
-    def on_periodic(self):
-        if not self.is_ready:
-            return
-
-        for _, plugin in self.plugin_manager.plugins.items():
-            for periodic in plugin.periodic:
-                if time.time() - periodic.last_time > periodic.interval:
-                    periodic.last_time = time.time()
-                    t_event = self.input.EventPeriodic()
-                    event = TimeEvent(bot=self, hook=periodic, event=t_event)
-
-                    # TODO account for these
-                    thread = threading.Thread(target=self.plugin_manager.launch, args=(event,))
-                    thread.start()
+        for regex_match, regex_hook in self.plugin_manager.regex_matcher.matches(event.msg.text):
+            regex_event = RegexEvent(bot=self, hook=regex_hook, match=regex_match, event=event)
+            futures.append(self.plugin_manager.dispatch(regex_event))
+
+        return futures
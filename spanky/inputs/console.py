@@ -1,46 +1,864 @@
-class EventPeriodic():
+"""
+Offline backend that drives the bot with synthetic load.
+
+It builds a set of fake servers with members, roles and channels and
+feeds the bot a configurable stream of messages, edits, deletes,
+reactions and joins, then reports how fast the events were dispatched
+to the hooks. No Discord connection or token is needed.
+
+Settings are read from the `console` section of bot_config.json, see
+DEFAULT_CONFIG for what can be set.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("spanky")
+
+bot = None
+
+DEFAULT_CONFIG = {
+    # Seed for the random generator, so that runs can be compared
+    "seed": 1,
+
+    # Size of the fake world
+    "servers": 3,
+    "members": 500,
+    "roles": 40,
+    "channels": 15,
+    # Maximum number of roles each member has
+    "member_roles": 5,
+
+    # Number of events to generate and events per second (0 means as fast as possible)
+    "events": 5000,
+    "rate": 0,
+    # Relative weights of the event types
+    "mix": {
+        "message": 0.80,
+        "edit": 0.06,
+        "delete": 0.05,
+        "reaction": 0.07,
+        "join": 0.02,
+    },
+    # Fraction of messages that are commands and the commands to pick from
+    "command_ratio": 0.1,
+    "commands": ["about", "help", "ping"],
+
+    # How long to wait for the hooks to finish after the last event
+    "drain_timeout": 30,
+    # Print what the bot sends
+    "verbose": False,
+}
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt "
+         "ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco "
+         "laboris nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate "
+         "velit esse cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non proident").split()
+
+EMOJIS = ("👍", "👎", "😂", "❤", "🔥", "🎉", "👀", "✅")
+
+_ids = itertools.count(900000000000000000)
+
+
+def next_id():
+    return next(_ids)
+
+
+def done_future(result=None):
+    """
+    Returns a future that is already done, for operations that complete immediately offline.
+    """
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+#
+# Fake data, shaped like the discord.py objects the bot wraps
+#
+class FakeAsset():
+    def __init__(self, url):
+        self.url = url
+
+
+class FakeRole():
+    def __init__(self, guild, name, position):
+        self.id = next_id()
+        self.name = name
+        self.position = position
+        self.guild = guild
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members.values() if self in member.roles]
+
+
+class FakeMember():
+    def __init__(self, guild, name, roles, bot=False):
+        self.id = next_id()
+        self.name = name
+        self.display_name = name
+        self.guild = guild
+        self.roles = roles
+        self.bot = bot
+        self.avatar = FakeAsset("https://cdn.example.invalid/avatars/%d.png" % self.id)
+
+
+class FakeChannel():
+    def __init__(self, guild, name, position):
+        self.id = next_id()
+        self.name = name
+        self.position = position
+        self.guild = guild
+        self.topic = None
+
+    def is_nsfw(self):
+        return False
+
+
+class FakeGuild():
+    def __init__(self, name):
+        self.id = next_id()
+        self.name = name
+        self.roles = []
+        self.members = {}
+        self.channels = []
+
+        # id lookups, and the member ids in a list to pick random members from
+        self.roles_by_id = {}
+        self.channels_by_id = {}
+        self.member_ids = []
+        self.member_idx = {}
+
+    def add_role(self, role):
+        self.roles.append(role)
+        self.roles_by_id[role.id] = role
+
+    def add_channel(self, chan):
+        self.channels.append(chan)
+        self.channels_by_id[chan.id] = chan
+
+    def add_member(self, member):
+        self.members[member.id] = member
+        self.member_idx[member.id] = len(self.member_ids)
+        self.member_ids.append(member.id)
+
+    def remove_member(self, member_id):
+        member = self.members.pop(member_id, None)
+        if member is None:
+            return None
+
+        # move the last id in the freed slot
+        idx = self.member_idx.pop(member_id)
+        last_id = self.member_ids.pop()
+        if last_id != member_id:
+            self.member_ids[idx] = last_id
+            self.member_idx[last_id] = idx
+
+        return member
+
+    def get_role(self, role_id):
+        return self.roles_by_id.get(role_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_channel(self, chan_id):
+        return self.channels_by_id.get(chan_id)
+
+
+class FakeMessage():
+    def __init__(self, author, channel, content):
+        self.id = next_id()
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.attachments = []
+        self.embeds = []
+        self.reactions = []
+        self.created_at = datetime.datetime.utcnow()
+
+
+class FakeReaction():
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+        self.count = 1
+
+#
+# Backend
+#
+class Init():
+    def __init__(self, bot_inst):
+        global bot
+
+        bot = bot_inst
+
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(bot.config.get("console", {}))
+
+        self.rnd = random.Random(self.config["seed"])
+        self.guilds = [self._make_guild(idx) for idx in range(self.config["servers"])]
+
+        self.own_user = FakeMember(None, "spanky", [], bot=True)
+        self.sent = 0
+        self.report = None
+
+    def _make_guild(self, idx):
+        guild = FakeGuild("server-%d" % idx)
+
+        for pos in range(self.config["roles"]):
+            guild.add_role(FakeRole(guild, "role-%d" % pos, pos))
+        for pos in range(self.config["channels"]):
+            guild.add_channel(FakeChannel(guild, "channel-%d" % pos, pos))
+
+        for pos in range(self.config["members"]):
+            self._add_member(guild, "user-%d-%d" % (idx, pos))
+
+        return guild
+
+    def _add_member(self, guild, name):
+        roles = self.rnd.sample(guild.roles, self.rnd.randint(0, min(self.config["member_roles"], len(guild.roles))))
+        member = FakeMember(guild, name, roles)
+        guild.add_member(member)
+
+        return member
+
+    async def do_init(self):
+        bot.ready()
+
+        generator = LoadGenerator(self, self.config)
+        self.report = await generator.run()
+
+        print(format_report(self.report))
+
+    def get_servers(self):
+        return [Server(guild) for guild in self.guilds]
+
+    def get_own_id(self):
+        return str(self.own_user.id)
+
+    def get_bot_roles_in_server(self, server):
+        return []
+
+    def add_msg_to_cache(self, msg):
+        pass
+
+    def on_send(self, target, text):
+        self.sent += 1
+        if self.config["verbose"]:
+            print("Send to %s: %s" % (target, text))
+
+
+class LoadGenerator():
+    """
+    Feeds synthetic events to the bot and measures, for each event, the time
+    from handing it to the bot until every hook it was dispatched to finished.
+    """
+
+    def __init__(self, backend, config):
+        self.backend = backend
+        self.config = config
+        self.rnd = random.Random(config["seed"] + 1)
+
+        mix = config["mix"]
+        self.event_types = list(mix.keys())
+        self.event_weights = [mix[name] for name in self.event_types]
+
+        # Recent messages, to be edited, deleted or reacted to
+        self.history = collections.deque(maxlen=1000)
+
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.pending = 0
+        self.dispatched = 0
+        self.cancelled = 0
+        self.counts = collections.Counter()
+
+    def _text(self):
+        words = [self.rnd.choice(WORDS) for _ in range(self.rnd.randint(1, 20))]
+        if self.rnd.random() < self.config["command_ratio"]:
+            words.insert(0, bot._prefix + self.rnd.choice(self.config["commands"]))
+
+        return " ".join(words)
+
+    def _random_member(self, guild):
+        return guild.members[self.rnd.choice(guild.member_ids)]
+
+    def _message(self):
+        guild = self.rnd.choice(self.backend.guilds)
+        msg = FakeMessage(self._random_member(guild), self.rnd.choice(guild.channels), self._text())
+        self.history.append(msg)
+
+        return bot.on_message(msg)
+
+    def _edit(self):
+        if not self.history:
+            return self._message()
+
+        before = self.rnd.choice(self.history)
+        after = FakeMessage(before.author, before.channel, self._text())
+        after.id = before.id
+
+        return bot.on_message_edit(before, after)
+
+    def _delete(self):
+        if not self.history:
+            return self._message()
+
+        msg = self.history.popleft()
+        return bot.on_message_delete(msg)
+
+    def _reaction(self):
+        if not self.history:
+            return self._message()
+
+        msg = self.rnd.choice(self.history)
+        reaction = FakeReaction(msg, self.rnd.choice(EMOJIS))
+        msg.reactions.append(reaction)
+
+        return bot.on_reaction_add(reaction, self._random_member(msg.guild))
+
+    def _join(self):
+        guild = self.rnd.choice(self.backend.guilds)
+        member = self.backend._add_member(guild, "joined-%d" % next_id())
+
+        return bot.on_member_join(member)
+
+    def _track(self, futures, started):
+        """
+        Record the latency of an event once all its hook futures are done.
+        """
+        futures = [future for future in futures or [] if future is not None]
+        self.dispatched += len(futures)
+
+        if not futures:
+            self.latencies.append(time.perf_counter() - started)
+            return
+
+        remaining = [len(futures)]
+        with self.lock:
+            self.pending += 1
+
+        def done(future):
+            with self.lock:
+                if future.cancelled():
+                    self.cancelled += 1
+
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self.latencies.append(time.perf_counter() - started)
+                    self.pending -= 1
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    async def run(self):
+        generators = {
+            "message": self._message,
+            "edit": self._edit,
+            "delete": self._delete,
+            "reaction": self._reaction,
+            "join": self._join,
+        }
+
+        total = self.config["events"]
+        rate = self.config["rate"]
+
+        started = time.perf_counter()
+        for idx in range(total):
+            if rate:
+                delay = started + idx / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif idx % 100 == 0:
+                # Let coroutine hooks run
+                await asyncio.sleep(0)
+
+            event_type = self.rnd.choices(self.event_types, self.event_weights)[0]
+            self.counts[event_type] += 1
+
+            event_start = time.perf_counter()
+            try:
+                futures = generators[event_type]()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                continue
+
+            self._track(futures, event_start)
+
+        injected = time.perf_counter() - started
+
+        # Wait for the hooks to finish
+        deadline = time.perf_counter() + self.config["drain_timeout"]
+        while self.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        return {
+            "events": total,
+            "counts": dict(self.counts),
+            "dispatched": self.dispatched,
+            "cancelled": self.cancelled,
+            "unfinished": self.pending,
+            "replies": self.backend.sent,
+            "inject_time": injected,
+            "total_time": elapsed,
+            "throughput": total / elapsed if elapsed else 0,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else 0,
+            },
+        }
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    if not values:
+        return 0
+
+    rank = max(0, int(round(pct / 100 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def format_report(report):
+    lat = report["latency"]
+    return "\n".join([
+        "Events: %d %s" % (report["events"], report["counts"]),
+        "Hook runs dispatched: %d, cancelled: %d, unfinished: %d, replies: %d" % (
+            report["dispatched"], report["cancelled"], report["unfinished"], report["replies"]),
+        "Injected in %.2fs, done in %.2fs, %.1f events/s" % (
+            report["inject_time"], report["total_time"], report["throughput"]),
+        "Latency p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms" % (
+            lat["p50"] * 1000, lat["p90"] * 1000, lat["p99"] * 1000, lat["max"] * 1000),
+    ])
+
+#
+# Wrappers, with the same interface as the discord_py backend
+#
+class ConsoleUtils():
+    @property
+    def in_thread(self):
+        return False
+
+    def get_server(self):
+        return None
+
+    def get_msg(self):
+        return None
+
+    def str_to_id(self, string):
+        return string.strip().replace("@", "").replace("<", "").replace(">", "").replace("!", "").replace("#", "").replace("&", "").replace(":", " ")
+
+    def id_to_user(self, id_str):
+        return "<@%s>" % id_str
+
+    def id_to_chan(self, id_str):
+        return "<#%s>" % id_str
+
+    def id_to_role_name(self, id_str):
+        role = self.get_server().get_role(id_str)
+        if not role:
+            return None
+        return role.name
+
+    def user_id_to_name(self, uid):
+        user = self.get_server().get_user(uid)
+        if not user:
+            return uid
+        return user.name
+
+    def user_id_to_object(self, uid):
+        return self.get_server().get_user(uid)
+
+    def get_channel(self, target, server=None):
+        if target == -1 or target is None:
+            return getattr(self, "source", None)
+
+        if server is None:
+            server = self.get_server()
+
+        if target[0] == "#":
+            for chan in server.get_chans():
+                if chan.name == target[1:]:
+                    return chan
+            return None
+
+        return server.get_chan(target)
+
+    async def async_send_message(self, text=None, embed=None, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=None):
+        return self.send_message(text if text is not None else embed, target, server).result()
+
+    def send_message(self, text, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=None):
+        channel = self.get_channel(target, server)
+        bot.backend.on_send(channel.name if channel else target, text)
+
+        return done_future()
+
+    async def async_send_pm(self, text, user):
+        self.send_pm(text, user)
+
+    def send_pm(self, text, user):
+        bot.backend.on_send("PM %s" % user.name, text)
+
+        return done_future()
+
+    def send_embed(self, title, description=None, fields=None, inline_fields=True, image_url=None, footer_txt=None, target=-1):
+        return self.send_message("[embed] %s" % title, target)
+
+    def reply(self, text, target=-1, timeout=0, allowed_mentions=None):
+        return self.send_message("(%s) %s" % (self.author.name, text), target, timeout=timeout)
+
+    def send_file(self, file_path, target=-1, server=None):
+        return self.send_message("[file] %s" % file_path, target, server)
+
+    async def async_send_file(self, file, target=-1):
+        self.send_message("[file] %s" % getattr(file, "filename", file), target)
+
+
+class EventPeriodic(ConsoleUtils):
     def __init__(self):
         pass
-    
-    def message(self, text, target=None):
-        if target == None:
-            target = self.source
-            
-        print("Send to %s: %s" % (target.name, text))
-    
-class EventMessage():
-    def __init__(self, event_type, message):
+
+
+class EventReact(ConsoleUtils):
+    hook_args = ("type", "author", "server", "msg", "channel", "source", "reaction")
+
+    def __init__(self, event_type, user, reaction):
+        self.type = event_type
+        self.author = User(user)
+        self.server = Server(user.guild)
+        self.msg = Message(reaction.message)
+        self.channel = Channel(reaction.message.channel)
+        self.source = self.channel
+
+        self.reaction = Reaction(reaction)
+
+    def get_server(self):
+        return self.server
+
+    def get_msg(self):
+        return self.msg
+
+
+class EventMember(ConsoleUtils):
+    hook_args = ("type", "member", "server", "after", "before")
+
+    def __init__(self, event_type, member, member_after=None):
         self.type = event_type
-        
+        self.member = User(member)
+        self.server = Server(member.guild)
+
+        if member_after:
+            self.after = EventMember(-1, member_after)
+            self.before = EventMember(-1, member)
+
+    def get_server(self):
+        return self.server
+
+
+class EventMessage(ConsoleUtils):
+    hook_args = ("type", "msg", "msgs", "channel", "author", "server_replies", "is_pm", "server",
+                 "source", "text", "do_trigger", "before", "after", "edited", "deleted")
+
+    def __init__(self, event_type, message, before=None, deleted=False, messages=[]):
+        self.type = event_type
+
+        if message is None:
+            message = messages[0]
         self.msg = Message(message)
+        self.msgs = [Message(message) for message in messages]
+
         self.channel = Channel(message.channel)
-        self.nick = Author(message.author)
-        self.text = message.text
-        self.server = Server(message)
-        
+        self.author = User(message.author)
+
+        self.server_replies = None
+        self.is_pm = False
+        if message.guild:
+            self.server = Server(message.guild)
+        else:
+            self.is_pm = True
+
         self.source = self.channel
-        
+        self.text = self.msg.text
+
+        self.do_trigger = True
+
+        if before:
+            self.before = EventMessage(-1, message=before)
+            self.after = EventMessage(-1, message=message)
+            self.edited = True
+        else:
+            self.before = None
+            self.after = None
+            self.edited = False
+
+        self.deleted = False
+        if deleted:
+            self.deleted = True
+            # don't trigger hooks on deleted messages
+            self.do_trigger = False
+
         self._message = message
-        
-    def message(self, text, target=None):
-        if target == None:
-            target = self.source
-            
-        print("Send to %s: %s" % (target.name, text))
+
+    def get_server(self):
+        if self.is_pm:
+            return self.channel
+        return self.server
+
+    def get_msg(self):
+        return self.msg
+
+    def get_msgs(self):
+        return self.msgs
+
+    @property
+    def attachments(self):
+        return iter(())
+
+    @property
+    def embeds(self):
+        return iter(())
 
 
 class Message():
-    def __init__(self, object):
-        self.text = object.text
-        
-class Author():
-    def __init__(self, name):
-        self.name = name
+    def __init__(self, obj, timeout=0):
+        self.text = obj.content
+        self.id = str(obj.id)
+        self.author = User(obj.author)
+        self.timeout = timeout
+        self._raw = obj
+
+    @property
+    def reactions(self):
+        return [Reaction(reaction) for reaction in self._raw.reactions]
+
+    @property
+    def created_at(self):
+        return self._raw.created_at
+
+    @property
+    def channel(self):
+        return Channel(self._raw.channel)
+
+    @property
+    def in_thread(self):
+        return False
+
+    def add_reaction(self, string):
+        self._raw.reactions.append(FakeReaction(self._raw, string))
+
+    def delete_message(self):
+        pass
+
+
+class User():
+    def __init__(self, obj):
+        self.nick = obj.display_name
+        self.name = obj.name
+        self.id = str(obj.id)
+        self.bot = obj.bot
+
+        self.avatar_url = obj.avatar.url
+
+        self.roles = [Role(role) for role in obj.roles]
+
+        self.bot_owner = "bot_owners" in bot.config and self.id in bot.config["bot_owners"]
+
+        self._raw = obj
+
+    def add_role(self, role):
+        if role._raw not in self._raw.roles:
+            self._raw.roles.append(role._raw)
+
+    def remove_role(self, role):
+        if role._raw in self._raw.roles:
+            self._raw.roles.remove(role._raw)
+
+    def replace_roles(self, roles):
+        self._raw.roles = [role._raw for role in roles]
+
+    def kick(self):
+        if self._raw.guild:
+            self._raw.guild.remove_member(self._raw.id)
+
+    def ban(self, server):
+        self.kick()
+
+    def unban(self, server):
+        pass
+
+    def send_pm(self, text):
+        bot.backend.on_send("PM %s" % self.name, text)
+
 
 class Channel():
-    def __init__(self, name):
-        self.name = name
-    
+    def __init__(self, obj):
+        self.name = obj.name
+        self.id = str(obj.id)
+        self.position = obj.position
+        self.server = Server(obj.guild) if obj.guild else None
+        self.topic = obj.topic
+        self.is_nsfw = obj.is_nsfw()
+        self.is_thread = False
+
+        self._raw = obj
+
+    def delete_messages(self, number):
+        pass
+
+    def set_topic(self, text):
+        self._raw.topic = text
+
+    def set_nsfw(self, state):
+        pass
+
+    def typing(self):
+        return _NoTyping()
+
+
+class _NoTyping():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
 class Server():
-    def __init__(self, name):
-        self.name = name
\ No newline at end of file
+    def __init__(self, obj):
+        self.name = obj.name
+        self.id = str(obj.id)
+        self._raw = obj
+
+    def get_roles(self):
+        return [Role(role) for role in self._raw.roles]
+
+    def get_role(self, role_id):
+        try:
+            role_id = int(role_id)
+        except:
+            return None
+
+        role = self._raw.get_role(role_id)
+        if role:
+            return Role(role)
+        return None
+
+    def get_role_by_name(self, name):
+        for role in self._raw.roles:
+            if role.name == name:
+                return Role(role)
+        return None
+
+    def get_role_ids(self):
+        return [role.id for role in self._raw.roles]
+
+    def get_users(self):
+        return [User(user) for user in self._raw.members.values()]
+
+    def get_user(self, user_id):
+        try:
+            user_id = int(user_id)
+        except:
+            return None
+
+        user = self._raw.get_member(user_id)
+        if user:
+            return User(user)
+        return None
+
+    def get_user_by_name(self, name):
+        for user in self._raw.members.values():
+            if user.name == name:
+                return User(user)
+        return None
+
+    def get_chans(self):
+        return [Channel(chan) for chan in self._raw.channels]
+
+    def get_chan(self, chan_id):
+        try:
+            chan_id = int(chan_id)
+        except:
+            return None
+
+        chan = self._raw.get_channel(chan_id)
+        if chan:
+            return Channel(chan)
+        return None
+
+    def get_chan_by_name(self, name):
+        for chan in self._raw.channels:
+            if chan.name == name:
+                return Channel(chan)
+        return None
+
+    def get_categories(self):
+        return []
+
+    def get_chans_in_cat(self, cat_id):
+        return []
+
+    @property
+    def emojis(self):
+        return []
+
+
+class Role():
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        if other and self.id == other.id:
+            return True
+        return False
+
+    def __init__(self, obj):
+        self.name = obj.name
+        self.id = str(obj.id)
+        self.position = obj.position
+        self._raw = obj
+
+    @property
+    def members(self):
+        return [User(user) for user in self._raw.members]
+
+    def set_name(self, name):
+        self._raw.name = name
+
+
+class Reaction():
+    def __init__(self, obj):
+        self.emoji = Emoji(obj.emoji)
+        self.count = obj.count
+        self._raw = obj
+
+
+class Emoji():
+    def __init__(self, obj):
+        self.name = obj
+        self.id = None
+        self.url = None
+        self._raw = obj
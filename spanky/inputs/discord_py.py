@@ -4,11 +4,15 @@ import discord
 import logging
 import asyncio
 import traceback
-import random
+import threading
 import collections
+import concurrent.futures
 import requests
 import json
 import abc
+import heapq
+import itertools
+import os
 from gc import collect
 from spanky.utils.image import Image
 from spanky.utils import time_utils
@@ -29,9 +33,200 @@ allowed_mentions = discord.AllowedMentions(everyone=False, users=True, roles=Tru
 client = discord.Client(intents=intents, allowed_mentions=allowed_mentions)
 bot = None
 bot_replies = {}
-to_delete = {}
 emojis = json.load(open("plugin_data/twemoji_800x800.json"))
-raw_msg_cache = {} # message cache that we use to map msg_id to msg
+# Rough size of a cached discord.Message without its content, in bytes
+MESSAGE_OVERHEAD = 2048
+
+def estimate_msg_size(msg):
+    raw = msg._raw
+    return MESSAGE_OVERHEAD + len(raw.content or "") + 512 * (len(raw.embeds) + len(raw.attachments))
+
+class MessageCache():
+    """
+    LRU cache of message wrappers by message ID, bounded both by number
+    of messages and by their estimated memory.
+    """
+    def __init__(self, max_messages=5000, max_bytes=16 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # msg id -> (message, estimated size)
+        self.messages = collections.OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, msg_id):
+        with self.lock:
+            entry = self.messages.get(msg_id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.messages.move_to_end(msg_id)
+            return entry[0]
+
+    def __setitem__(self, msg_id, msg):
+        size = estimate_msg_size(msg)
+
+        with self.lock:
+            old = self.messages.pop(msg_id, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self.messages[msg_id] = (msg, size)
+            self.bytes += size
+
+            while self.messages and (len(self.messages) > self.max_messages or self.bytes > self.max_bytes):
+                _, (_, evicted_size) = self.messages.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.messages)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "messages": len(self.messages),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions}
+
+raw_msg_cache = MessageCache() # message cache that we use to map msg_id to msg
+
+class IdentityMap():
+    """
+    One Server, Channel and Role wrapper per discord ID.
+
+    Wrappers are created on first use and reused afterwards. Update events
+    point them to the new discord object and delete events drop them.
+
+    An object that isn't the one in the discord cache, like the "before"
+    object of an update event, gets its own wrapper outside of the map.
+    Its attributes are read from that object, so they keep the old values.
+    """
+    def __init__(self):
+        self.wrappers = {}
+
+    def get(self, cls, obj):
+        key = (cls, obj.id)
+        wrapper = self.wrappers.get(key)
+        if wrapper is None:
+            # another thread may have created it meanwhile, keep the first one
+            wrapper = self.wrappers.setdefault(key, cls._create(obj))
+        elif wrapper._raw is not obj:
+            if cls._cached(obj) is not obj:
+                return cls._create(obj)
+
+            # the cache moved to a new object without an update event
+            wrapper._raw = obj
+        return wrapper
+
+    def refresh(self, cls, obj):
+        wrapper = self.wrappers.get((cls, obj.id))
+        if wrapper is not None:
+            wrapper._raw = obj
+
+    def evict(self, cls, obj_id):
+        self.wrappers.pop((cls, obj_id), None)
+
+    def evict_guild(self, guild):
+        """
+        Drop a server and the wrappers of its channels, threads and roles.
+        """
+        self.evict(Server, guild.id)
+        for chan in list(guild.channels) + list(getattr(guild, "threads", [])):
+            self.evict(Channel, chan.id)
+        for role in guild.roles:
+            self.evict(Role, role.id)
+
+    def clear(self):
+        self.wrappers.clear()
+
+wrappers = IdentityMap()
+
+class NameIndex():
+    """
+    Channels, roles and members of a guild by name.
+
+    Each kind is indexed on the first lookup and kept current by the
+    gateway events. Names aren't unique, a lookup returns the first object
+    that got the name.
+    """
+    KINDS = ("channels", "roles", "members")
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.lock = threading.Lock()
+        # kind -> name -> {id: object}
+        self.index = {}
+
+    def _bucket_map(self, kind):
+        names = self.index.get(kind)
+        if names is None:
+            names = {}
+            for obj in getattr(self.guild, kind):
+                names.setdefault(obj.name, {})[obj.id] = obj
+            self.index[kind] = names
+
+        return names
+
+    def find(self, kind, name):
+        with self.lock:
+            bucket = self._bucket_map(kind).get(name)
+            if bucket:
+                return next(iter(bucket.values()))
+
+        return None
+
+    def add(self, kind, obj):
+        with self.lock:
+            if kind in self.index:
+                self.index[kind].setdefault(obj.name, {})[obj.id] = obj
+
+    def remove(self, kind, obj):
+        with self.lock:
+            names = self.index.get(kind)
+            if names is None:
+                return
+
+            bucket = names.get(obj.name)
+            if bucket is not None:
+                bucket.pop(obj.id, None)
+                if not bucket:
+                    del names[obj.name]
+
+    def update(self, kind, before, after):
+        self.remove(kind, before)
+        self.add(kind, after)
+
+name_indexes = {} # guild id -> NameIndex
+
+def name_index(guild):
+    index = name_indexes.get(guild.id)
+    if index is None or index.guild is not guild:
+        index = name_indexes[guild.id] = NameIndex(guild)
+    return index
+
+def index_event(guild, kind, before=None, after=None):
+    """
+    Update the name index of a guild, if it has one, after an object was created, changed or deleted.
+    """
+    index = name_indexes.get(guild.id)
+    if index is None:
+        return
+
+    if before is not None:
+        index.remove(kind, before)
+    if after is not None:
+        index.add(kind, after)
 
 class Init():
     def __init__(self, bot_inst):
@@ -42,6 +237,17 @@ class Init():
 
         bot = bot_inst
 
+        deleter.path = bot.config.get("pending_deletions_file", deleter.path)
+
+        out_cfg = bot.config.get("outbound", {})
+        outbound.burst = out_cfg.get("burst", outbound.burst)
+        outbound.per_seconds = out_cfg.get("per_seconds", outbound.per_seconds)
+        outbound.merge_window = out_cfg.get("merge_window", outbound.merge_window)
+
+        cache_cfg = bot.config.get("message_cache", {})
+        raw_msg_cache.max_messages = cache_cfg.get("max_messages", raw_msg_cache.max_messages)
+        raw_msg_cache.max_bytes = cache_cfg.get("max_bytes", raw_msg_cache.max_bytes)
+
     async def do_init(self):
         await client.login(bot.config["discord_token"])
         await client.connect()
@@ -68,6 +274,23 @@ class Init():
     def add_msg_to_cache(self, msg):
         raw_msg_cache[msg.id] = msg
 
+    def get_cache_stats(self):
+        """
+        Size and hit rate of the message caches.
+        """
+        replies = list(bot_replies.values())
+        lookups = sum(queue.hits + queue.misses for queue in replies)
+
+        return {
+            "messages": raw_msg_cache.stats(),
+            "replies": {
+                "servers": len(replies),
+                "replies": sum(len(queue) for queue in replies),
+                "bytes": sum(queue.bytes for queue in replies),
+                "hits": sum(queue.hits for queue in replies),
+                "misses": sum(queue.misses for queue in replies),
+                "hit_rate": sum(queue.hits for queue in replies) / lookups if lookups else 0.0}}
+
 class DiscordUtils(abc.ABC):
     @abc.abstractmethod
     def get_server(self):
@@ -97,7 +320,7 @@ class DiscordUtils(abc.ABC):
         except ValueError:
             return None
 
-        role = discord.utils.find(lambda m: m.id == iid_str, self.get_server()._raw.roles)
+        role = self.get_server()._raw.get_role(iid_str)
         if not role:
             return None
         return role.name
@@ -109,7 +332,7 @@ class DiscordUtils(abc.ABC):
         except ValueError:
             return uid
 
-        user = discord.utils.find(lambda m: m.id == iuid, self.get_server()._raw.members)
+        user = self.get_server()._raw.get_member(iuid)
         if not user:
             return uid
         return user.name
@@ -121,7 +344,7 @@ class DiscordUtils(abc.ABC):
         except ValueError:
             return None
 
-        user = discord.utils.find(lambda m: m.id == iuid, self.get_server()._raw.members)
+        user = self.get_server()._raw.get_member(iuid)
         if user:
             return User(user)
         else:
@@ -150,16 +373,15 @@ class DiscordUtils(abc.ABC):
             if target == -1:
                 target = self.source.id
             elif target[0] == "#":
-                target = target[1:]
-                return discord.utils.find(lambda m: m.name == target, target_server.channels)
+                return name_index(target_server).find("channels", target[1:])
 
         if not self.in_thread:
-            return discord.utils.find(lambda m: m.id == int(target), target_server.channels)
+            return target_server.get_channel(int(target))
         else:
-            return discord.utils.find(lambda m: m.id == int(target), target_server.threads)
+            return target_server.get_thread(int(target))
 
     def get_channel_name(self, chan_id):
-        chan = discord.utils.find(lambda m: m.id == int(chan_id), self.get_server()._raw.channels)
+        chan = self.get_server()._raw.get_channel(int(chan_id))
         return chan.name
 
     async def async_edit_message(self, msg, text=None, embed=None):
@@ -171,7 +393,36 @@ class DiscordUtils(abc.ABC):
         elif embed:
             await msg._raw.edit(embed=embed)
 
+    def _may_edit_reply(self):
+        # reactions usually edit the message they were added to
+        if type(self) is EventReact:
+            return True
+        if type(self) is EventMessage and self.get_server().id in bot_replies:
+            return bot_replies[self.get_server().id].replies.get(self.msg.id) is not None
+        return False
+
+    def queue_message(self, text=None, embed=None, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=allowed_mentions):
+        """
+        Queue a message on the outbound queue of its channel.
+        Returns a concurrent.futures.Future with the sent message.
+        """
+        channel = self.get_channel(target, server)
+
+        future = concurrent.futures.Future()
+        if not channel:
+            future.set_result(None)
+            return future
+
+        return outbound.submit(channel.id, OutboundMessage(
+            self, future, text=text, embed=embed, target=target, server=server, timeout=timeout,
+            check_old=check_old, allowed_mentions=allowed_mentions))
+
     async def async_send_message(self, text=None, embed=None, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=allowed_mentions):
+        return await asyncio.wrap_future(self.queue_message(
+            text=text, embed=embed, target=target, server=server, timeout=timeout,
+            check_old=check_old, allowed_mentions=allowed_mentions))
+
+    async def _async_send_message(self, text=None, embed=None, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=allowed_mentions):
         # Get target, if given
         channel = self.get_channel(target, server)
 
@@ -220,9 +471,7 @@ class DiscordUtils(abc.ABC):
             print(traceback.format_exc())
 
     def send_message(self, text, target=-1, server=None, timeout=0, check_old=True, allowed_mentions=allowed_mentions):
-        asyncio.run_coroutine_threadsafe(
-            self.async_send_message(text=text, target=target, server=server, timeout=timeout, check_old=check_old, allowed_mentions=allowed_mentions),
-            bot.loop)
+        return self.queue_message(text=text, target=target, server=server, timeout=timeout, check_old=check_old, allowed_mentions=allowed_mentions)
 
     async def async_send_pm(self, text, user):
         await user._raw.send(text)
@@ -234,11 +483,10 @@ class DiscordUtils(abc.ABC):
     def send_embed(self, title, description=None, fields=None, inline_fields=True, image_url=None, footer_txt=None, target=-1):
         em = dutils.prepare_embed(title, description, fields, inline_fields, image_url, footer_txt)
 
-        asyncio.run_coroutine_threadsafe(
-            self.async_send_message(embed=em, target=target), bot.loop)
+        return self.queue_message(embed=em, target=target)
 
     def reply(self, text, target=-1, timeout=0, allowed_mentions=allowed_mentions):
-        self.send_message("(%s) %s" % (self.author.name, text), target, timeout=timeout, allowed_mentions=allowed_mentions)
+        return self.send_message("(%s) %s" % (self.author.name, text), target, timeout=timeout, allowed_mentions=allowed_mentions)
 
     def send_file(self, file_path, target=-1, server=None):
         dfile = discord.File(file_path)
@@ -275,6 +523,145 @@ class DiscordUtils(abc.ABC):
     async def async_set_avatar(self, image):
         await client.edit_profile(avatar=image)
 
+class OutboundMessage():
+    """
+    A message waiting in a channel queue, with the arguments of DiscordUtils._async_send_message.
+    """
+    def __init__(self, event, future, **kwargs):
+        self.event = event
+        self.future = future
+        self.kwargs = kwargs
+
+    def mergeable_with(self, other):
+        """
+        Plain text messages that don't edit an older reply can be sent as one message.
+        """
+        for msg in (self, other):
+            if msg.kwargs["text"] is None or msg.kwargs["embed"] is not None:
+                return False
+            if msg.kwargs["check_old"] and msg.event._may_edit_reply():
+                return False
+
+        return all(self.kwargs[key] == other.kwargs[key] for key in ("timeout", "allowed_mentions", "server"))
+
+
+class OutboundDispatcher():
+    """
+    One ordered send queue per channel.
+
+    Each channel is paced with a token bucket so that bursts of replies
+    stay under Discord's per-channel rate limit instead of running into
+    429s. With a merge window, consecutive short text messages to the same
+    channel are joined into one message and all their futures get it.
+    """
+    MAX_LENGTH = 2000
+
+    def __init__(self, burst=5, per_seconds=5.0, merge_window=0):
+        self.burst = burst
+        self.per_seconds = per_seconds
+        self.merge_window = merge_window
+
+        # channel id -> deque of OutboundMessage
+        self.queues = {}
+        # channel id -> (tokens, last refill)
+        self.buckets = {}
+
+    def submit(self, channel_id, out_msg):
+        bot.loop.call_soon_threadsafe(self._enqueue, channel_id, out_msg)
+        return out_msg.future
+
+    def _enqueue(self, channel_id, out_msg):
+        queue = self.queues.get(channel_id)
+        if queue is not None:
+            queue.append(out_msg)
+            return
+
+        self.queues[channel_id] = collections.deque([out_msg])
+        bot.loop.create_task(self._drain(channel_id))
+
+    async def _take_token(self, channel_id):
+        tokens, updated = self.buckets.get(channel_id, (self.burst, time_utils.tnow()))
+
+        now = time_utils.tnow()
+        tokens = min(self.burst, tokens + (now - updated) * self.burst / self.per_seconds)
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) * self.per_seconds / self.burst)
+            now = time_utils.tnow()
+            tokens = 1
+
+        self.buckets[channel_id] = (tokens - 1, now)
+
+    @staticmethod
+    def _drop_cancelled(queue):
+        """
+        Remove the messages at the head of the queue whose caller gave up on them.
+        The others are marked as running and can't be cancelled anymore.
+        """
+        while queue and not queue[0].future.set_running_or_notify_cancel():
+            queue.popleft()
+
+    async def _drain(self, channel_id):
+        queue = self.queues[channel_id]
+
+        try:
+            while True:
+                self._drop_cancelled(queue)
+                if not queue:
+                    break
+
+                await self._take_token(channel_id)
+
+                if self.merge_window and len(queue) == 1 and queue[0].kwargs["text"] is not None:
+                    # give the replies of the same burst a chance to arrive
+                    await asyncio.sleep(self.merge_window)
+
+                batch = [queue.popleft()]
+                length = len(batch[0].kwargs["text"] or "")
+                while self.merge_window:
+                    self._drop_cancelled(queue)
+                    if not queue or not batch[0].mergeable_with(queue[0]) or \
+                            length + 1 + len(queue[0].kwargs["text"]) > self.MAX_LENGTH:
+                        break
+                    length += 1 + len(queue[0].kwargs["text"])
+                    batch.append(queue.popleft())
+
+                await self._send(batch)
+        finally:
+            # a new message starts a new drain task
+            del self.queues[channel_id]
+            for out_msg in queue:
+                if not out_msg.future.done():
+                    out_msg.future.cancel()
+
+        # forget channels that are idle again
+        tokens, updated = self.buckets.get(channel_id, (0, 0))
+        if tokens + (time_utils.tnow() - updated) * self.burst / self.per_seconds >= self.burst:
+            self.buckets.pop(channel_id, None)
+
+    async def _send(self, batch):
+        first = batch[0]
+        kwargs = dict(first.kwargs)
+        if len(batch) > 1:
+            kwargs["text"] = "\n".join(out_msg.kwargs["text"] for out_msg in batch)
+
+        try:
+            msg = await first.event._async_send_message(**kwargs)
+
+            # the other merged replies point to the same message
+            for out_msg in batch[1:]:
+                if msg and type(out_msg.event) is EventMessage:
+                    add_bot_reply(out_msg.event.get_server().id, out_msg.event.msg._raw, msg)
+        except Exception as e:
+            traceback.print_exc()
+            for out_msg in batch:
+                out_msg.future.set_exception(e)
+            return
+
+        for out_msg in batch:
+            out_msg.future.set_result(msg)
+
+outbound = OutboundDispatcher()
+
 class EventPeriodic(DiscordUtils):
     def __init__(self):
         pass
@@ -286,6 +673,8 @@ class EventPeriodic(DiscordUtils):
         return None
 
 class EventReact(DiscordUtils):
+    hook_args = ("type", "author", "server", "msg", "channel", "source", "reaction")
+
     def __init__(self, event_type, user, reaction):
         self.type = event_type
         self.author = User(user)
@@ -307,6 +696,8 @@ class EventReact(DiscordUtils):
         return self.msg
 
 class EventMember(DiscordUtils):
+    hook_args = ("type", "member", "server", "after", "before")
+
     def __init__(self, event_type, member, member_after=None):
         self.type = event_type
         self.member = User(member)
@@ -323,14 +714,15 @@ class EventMember(DiscordUtils):
         return None
 
 class EventMessage(DiscordUtils):
+    hook_args = ("type", "msg", "msgs", "channel", "author", "server_replies", "is_pm", "server",
+                 "source", "text", "do_trigger", "before", "after", "edited", "deleted")
+
     def __init__(self, event_type, message, before=None, deleted=False, messages=[]):
         self.type = event_type
 
-        if message is not None:
-            self.msg = Message(message)
-        else:
-            self.msg = Message(messages[0])
-        self.msgs = [Message(message) for message in messages]
+        if message is None:
+            message = messages[0]
+        self.msg = Message(message)
 
         self.channel = Channel(message.channel)
         self.author = User(message.author)
@@ -350,14 +742,13 @@ class EventMessage(DiscordUtils):
 
         self.do_trigger = True
 
-        if before:
-            self.before = EventMessage(-1, message=before)
-            self.after = EventMessage(-1, message=message)
-            self.edited = True
-        else:
-            self.before = None
-            self.after = None
-            self.edited = False
+        # msgs, before and after are only wrapped when a hook asks for them
+        self._messages = messages
+        self._msgs = None
+        self._before_raw = before
+        self._before = None
+        self._after = None
+        self.edited = before is not None
 
         if deleted:
             self.deleted = True
@@ -366,6 +757,24 @@ class EventMessage(DiscordUtils):
 
         self._message = message
 
+    @property
+    def msgs(self):
+        if self._msgs is None:
+            self._msgs = [Message(message) for message in self._messages]
+        return self._msgs
+
+    @property
+    def before(self):
+        if self._before is None and self.edited:
+            self._before = EventMessage(-1, message=self._before_raw)
+        return self._before
+
+    @property
+    def after(self):
+        if self._after is None and self.edited:
+            self._after = EventMessage(-1, message=self._message)
+        return self._after
+
     @property
     def in_thread(self):
         return self.msg.in_thread
@@ -457,17 +866,39 @@ class EventMessage(DiscordUtils):
                     return
 
 class Message():
+    # Attributes are read from the discord object when first used
+    __slots__ = ("_raw", "timeout", "_author", "_channel")
+
     def __init__(self, obj, timeout=0):
-        self.text = obj.content
-        self.id = str(obj.id)
-        self.author = User(obj.author)
-        self.clean_content = obj.clean_content
         self._raw = obj
-        self.reference_info = obj.reference
+        self._author = None
+        self._channel = None
 
         # Delete the message `timeout` seconds after it was created
         self.timeout = timeout
 
+    @property
+    def text(self):
+        return self._raw.content
+
+    @property
+    def id(self):
+        return str(self._raw.id)
+
+    @property
+    def author(self):
+        if self._author is None:
+            self._author = User(self._raw.author)
+        return self._author
+
+    @property
+    def clean_content(self):
+        return self._raw.clean_content
+
+    @property
+    def reference_info(self):
+        return self._raw.reference
+
     def reactions(self):
         for react in self._raw.reactions:
             yield Reaction(react)
@@ -478,7 +909,9 @@ class Message():
 
     @property
     def channel(self):
-        return Channel(self._raw.channel)
+        if self._channel is None:
+            self._channel = Channel(self._raw.channel)
+        return self._channel
 
     @property
     def in_thread(self):
@@ -516,27 +949,41 @@ class Message():
         await self._raw.clear_reactions()
 
 class User():
+    __slots__ = ("_raw", "_roles")
+
     def __init__(self, obj):
-        self.nick = obj.display_name
-        self.name = obj.name
-        self.id = str(obj.id)
-        self.bot = obj.bot
+        self._raw = obj
+        self._roles = None
 
-        self.avatar_url = obj.avatar.url
+    @property
+    def nick(self):
+        return self._raw.display_name
 
-        self.roles = []
-        if hasattr(obj, "roles"):
-            for role in obj.roles:
-                if role.name == '@everyone':
-                    continue
-                self.roles.append(Role(role))
+    @property
+    def name(self):
+        return self._raw.name
 
-        self.bot_owner = False
-        global bot
-        if "bot_owners" in bot.config and self.id in bot.config["bot_owners"]:
-            self.bot_owner = True
+    @property
+    def id(self):
+        return str(self._raw.id)
 
-        self._raw = obj
+    @property
+    def bot(self):
+        return self._raw.bot
+
+    @property
+    def avatar_url(self):
+        return self._raw.avatar.url
+
+    @property
+    def roles(self):
+        if self._roles is None:
+            self._roles = [Role(role) for role in getattr(self._raw, "roles", ()) if role.name != '@everyone']
+        return self._roles
+
+    @property
+    def bot_owner(self):
+        return self.id in bot.config.get("bot_owners", ())
 
     def add_role(self, role):
         async def do_add_role(user, role):
@@ -611,6 +1058,9 @@ class User():
 
         asyncio.run_coroutine_threadsafe(do_unban(self._raw, server), bot.loop)
 
+    async def async_unban(self, server):
+        await server._raw.unban(self._raw)
+
     def send_pm(self, text):
         async def async_send_pm(text):
             await self._raw.send(text)
@@ -619,33 +1069,65 @@ class User():
             async_send_pm(text=text), bot.loop)
 
 class Channel():
-    def __init__(self, obj):
-        self.name = None
-        if hasattr(obj, "name"):
-            self.name = obj.name
+    __slots__ = ("_raw", "_server")
+
+    def __new__(cls, obj):
+        # DM channels are not shared between events, no need to keep them
+        if not hasattr(obj, "guild"):
+            return cls._create(obj)
+        return wrappers.get(cls, obj)
+
+    @classmethod
+    def _create(cls, obj):
+        chan = object.__new__(cls)
+        chan._raw = obj
+        chan._server = None
+        return chan
+
+    @staticmethod
+    def _cached(obj):
+        guild = obj.guild
+        return guild.get_channel(obj.id) or guild.get_thread(obj.id)
+
+    def __hash__(self):
+        return hash(self._raw.id)
+
+    def __eq__(self, other):
+        if other and self.id == other.id:
+            return True
+        return False
 
-        self.id = str(obj.id)
-        self.position = None
-        if hasattr(obj, "position"):
-            self.position = obj.position
+    @property
+    def name(self):
+        return getattr(self._raw, "name", None)
 
-        self.server = None
-        if hasattr(obj, "guild"):
-            self.server = Server(obj.guild)
+    @property
+    def id(self):
+        return str(self._raw.id)
 
-        self.topic = None
-        if hasattr(obj, "topic"):
-            self.topic = obj.topic
+    @property
+    def position(self):
+        return getattr(self._raw, "position", None)
 
-        self.is_nsfw = None
-        if hasattr(obj, "is_nsfw"):
-            self.is_nsfw = obj.is_nsfw()
+    @property
+    def server(self):
+        if self._server is None and hasattr(self._raw, "guild"):
+            self._server = Server(self._raw.guild)
+        return self._server
 
-        self.is_thread = False
-        if type(obj) == discord.threads.Thread:
-            self.is_thread = True
+    @property
+    def topic(self):
+        return getattr(self._raw, "topic", None)
 
-        self._raw = obj
+    @property
+    def is_nsfw(self):
+        if hasattr(self._raw, "is_nsfw"):
+            return self._raw.is_nsfw()
+        return None
+
+    @property
+    def is_thread(self):
+        return type(self._raw) == discord.threads.Thread
 
     def delete_messages(self, number):
         async def do_delete(channel, num):
@@ -744,10 +1226,36 @@ class Category():
             yield Channel(chan)
 
 class Server():
-    def __init__(self, obj):
-        self.name = obj.name
-        self.id = str(obj.id)
-        self._raw = obj
+    __slots__ = ("_raw",)
+
+    def __new__(cls, obj):
+        return wrappers.get(cls, obj)
+
+    @classmethod
+    def _create(cls, obj):
+        server = object.__new__(cls)
+        server._raw = obj
+        return server
+
+    @staticmethod
+    def _cached(obj):
+        return client.get_guild(obj.id)
+
+    def __hash__(self):
+        return hash(self._raw.id)
+
+    def __eq__(self, other):
+        if other and self.id == other.id:
+            return True
+        return False
+
+    @property
+    def name(self):
+        return self._raw.name
+
+    @property
+    def id(self):
+        return str(self._raw.id)
 
     def get_roles(self):
         roles = []
@@ -768,6 +1276,12 @@ class Server():
             return Role(role)
         return None
 
+    def get_role_by_name(self, name):
+        role = name_index(self._raw).find("roles", name)
+        if role:
+            return Role(role)
+        return None
+
     def get_role_ids(self):
         ids = []
         for role in self._raw.roles:
@@ -793,6 +1307,12 @@ class Server():
             return User(user)
         return None
 
+    def get_user_by_name(self, name):
+        user = name_index(self._raw).find("members", name)
+        if user:
+            return User(user)
+        return None
+
     def get_chans(self):
         chans = []
 
@@ -811,6 +1331,12 @@ class Server():
             return Channel(chan)
         return None
 
+    def get_chan_by_name(self, name):
+        chan = name_index(self._raw).find("channels", name)
+        if chan:
+            return Channel(chan)
+        return None
+
     async def get_bans(self):
         bans = await self._raw.bans()
 
@@ -908,21 +1434,40 @@ class Server():
 
 
 class Role():
-    hash = random.randint(0, 2 ** 31)
+    __slots__ = ("_raw",)
+
+    def __new__(cls, obj):
+        return wrappers.get(cls, obj)
+
+    @classmethod
+    def _create(cls, obj):
+        role = object.__new__(cls)
+        role._raw = obj
+        return role
+
+    @staticmethod
+    def _cached(obj):
+        return obj.guild.get_role(obj.id)
 
     def __hash__(self):
-        return self.hash
+        return hash(self._raw.id)
 
     def __eq__(self, other):
         if other and self.id == other.id:
             return True
         return False
 
-    def __init__(self, obj):
-        self.name = obj.name
-        self.id = str(obj.id)
-        self.position = obj.position
-        self._raw = obj
+    @property
+    def name(self):
+        return self._raw.name
+
+    @property
+    def id(self):
+        return str(self._raw.id)
+
+    @property
+    def position(self):
+        return self._raw.position
 
     @property
     def members(self):
@@ -984,46 +1529,238 @@ class Emoji():
         await self._raw.delete(reason=None)
 
 class DictQueue():
+    """
+    The last `size` bot replies of a server, by the ID of the message
+    they replied to and by their own ID.
+    """
     def __init__(self, size):
-        self.queue = collections.deque(maxlen=size)
+        self.size = size
+        self.lock = threading.Lock()
+        # source msg id -> reply, oldest first
+        self.replies = collections.OrderedDict()
+        # reply msg id -> source msg id
+        self.sources = {}
+        # source msg id -> estimated reply size
+        self.sizes = {}
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
 
     def __setitem__(self, key, value):
-        self.queue.append((key, value))
+        with self.lock:
+            self._remove(key)
+
+            self.replies[key] = value
+            self.sources[value.id] = key
+            self.sizes[key] = estimate_msg_size(value)
+            self.bytes += self.sizes[key]
+
+            while len(self.replies) > self.size:
+                self._remove(next(iter(self.replies)))
+
+    def _remove(self, key):
+        reply = self.replies.pop(key, None)
+        if reply is not None:
+            self.sources.pop(reply.id, None)
+            self.bytes -= self.sizes.pop(key)
 
     def __iter__(self):
-        self.index = 0
-        return self
+        with self.lock:
+            return iter(list(self.replies))
 
-    def __next__(self):
-        if self.index == len(self.queue):
-            raise StopIteration
+    def __len__(self):
+        return len(self.replies)
 
-        rval = self.queue[self.index][0]
-        self.index = self.index + 1
-        return rval
+    def _count(self, reply):
+        if reply is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return reply
 
     def get_old_reply(self, message):
-        for elem in self.queue:
-            if elem[0] == message.id:
-                return elem[1]
+        return self._count(self.replies.get(message.id))
 
     def get_bot_message(self, message):
-        for elem in self.queue:
-            if elem[1].id == message.id:
-                return elem[1]
-
-        if message.id in raw_msg_cache:
-            return raw_msg_cache[message.id]
+        with self.lock:
+            key = self.sources.get(message.id)
+            if key is not None:
+                return self._count(self.replies[key])
 
-        return None
+        return self._count(raw_msg_cache.get(message.id))
 
     def bot_messages(self):
-        for elem in reversed(self.queue):
-            yield elem[1]
+        with self.lock:
+            replies = list(self.replies.values())
+
+        for reply in reversed(replies):
+            yield reply
+
+# Discord only bulk deletes 2 to 100 messages younger than 14 days
+BULK_DELETE_MAX = 100
+BULK_DELETE_MAX_AGE = 14 * 24 * 3600 - 60
+# Pending deletions are written to disk at most this often
+DELETIONS_SAVE_INTERVAL = 1.0
+
+class DeletionScheduler():
+    """
+    Deletes bot messages when their timeout expires.
+
+    Deadlines are kept in a heap and the runner only wakes up for the
+    earliest one. Messages of the same channel that expire together are
+    deleted with one bulk call. Pending deletions are saved to a file by
+    the runner, off the loop, so that they still happen after a restart.
+    """
+    def __init__(self, path="pending_deletions.json"):
+        self.path = path
+        # (deadline, seq, channel id, message id)
+        self.heap = []
+        self.seq = itertools.count()
+        self.wakeup = None
+        self.loaded = False
+        # the heap changed since the last save
+        self.dirty = False
+        self.last_save = 0
+
+    def schedule(self, reply):
+        """
+        Delete a message `reply.timeout` seconds from now. Must be called from the bot loop.
+        """
+        deadline = time_utils.tnow() + reply.timeout
+        self._push(deadline, reply._raw.channel.id, reply._raw.id)
+
+        if not self.dirty:
+            self.dirty = True
+            # let the runner plan the save
+            if self.wakeup:
+                self.wakeup.set()
+
+    def _push(self, deadline, channel_id, msg_id):
+        heapq.heappush(self.heap, (deadline, next(self.seq), channel_id, msg_id))
+
+        # wake the runner up if this is the new earliest deadline
+        if self.wakeup and self.heap[0][3] == msg_id:
+            self.wakeup.set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                for deadline, channel_id, msg_id in json.load(f):
+                    self._push(deadline, channel_id, msg_id)
+        except Exception:
+            traceback.print_exc()
+
+    def save(self, entries):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            traceback.print_exc()
+
+    async def save_pending(self):
+        """
+        Save the heap in the default executor, the copy is made on the loop.
+        """
+        self.dirty = False
+        self.last_save = time_utils.tnow()
+        entries = [[deadline, channel_id, msg_id] for deadline, _, channel_id, msg_id in self.heap]
+        await client.loop.run_in_executor(None, self.save, entries)
+
+    def _pop_due(self):
+        """
+        Pop the expired messages, grouped by channel.
+        """
+        now = time_utils.tnow()
+        due = collections.defaultdict(list)
+        while self.heap and self.heap[0][0] <= now:
+            _, _, channel_id, msg_id = heapq.heappop(self.heap)
+            due[channel_id].append(msg_id)
+
+        return due
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        if not self.loaded:
+            self.load()
+            self.loaded = True
+
+        while not client.is_closed():
+            now = time_utils.tnow()
+            timeout = None
+            if self.heap:
+                timeout = max(0, self.heap[0][0] - now)
+            if self.dirty:
+                save_in = max(0, self.last_save + DELETIONS_SAVE_INTERVAL - now)
+                timeout = save_in if timeout is None else min(timeout, save_in)
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            due = self._pop_due()
+            if due:
+                self.dirty = True
+
+            for channel_id, msg_ids in due.items():
+                try:
+                    await self._delete(channel_id, msg_ids)
+                except Exception:
+                    traceback.print_exc()
+
+            if self.dirty and time_utils.tnow() >= self.last_save + DELETIONS_SAVE_INTERVAL:
+                await self.save_pending()
+
+    async def _delete(self, channel_id, msg_ids):
+        channel = client.get_channel(channel_id)
+        if channel is None:
+            try:
+                channel = await client.fetch_channel(channel_id)
+            except discord.HTTPException:
+                # channel is gone, and its messages with it
+                return
+
+        now = time_utils.tnow()
+        bulk = [msg_id for msg_id in msg_ids
+                if now - discord.utils.snowflake_time(msg_id).timestamp() < BULK_DELETE_MAX_AGE]
+        single = [msg_id for msg_id in msg_ids if msg_id not in bulk]
+
+        # DMs have no bulk delete
+        if not hasattr(channel, "delete_messages"):
+            bulk, single = [], msg_ids
+
+        for idx in range(0, len(bulk), BULK_DELETE_MAX):
+            chunk = bulk[idx:idx + BULK_DELETE_MAX]
+            if len(chunk) == 1:
+                single.extend(chunk)
+                continue
+
+            try:
+                await channel.delete_messages([discord.Object(id=msg_id) for msg_id in chunk])
+            except discord.HTTPException:
+                # fall back to deleting them one by one, some may be gone already
+                single.extend(chunk)
+
+        for msg_id in single:
+            try:
+                await channel.get_partial_message(msg_id).delete()
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                traceback.print_exc()
+
+deleter = DeletionScheduler()
 
 def add_temporary_reply(reply):
     if reply.timeout != 0:
-        to_delete[time_utils.tnow() + reply.timeout] = reply
+        deleter.schedule(reply)
 
 def add_bot_reply(server_id, source, reply):
     if server_id not in bot_replies:
@@ -1036,14 +1773,12 @@ def add_bot_reply(server_id, source, reply):
 
     print("%s -> %s" % (source.id, reply.id))
 
-def check_to_delete():
-    for key in list(to_delete.keys()):
-        if key < time_utils.tnow():
-            to_delete[key].delete_message()
-            del to_delete[key]
-
 @client.event
 async def on_ready():
+    # discord.py builds new guild objects when it reconnects
+    wrappers.clear()
+    name_indexes.clear()
+
     print('Logged in as')
     print(client.user.name)
     print(client.user.id)
@@ -1078,14 +1813,17 @@ async def on_message(message):
 ### Members
 @client.event
 async def on_member_join(member):
+    index_event(member.guild, "members", after=member)
     await call_func(bot.on_member_join, member)
 
 @client.event
 async def on_member_remove(member):
+    index_event(member.guild, "members", before=member)
     await call_func(bot.on_member_remove, member)
 
 @client.event
 async def on_member_update(before, after):
+    index_event(after.guild, "members", before, after)
     await call_func(bot.on_member_update, before, after)
 
 @client.event
@@ -1112,15 +1850,16 @@ async def on_raw_reaction_add(reaction):
     if reaction.member.id != client.user.id:
 
         # Fetch the message
-        if reaction.message_id not in raw_msg_cache:
-            msg_id = str(reaction.message_id)
+        msg_id = str(reaction.message_id)
+        msg = raw_msg_cache.get(msg_id)
+        if msg is None:
             channel = await client.fetch_channel(reaction.channel_id)
-            msg = await channel.fetch_message(reaction.message_id)
+            msg = Message(await channel.fetch_message(reaction.message_id))
 
-            raw_msg_cache[msg_id] = Message(msg)
+            raw_msg_cache[msg_id] = msg
 
-        reaction.message = raw_msg_cache[msg_id]._raw
-        reaction.channel = raw_msg_cache[msg_id]._raw.channel
+        reaction.message = msg._raw
+        reaction.channel = msg._raw.channel
 
         await call_func(bot.on_reaction_add, reaction, reaction.member)
 ###
@@ -1133,6 +1872,68 @@ async def on_server_join(server):
 async def on_server_remove(server):
     await call_func(bot.on_server_leave, server)
 
+### Wrapper identity map upkeep
+@client.event
+async def on_guild_available(guild):
+    wrappers.evict_guild(guild)
+    name_indexes.pop(guild.id, None)
+
+@client.event
+async def on_guild_remove(guild):
+    wrappers.evict_guild(guild)
+    name_indexes.pop(guild.id, None)
+
+@client.event
+async def on_guild_update(before, after):
+    wrappers.refresh(Server, after)
+
+@client.event
+async def on_guild_channel_update(before, after):
+    wrappers.refresh(Channel, after)
+    index_event(after.guild, "channels", before, after)
+
+@client.event
+async def on_guild_channel_create(channel):
+    index_event(channel.guild, "channels", after=channel)
+
+@client.event
+async def on_guild_channel_delete(channel):
+    wrappers.evict(Channel, channel.id)
+    index_event(channel.guild, "channels", before=channel)
+
+@client.event
+async def on_thread_update(before, after):
+    wrappers.refresh(Channel, after)
+
+@client.event
+async def on_thread_delete(thread):
+    wrappers.evict(Channel, thread.id)
+
+@client.event
+async def on_guild_role_update(before, after):
+    wrappers.refresh(Role, after)
+    index_event(after.guild, "roles", before, after)
+
+@client.event
+async def on_guild_role_create(role):
+    index_event(role.guild, "roles", after=role)
+
+@client.event
+async def on_guild_role_delete(role):
+    wrappers.evict(Role, role.id)
+    index_event(role.guild, "roles", before=role)
+
+@client.event
+async def on_user_update(before, after):
+    # Usernames are global, update every guild the user is in
+    if before.name == after.name:
+        return
+
+    for index in list(name_indexes.values()):
+        member = index.guild.get_member(after.id)
+        if member:
+            index.update("members", before, member)
+
 ###
 
 async def periodic_task():
@@ -1140,11 +1941,10 @@ async def periodic_task():
 
     while not client.is_closed():
         try:
-            bot.on_periodic()
-            check_to_delete()
-            await asyncio.sleep(1)
+            await deleter.run()
         except Exception:
             traceback.print_stack()
             traceback.print_exc()
+            await asyncio.sleep(1)
 
 client.loop.create_task(periodic_task())
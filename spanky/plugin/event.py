@@ -27,7 +27,23 @@ class EventType(enum.Enum):
     other = 99
     action = 100
 
+def event_args(cls):
+    """
+    Names a hook can ask for from an event class: its methods and properties,
+    plus the instance attributes declared in `hook_args` along the class hierarchy.
+    """
+    names = set(dir(cls))
+    for klass in cls.__mro__:
+        names.update(getattr(klass, "hook_args", ()))
+
+    return names
+
 class BaseEvent():
+    # Instance attributes that hooks can ask for
+    hook_args = ("bot", "db", "hook")
+    # Whether the event wraps a backend event in `event`
+    has_backend_event = True
+
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.db
@@ -64,9 +80,11 @@ class BaseEvent():
             self.db = None
 
     def reply(self, text, allowed_mentions=discord.AllowedMentions(everyone=False, users=True, roles=True)):
-        self.event.reply(text, allowed_mentions=allowed_mentions)
+        return self.event.reply(text, allowed_mentions=allowed_mentions)
 
 class TextEvent(BaseEvent):
+    hook_args = ("text", "triggered_command", "event", "permission_mgr", "doc")
+
     def __init__(self, hook, text, triggered_command, event, bot, permission_mgr):
         super().__init__(bot)
         self.hook = hook
@@ -84,11 +102,16 @@ class TextEvent(BaseEvent):
         self.notice("unimplemented docstring", target=target)
 
 class OnStartEvent(BaseEvent):
+    has_backend_event = False
+
     def __init__(self, bot, hook):
         super().__init__(bot)
         self.hook = hook
 
 class OnReadyEvent(BaseEvent):
+    hook_args = ("permission_mgr", "server", "event")
+    has_backend_event = False
+
     def __init__(self, bot, hook, permission_mgr, server):
         super().__init__(bot)
         self.hook = hook
@@ -97,18 +120,25 @@ class OnReadyEvent(BaseEvent):
         self.event = None
 
 class OnConnReadyEvent(BaseEvent):
+    hook_args = ("event",)
+    has_backend_event = False
+
     def __init__(self, bot, hook):
         super().__init__(bot)
         self.hook = hook
         self.event = None
 
 class TimeEvent(BaseEvent):
+    hook_args = ("event",)
+
     def __init__(self, bot, hook, event):
         super().__init__(bot)
         self.hook = hook
         self.event = event
 
 class HookEvent(BaseEvent):
+    hook_args = ("event", "permission_mgr")
+
     def __init__(self, bot, hook, event, permission_mgr):
         super().__init__(bot)
         self.hook = hook
@@ -120,6 +150,7 @@ class RegexEvent(BaseEvent):
     :type hook: cloudbot.plugin.RegexHook
     :type match: re.__Match
     """
+    hook_args = ("event", "match")
 
     def __init__(self, *, bot=None, hook, event, match):
         """
@@ -0,0 +1,249 @@
+import collections
+import logging
+import threading
+import traceback
+import concurrent.futures
+
+logger = logging.getLogger("spanky")
+
+# Work classes, highest priority first
+WORK_CLASSES = ("moderation", "command", "background")
+DEFAULT_WORK_CLASS = "command"
+
+# Default settings for each work class, overridden by the `classes` section of the executor config
+DEFAULT_CLASS_CONFIG = {
+    "moderation": {"watermark": 800, "policy": "drop"},
+    "command": {"watermark": 800, "policy": "drop"},
+    "background": {"watermark": 200, "policy": "defer", "defer_share": 0.05},
+}
+
+SHED_POLICIES = ("drop", "sample", "defer")
+
+
+class WorkClass():
+    """
+    Queue for one class of work and its load shedding settings.
+
+    Work is always accepted while the queue is below the watermark. Above
+    it, the policy decides what happens to new work:
+        - drop: new work is dropped
+        - sample: only one in every `1 / sample_rate` submissions is kept
+        - defer: new work is parked and run in batches once all queues are empty.
+          While they are busy, the class still gets one in every
+          `1 / defer_share` items the workers take, so it can't starve.
+    Work is always dropped once the queue is full.
+    """
+
+    def __init__(self, name, queue_size=1000, watermark=None, policy="drop", sample_rate=0.1, batch_size=50,
+                 defer_share=0.05):
+        if policy not in SHED_POLICIES:
+            raise ValueError("Unknown shedding policy %s for %s" % (policy, name))
+
+        self.name = name
+        self.queue_size = queue_size
+        self.watermark = min(watermark or queue_size, queue_size)
+        self.policy = policy
+        self.sample_every = max(1, int(round(1 / sample_rate))) if sample_rate else 1
+        self.batch_size = batch_size
+        self.share_every = 0
+        if policy == "defer" and defer_share:
+            self.share_every = max(1, int(round(1 / defer_share)))
+
+        self.queue = collections.deque()
+        self.deferred = collections.deque()
+
+        self.accepted = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.deferred_total = 0
+        self._sample_count = 0
+
+    @property
+    def shed(self):
+        """Work that was rejected and will never run"""
+        return self.dropped + self.sampled_out
+
+    def admit(self, item):
+        """
+        Queue an item according to the shedding policy.
+        Returns False if the item was rejected.
+        """
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+
+        if len(self.queue) >= self.watermark:
+            if self.policy == "drop":
+                self.dropped += 1
+                return False
+
+            if self.policy == "sample":
+                self._sample_count += 1
+                if self._sample_count % self.sample_every:
+                    self.sampled_out += 1
+                    return False
+
+            elif self.policy == "defer":
+                if len(self.deferred) >= self.queue_size:
+                    self.dropped += 1
+                    return False
+
+                self.deferred_total += 1
+                self.deferred.append(item)
+                return True
+
+        self.accepted += 1
+        self.queue.append(item)
+        return True
+
+    def release_batch(self):
+        """
+        Move a batch of deferred work to the queue.
+        """
+        for _ in range(min(self.batch_size, len(self.deferred))):
+            self.queue.append(self.deferred.popleft())
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "deferred": len(self.deferred),
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "deferred_total": self.deferred_total}
+
+
+class HookExecutor():
+    """
+    Fixed pool of named worker threads fed from bounded per-class queues.
+
+    Replaces spawning a new thread for every hook invocation. Workers take
+    work from the highest priority class that has any, so background work
+    can pile up and be shed without delaying commands. Classes with the
+    defer policy only get their small share. Rejected work has its returned
+    future cancelled.
+    """
+
+    def __init__(self, name="hook", workers=16, queue_size=1000, classes=None):
+        self.name = name
+        self.cond = threading.Condition()
+
+        self.classes = collections.OrderedDict()
+        for cls_name in WORK_CLASSES:
+            cls_cfg = dict(DEFAULT_CLASS_CONFIG[cls_name])
+            cls_cfg.setdefault("queue_size", queue_size)
+            cls_cfg.update((classes or {}).get(cls_name, {}))
+            self.classes[cls_name] = WorkClass(cls_name, **cls_cfg)
+
+        # items taken by the workers, to give deferred work its share
+        self.picks = 0
+
+        self.workers = []
+        for idx in range(workers):
+            worker = threading.Thread(
+                target=self._work,
+                name="%s-worker-%d" % (name, idx),
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    @classmethod
+    def from_config(cls, config, name="hook"):
+        """
+        Build an executor from the `hook_executor` section of bot_config.json
+        """
+        exec_cfg = config.get("hook_executor", {})
+        return cls(
+            name=name,
+            workers=exec_cfg.get("workers", 16),
+            queue_size=exec_cfg.get("queue_size", 1000),
+            classes=exec_cfg.get("classes", {}))
+
+    @property
+    def dropped(self):
+        return sum(work_class.shed for work_class in self.classes.values())
+
+    def submit(self, func, *args, work_class=None):
+        """
+        Queue `func(*args)` to be run on a worker thread, as part of the given work class.
+
+        Returns a concurrent.futures.Future for the call.
+        """
+        future = concurrent.futures.Future()
+
+        with self.cond:
+            wc = self.classes.get(work_class) or self.classes[DEFAULT_WORK_CLASS]
+            if wc.admit((future, func, args)):
+                self.cond.notify()
+                return future
+
+            shed = wc.shed
+
+        future.cancel()
+        # Don't flood the log while shedding
+        if shed % 100 == 1:
+            logger.warning("%s executor shedding %s work (%d so far), dropped %s" %
+                           (self.name, wc.name, shed, getattr(func, "__name__", func)))
+
+        return future
+
+    def qsize(self):
+        return sum(len(work_class.queue) for work_class in self.classes.values())
+
+    def stats(self):
+        """
+        Get queue lengths and shedding counters for each work class.
+        """
+        with self.cond:
+            return {name: work_class.stats() for name, work_class in self.classes.items()}
+
+    def _next(self):
+        """
+        Get the next item to run, waiting for one if needed.
+        """
+        with self.cond:
+            while True:
+                item = self._pick()
+                if item is not None:
+                    return item
+
+                # Nothing else to do, run deferred work
+                for work_class in self.classes.values():
+                    if work_class.deferred:
+                        work_class.release_batch()
+                        self.cond.notify_all()
+                        break
+                else:
+                    self.cond.wait()
+
+    def _pick(self):
+        """
+        Take an item from the highest priority queue, unless it's the turn
+        of a class with the defer policy.
+        """
+        self.picks += 1
+        for work_class in self.classes.values():
+            if work_class.share_every and self.picks % work_class.share_every == 0:
+                if work_class.queue:
+                    return work_class.queue.popleft()
+                if work_class.deferred:
+                    return work_class.deferred.popleft()
+
+        for work_class in self.classes.values():
+            if work_class.queue:
+                return work_class.queue.popleft()
+
+        return None
+
+    def _work(self):
+        while True:
+            future, func, args = self._next()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                traceback.print_exc()
+                future.set_exception(e)
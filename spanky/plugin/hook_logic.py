@@ -1,9 +1,13 @@
 import time
+import dis
+import hashlib
 import inspect
 import asyncio
 import sqlalchemy
 import logging
-from spanky.plugin.hook_parameters import extract_params
+from spanky.plugin.hook_parameters import extract_params, map_params
+from spanky.plugin.event import event_args, TextEvent, RegexEvent, TimeEvent, HookEvent, \
+    OnStartEvent, OnReadyEvent, OnConnReadyEvent
 
 from spanky import database
 
@@ -21,8 +25,21 @@ class Hook:
     :type threaded: bool
     :type permissions: list[str]
     :type single_thread: bool
+    :type work_class: str
     """
 
+    # Event class the hook is launched with, None if it doesn't go through argument injection
+    event_class = None
+
+    # Executor work class used when the hook doesn't ask for one
+    default_work_class = "command"
+
+    # Only manifest stand-ins of not yet imported plugins are lazy
+    lazy = False
+
+    # Digest of the hook function and decorator arguments, see hook_fingerprint
+    fingerprint = None
+
     def __init__(self, _type, plugin, func_hook):
         """
         :type _type: str
@@ -51,8 +68,15 @@ class Hook:
             self.permissions = [self.permissions]
 
         self.format = func_hook.kwargs.pop("format", None)
-        self.single_thread = func_hook.kwargs.pop("singlethread", False)
+        self.format_len = None
+        if self.format:
+            self.format_len = len(self.format.split())
+        # Both spellings are used by plugins
+        single_thread = func_hook.kwargs.pop("singlethread", False)
+        single_threaded = func_hook.kwargs.pop("single_threaded", False)
+        self.single_thread = single_thread or single_threaded
         self.server_id = func_hook.kwargs.pop("server_id", None)
+        self.work_class = func_hook.kwargs.pop("work_class", self.default_work_class)
         if isinstance(self.server_id, int):
             self.server_id = str(self.server_id)
 
@@ -66,6 +90,38 @@ class Hook:
             # we should have popped all the args, so warn if there are any left
             logger.warning("Ignoring extra args {} from {}".format(func_hook.kwargs, self.description))
 
+        self.storage_name = self.plugin.name.replace(".py", "").replace("/", "_")
+
+        # Arguments that are looked up on the backend event (event.event)
+        self.backend_args = []
+        self.arg_injectors = []
+        if self.event_class is not None:
+            self.arg_injectors = self._compile_injectors()
+
+    def _compile_injectors(self):
+        """
+        Build one accessor per required argument, so that preparing the
+        arguments for a call doesn't need any lookups by name.
+        Each accessor takes the launch event and returns the argument value.
+        """
+        injectors = []
+        launch_args = event_args(self.event_class)
+
+        for arg in self.required_args:
+            if arg == "storage":
+                injectors.append(_storage_injector(self.storage_name + ".json"))
+            elif arg == "storage_loc":
+                injectors.append(_storage_loc_injector(self.storage_name))
+            elif arg == "cmd_args":
+                injectors.append(_cmd_args_injector(self.param_list))
+            elif arg in launch_args:
+                injectors.append(_event_injector(arg))
+            else:
+                self.backend_args.append(arg)
+                injectors.append(_backend_injector(arg))
+
+        return injectors
+
     def has_server_id(self, sid):
         if type(self.server_id) == str:
             return self.server_id == sid
@@ -92,6 +148,8 @@ class CommandHook(Hook):
     :type auto_help: bool
     """
 
+    event_class = TextEvent
+
     def __init__(self, plugin, cmd_hook):
         """
         :type plugin: Plugin
@@ -124,6 +182,8 @@ class RegexHook(Hook):
     :type regexes: set[re.__Regex]
     """
 
+    event_class = RegexEvent
+
     def __init__(self, plugin, regex_hook):
         """
         :type plugin: Plugin
@@ -146,6 +206,9 @@ class PeriodicHook(Hook):
     :type interval: int
     """
 
+    event_class = TimeEvent
+    default_work_class = "background"
+
     def __init__(self, plugin, periodic_hook):
         """
         :type plugin: Plugin
@@ -154,7 +217,7 @@ class PeriodicHook(Hook):
 
         self.interval = periodic_hook.interval
         self.initial_interval = periodic_hook.kwargs.pop("initial_interval", self.interval)
-        self.last_time = time.time()
+        self.last_time = 0
 
         super().__init__("periodic", plugin, periodic_hook)
 
@@ -170,6 +233,9 @@ class RawHook(Hook):
     :type triggers: set[str]
     """
 
+    event_class = HookEvent
+    default_work_class = "background"
+
     def __init__(self, plugin, msg_raw_hook):
         """
         :type plugin: Plugin
@@ -212,6 +278,9 @@ class EventHook(Hook):
     :type types: set[cloudbot.event.EventType]
     """
 
+    event_class = HookEvent
+    default_work_class = "background"
+
     def __init__(self, plugin, event_hook):
         """
         :type plugin: Plugin
@@ -230,11 +299,16 @@ class EventHook(Hook):
 
 
 class OnStartHook(Hook):
+    event_class = OnStartEvent
+
     def __init__(self, plugin, on_start_hook):
         """
         :type plugin: Plugin
         :type on_start_hook: cloudbot.util.hook._On_startHook
         """
+        # Seconds the hook may take before the plugin is given up on, None for the configured default
+        self.timeout = on_start_hook.kwargs.pop("timeout", None)
+
         super().__init__("on_start", plugin, on_start_hook)
 
     def __repr__(self):
@@ -244,6 +318,8 @@ class OnStartHook(Hook):
         return "on_start {} from {}".format(self.function_name, self.plugin.file_name)
 
 class OnConnReadyHook(Hook):
+    event_class = OnConnReadyEvent
+
     def __init__(self, plugin, on_connection_ready_hook):
         super().__init__("on_connection_ready", plugin, on_connection_ready_hook)
 
@@ -255,6 +331,8 @@ class OnConnReadyHook(Hook):
 
 
 class OnReadyHook(Hook):
+    event_class = OnReadyEvent
+
     def __init__(self, plugin, on_ready_hook):
         super().__init__("on_ready", plugin, on_ready_hook)
 
@@ -264,6 +342,54 @@ class OnReadyHook(Hook):
     def __str__(self):
         return "on_ready {} from {}".format(self.function_name, self.plugin.file_name)
 
+# Returned by an injector when the event can't provide the argument, the call is cancelled
+MISSING_ARG = object()
+
+def _has_attr(obj, name):
+    """
+    Check for an attribute without evaluating it, so that errors raised
+    by properties aren't mistaken for a missing attribute.
+    """
+    return hasattr(type(obj), name) or name in getattr(obj, "__dict__", ())
+
+def _storage_injector(stor_file):
+    def inject(event):
+        # no storage for PMs
+        if getattr(event, "permission_mgr", None) is None:
+            return MISSING_ARG
+        return event.permission_mgr.get_plugin_storage(stor_file)
+    return inject
+
+def _storage_loc_injector(stor_name):
+    def inject(event):
+        if getattr(event, "permission_mgr", None) is None:
+            return MISSING_ARG
+        return event.permission_mgr.get_data_location(stor_name)
+    return inject
+
+def _event_injector(arg):
+    def inject(event):
+        if not _has_attr(event, arg):
+            return MISSING_ARG
+        return getattr(event, arg)
+    return inject
+
+def _cmd_args_injector(param_list):
+    if param_list is None:
+        return lambda event: {}
+
+    def inject(event):
+        return map_params(event.text, param_list)
+    return inject
+
+def _backend_injector(arg):
+    def inject(event):
+        backend_event = getattr(event, "event", None)
+        if backend_event is None or not _has_attr(backend_event, arg):
+            return MISSING_ARG
+        return getattr(backend_event, arg)
+    return inject
+
 def find_hooks(parent, module):
     """
     :type parent: Plugin
@@ -289,13 +415,83 @@ def find_hooks(parent, module):
             func_hooks = func._cloudbot_hook
 
             for hook_type, func_hook in func_hooks.items():
-                type_lists[hook_type].append(_hook_name_to_plugin[hook_type](parent, func_hook))
+                # the hook constructors consume the decorator kwargs
+                fingerprint = hook_fingerprint(func_hook)
+
+                hook = _hook_name_to_plugin[hook_type](parent, func_hook)
+                hook.fingerprint = fingerprint
+                type_lists[hook_type].append(hook)
 
             # delete the hook to free memory
             del func._cloudbot_hook
 
     return command, regex, raw, sieve, event, periodic, on_start, on_ready, on_conn_ready
 
+def _code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+def _settings_repr(value):
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value, key=repr))
+    if isinstance(value, dict):
+        return repr(sorted((key, _settings_repr(val)) for key, val in value.items()))
+    if isinstance(value, (list, tuple)):
+        return repr([_settings_repr(val) for val in value])
+    if hasattr(value, "pattern"):
+        return repr(value.pattern)
+
+    return repr(value)
+
+
+def hook_fingerprint(func_hook):
+    """
+    Digest of a decorated function: its bytecode, constants, default
+    arguments and decorator arguments. Line numbers are left out, so that
+    editing another function in the same file keeps the fingerprint.
+
+    :type func_hook: spanky.plugin.hook._Hook
+    :rtype: str
+    """
+    function = inspect.unwrap(func_hook.function)
+    digest = hashlib.sha1()
+
+    _code_digest(function.__code__, digest)
+    digest.update(_settings_repr(function.__defaults__).encode())
+    digest.update(_settings_repr(function.__kwdefaults__).encode())
+
+    for name, value in sorted(vars(func_hook).items()):
+        if name != "function":
+            digest.update(("%s=%s" % (name, _settings_repr(value))).encode())
+
+    return digest.hexdigest()
+
+
+def stored_globals(function):
+    """
+    Names of the module globals a function assigns or deletes.
+
+    :rtype: set[str]
+    """
+    names = set()
+    codes = [inspect.unwrap(function).__code__]
+    while codes:
+        code = codes.pop()
+        for instr in dis.get_instructions(code):
+            if instr.opname in ("STORE_GLOBAL", "DELETE_GLOBAL"):
+                names.add(instr.argval)
+        codes.extend(const for const in code.co_consts if inspect.iscode(const))
+
+    return names
+
+
 def find_tables(code):
     """
     :type code: object
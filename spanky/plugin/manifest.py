@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+
+from spanky.plugin.event import TextEvent
+from spanky.plugin.permissions import Permission
+
+logger = logging.getLogger("spanky")
+
+# Bump when the entry layout changes, so that old manifests are rebuilt
+MANIFEST_VERSION = 2
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _perm_names(permissions):
+    return [perm.name if isinstance(perm, Permission) else str(perm) for perm in permissions]
+
+
+def _cmd_entry(cmd):
+    return {
+        "name": cmd.name,
+        "function_name": cmd.function_name,
+        "aliases": cmd.aliases,
+        "doc": cmd.doc,
+        # the whole docstring, help shows it like for loaded commands
+        "function_doc": cmd.function.__doc__,
+        "permissions": _perm_names(cmd.permissions),
+        "format": cmd.format,
+        "server_id": cmd.server_id,
+        "can_pm": cmd.can_pm,
+        "pm_only": cmd.pm_only,
+        "threaded": cmd.threaded,
+        "work_class": cmd.work_class,
+    }
+
+
+def plugin_entry(plugin):
+    """
+    Describe the hooks of a loaded plugin.
+
+    Only plugins made of nothing but commands can be loaded lazily: every
+    other hook type has to be registered and run from the module itself.
+    """
+    entry = {
+        "commands": [_cmd_entry(cmd) for cmd in plugin.commands],
+        "regexes": [
+            {"function_name": hook.function_name, "patterns": [str(regex.pattern) for regex in hook.regexes]}
+            for hook in plugin.regexes],
+        "events": [
+            {"function_name": hook.function_name, "types": sorted(evt_type.name for evt_type in hook.types)}
+            for hook in plugin.events],
+        "periodic": [
+            {"function_name": hook.function_name, "interval": hook.interval}
+            for hook in plugin.periodic],
+        "raw": [hook.function_name for hook in plugin.raw_hooks],
+        "sieves": [hook.function_name for hook in plugin.sieves],
+        "on_start": [hook.function_name for hook in plugin.run_on_start],
+        "on_ready": [hook.function_name for hook in plugin.run_on_ready],
+        "on_connection_ready": [hook.function_name for hook in plugin.run_on_conn_ready],
+        "tables": len(plugin.tables),
+    }
+
+    # Custom permissions can't be restored from the manifest
+    custom_perms = any(not isinstance(perm, Permission) for cmd in plugin.commands for perm in cmd.permissions)
+
+    entry["lazy"] = bool(entry["commands"]) and not entry["tables"] and not custom_perms and not any(
+        entry[key] for key in ("regexes", "events", "periodic", "raw", "sieves",
+                               "on_start", "on_ready", "on_connection_ready"))
+
+    return entry
+
+
+class ManifestCache():
+    """
+    Hooks of each plugin file, saved between runs.
+
+    An entry is valid while the file keeps the same modification time. If
+    only the time changed, the file hash is checked before dropping the
+    entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("plugins", {})
+        except Exception as e:
+            logger.warning("Could not read plugin manifest %s: %s" % (path, e))
+
+    def get(self, fname):
+        """
+        Get the manifest entry of a plugin file, or None if it's missing or stale.
+        """
+        entry = self.entries.get(fname)
+        if entry is None:
+            return None
+
+        try:
+            mtime = os.path.getmtime(fname)
+            if entry["mtime"] == mtime:
+                return entry
+
+            if entry["hash"] == file_hash(fname):
+                entry["mtime"] = mtime
+                self.dirty = True
+                return entry
+        except OSError:
+            pass
+
+        return None
+
+    def update(self, fname, plugin):
+        entry = plugin_entry(plugin)
+        entry["mtime"] = os.path.getmtime(fname)
+        entry["hash"] = file_hash(fname)
+
+        self.entries[fname] = entry
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "plugins": self.entries}, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+        self.dirty = False
+
+
+def _lazy_function(name, doc):
+    def not_loaded(*args):
+        raise RuntimeError("Plugin for %s is not loaded yet" % name)
+
+    not_loaded.__name__ = name
+    not_loaded.__doc__ = doc
+    return not_loaded
+
+
+class LazyCommandHook():
+    """
+    Stand-in for a command of a plugin that isn't imported yet.
+
+    Has everything needed to route the command, list it and check its
+    permissions. The plugin manager imports the plugin and swaps in the real
+    hook before it runs.
+    """
+
+    type = "command"
+    lazy = True
+    event_class = TextEvent
+
+    def __init__(self, plugin, entry):
+        self.plugin = plugin
+        self.name = entry["name"]
+        self.function_name = entry["function_name"]
+        self.function = _lazy_function(self.function_name, entry["function_doc"])
+        self.aliases = list(entry["aliases"])
+        self.doc = entry["doc"]
+        self.permissions = [Permission[perm] for perm in entry["permissions"]]
+        self.format = entry["format"]
+        self.format_len = len(self.format.split()) if self.format else None
+        self.server_id = entry["server_id"]
+        self.can_pm = entry["can_pm"]
+        self.pm_only = entry["pm_only"]
+        self.work_class = entry["work_class"]
+
+        # Resolving the plugin imports a module, never do it on the event loop
+        self.threaded = True
+
+        self.required_args = []
+        self.backend_args = []
+        self.arg_injectors = []
+        self.single_thread = False
+
+    @property
+    def description(self):
+        return "{}:{}".format(self.plugin.name, self.function_name)
+
+    def __repr__(self):
+        return "LazyCommand[name: {}, aliases: {}, plugin: {}]".format(self.name, self.aliases[1:], self.plugin.name)
@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("spanky")
+
+# Latency histogram upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Phases of a hook run that get a histogram
+PHASES = ("queue_wait", "sieve", "exec", "reply")
+
+
+class Histogram():
+    """
+    Cumulative latency histogram with fixed buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def avg(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def cumulative(self):
+        """
+        Returns (bound, count of observations <= bound) for each bucket.
+        """
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            yield bound, total
+
+
+class HookMetrics():
+    """
+    Counters and per phase latency histograms for a hook.
+    """
+
+    def __init__(self, description):
+        self.description = description
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.phases = {phase: Histogram() for phase in PHASES}
+
+
+class MetricsRegistry():
+    """
+    Collects hook metrics, keyed by hook description.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = {}
+        self.dump_thread = None
+        # Functions that return more metrics in the exposition format
+        self.collectors = []
+
+    def _get(self, hook):
+        metrics = self.hooks.get(hook.description)
+        if metrics is None:
+            metrics = self.hooks[hook.description] = HookMetrics(hook.description)
+
+        return metrics
+
+    def observe(self, hook, phase, value):
+        with self.lock:
+            self._get(hook).phases[phase].observe(value)
+
+    def call(self, hook, duration, error=False):
+        """
+        Record a finished hook run.
+        """
+        with self.lock:
+            metrics = self._get(hook)
+            metrics.calls += 1
+            metrics.phases["exec"].observe(duration)
+            if error:
+                metrics.errors += 1
+
+    def reject(self, hook):
+        """
+        Record a run that was stopped by the sieves or the command format check.
+        """
+        with self.lock:
+            self._get(hook).rejected += 1
+
+    def timed_reply(self, hook, started, future):
+        """
+        Record the reply send time once the future of the reply is done.
+        """
+        if future is None:
+            return
+
+        def done(_):
+            self.observe(hook, "reply", time.perf_counter() - started)
+
+        future.add_done_callback(done)
+
+    def top(self, count=10, phase="exec"):
+        """
+        Get the `count` hooks with the highest average time for a phase.
+        """
+        with self.lock:
+            ranked = [m for m in self.hooks.values() if m.phases[phase].count]
+
+        ranked.sort(key=lambda m: m.phases[phase].avg, reverse=True)
+        return ranked[:count]
+
+    def add_collector(self, collector):
+        """
+        Add a function whose output is appended to the Prometheus dump.
+        Adding it again does nothing, the bot may get ready more than once.
+        """
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def to_prometheus(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        counters = (
+            ("spanky_hook_calls_total", "Hook runs.", "calls"),
+            ("spanky_hook_errors_total", "Hook runs that raised an exception.", "errors"),
+            ("spanky_hook_rejected_total", "Hook runs stopped by sieves or format checks.", "rejected"))
+
+        lines = []
+        with self.lock:
+            hooks = [self.hooks[desc] for desc in sorted(self.hooks)]
+
+            # All samples of a metric must be grouped together
+            for name, help_text, attr in counters:
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s counter" % name)
+                for metrics in hooks:
+                    lines.append('%s{hook="%s"} %d' % (name, _escape(metrics.description), getattr(metrics, attr)))
+
+            lines.append("# HELP spanky_hook_seconds Time spent in each phase of a hook run.")
+            lines.append("# TYPE spanky_hook_seconds histogram")
+            for metrics in hooks:
+                for phase, hist in metrics.phases.items():
+                    if not hist.count:
+                        continue
+
+                    label = 'hook="%s",phase="%s"' % (_escape(metrics.description), phase)
+                    for bound, count in hist.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append('spanky_hook_seconds_bucket{%s,le="%s"} %d' % (label, le, count))
+                    lines.append("spanky_hook_seconds_sum{%s} %f" % (label, hist.sum))
+                    lines.append("spanky_hook_seconds_count{%s} %d" % (label, hist.count))
+
+        text = "\n".join(lines) + "\n"
+        for collector in self.collectors:
+            text += collector()
+
+        return text
+
+    def dump(self, path):
+        """
+        Write the metrics to a file. The file is replaced atomically so that
+        a scraper never reads a partial dump.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def start_dump(self, path, interval):
+        """
+        Periodically dump the metrics to a file from a background thread.
+        """
+        if self.dump_thread:
+            return
+
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+
+        self.dump_thread = threading.Thread(target=dump_loop, name="metrics-dump", daemon=True)
+        self.dump_thread.start()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
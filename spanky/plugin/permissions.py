@@ -1,6 +1,11 @@
+import collections
 import enum
 import os
+import threading
+import time
+import weakref
 
+from spanky.plugin.metrics import Histogram
 from spanky.utils import storage
 
 @enum.unique
@@ -8,26 +13,177 @@ class Permission(enum.Enum):
     admin     = 0   # Can be used by anyone with admin rights in a server
     bot_owner = 99  # Bot big boss
 
+
+class StoreCache():
+    """
+    Plugin stores of all servers, bounded by count and by size.
+
+    The least recently used stores are flushed and dropped when a limit is
+    hit and loaded again on the next access. A store that is dropped while
+    a hook still holds it is handed out again instead of loading a second
+    copy from disk. Stores are loaded outside of the cache lock, each one
+    under its own load lock, so a cold load only delays its own lookups.
+    """
+    def __init__(self, max_stores=1000, max_bytes=64 * 1024 * 1024):
+        self.max_stores = max_stores
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        # (server id, store file) -> store, oldest first
+        self.stores = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        # stores that were evicted but are still referenced
+        self.alive = weakref.WeakValueDictionary()
+        # key -> lock held while the store is loaded from disk
+        self.loading = {}
+        # evicted stores to flush once the lock is released
+        self.evicted = []
+
+        self.hits = 0
+        self.reused = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = Histogram()
+
+    def configure(self, config):
+        self.max_stores = config.get("cache_max_stores", self.max_stores)
+        self.max_bytes = config.get("cache_max_bytes", self.max_bytes)
+
+    def get(self, server_id, stor_file):
+        key = (server_id, stor_file)
+
+        with self.lock:
+            store = self._cached(key)
+            if store is None:
+                load_lock = self.loading.setdefault(key, threading.Lock())
+
+        if store is None:
+            # two copies of a store would overwrite each other, load each one once
+            with load_lock:
+                with self.lock:
+                    # loaded by the thread that held the load lock
+                    store = self._cached(key)
+
+                if store is None:
+                    started = time.perf_counter()
+                    store = storage.open_store(server_id, stor_file)
+                    elapsed = time.perf_counter() - started
+
+                    with self.lock:
+                        self.load_time.observe(elapsed)
+                        self.loads += 1
+                        self.alive[key] = store
+                        self._add(key, store)
+                        self.loading.pop(key, None)
+
+        # write the evicted stores without blocking the other lookups
+        if self.evicted:
+            with self.lock:
+                evicted, self.evicted = self.evicted, []
+            for old in evicted:
+                old.flush()
+
+        return store
+
+    def _cached(self, key):
+        """
+        The store if it's in memory, else None. Called with the lock held.
+        """
+        store = self.stores.get(key)
+        if store is not None:
+            self.hits += 1
+            self.stores.move_to_end(key)
+            self._resize(key, store)
+            return store
+
+        store = self.alive.get(key)
+        if store is not None:
+            self.reused += 1
+            self._add(key, store)
+
+        return store
+
+    def _add(self, key, store):
+        self.stores[key] = store
+        self.sizes[key] = 0
+        self._resize(key, store)
+        self.evicted.extend(self._evict())
+
+    def _resize(self, key, store):
+        size = store.size_estimate()
+        self.bytes += size - self.sizes[key]
+        self.sizes[key] = size
+
+    def _evict(self):
+        evicted = []
+        while len(self.stores) > 1 and \
+                (len(self.stores) > self.max_stores or self.bytes > self.max_bytes):
+            key, store = self.stores.popitem(last=False)
+            self.bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            evicted.append(store)
+
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {
+                "resident": len(self.stores),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "reused": self.reused,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "load_avg": self.load_time.avg,
+                "load_max": self.load_time.max}
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            gauges = (
+                ("spanky_storage_resident_stores", "Plugin stores in memory.", len(self.stores)),
+                ("spanky_storage_resident_bytes", "Estimated size of the plugin stores in memory.", self.bytes))
+            counters = (
+                ("spanky_storage_loads_total", "Plugin stores loaded from disk.", self.loads),
+                ("spanky_storage_evictions_total", "Plugin stores dropped from memory.", self.evictions))
+
+            for name, help_text, value in gauges:
+                lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s gauge" % name, "%s %d" % (name, value)]
+            for name, help_text, value in counters:
+                lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s counter" % name, "%s %d" % (name, value)]
+
+            lines.append("# HELP spanky_storage_load_seconds Time spent loading a plugin store.")
+            lines.append("# TYPE spanky_storage_load_seconds histogram")
+            for bound, count in self.load_time.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('spanky_storage_load_seconds_bucket{le="%s"} %d' % (le, count))
+            lines.append("spanky_storage_load_seconds_sum %f" % self.load_time.sum)
+            lines.append("spanky_storage_load_seconds_count %d" % self.load_time.count)
+
+        return "\n".join(lines) + "\n"
+
+store_cache = StoreCache()
+
+
 class PermissionMgr():
     def __init__(self, server):
-        self.meta = storage.dsdict(server.id, "meta.json")
         self.server = server
         self.server_id = str(server.id)
 
-        self.stor_cache = {}
+        meta = self.meta
+        if "name" not in meta.keys():
+            meta["name"] = server.name
 
-        if "name" not in self.meta.keys():
-            self.meta["name"] = server.name
+        if "id" not in meta.keys():
+            meta["id"] = server.id
 
-        if "id" not in self.meta.keys():
-            self.meta["id"] = server.id
+    @property
+    def meta(self):
+        return self.get_plugin_storage("meta.json")
 
     def get_plugin_storage(self, stor_file):
-        if self.server_id + stor_file not in self.stor_cache:
-            self.stor_cache[self.server_id + stor_file] = \
-                storage.dsdict(self.server_id, stor_file)
-
-        return self.stor_cache[self.server_id + stor_file]
+        return store_cache.get(self.server_id, stor_file)
 
     def get_data_location(self, name):
-        return str(storage.DS_LOC / self.server_id / (name  +"_data")) + os.sep
\ No newline at end of file
+        return str(storage.DS_LOC / self.server_id / (name  +"_data")) + os.sep
@@ -3,14 +3,24 @@ import asyncio
 import glob
 import os
 import importlib
+import sys
 import asyncio
+import time
+import threading
 
+from types import MappingProxyType
 from discord import File
 from spanky.plugin.reloader import PluginReloader
-from spanky.plugin.hook_logic import find_hooks, find_tables
-from spanky.plugin.event import EventType, OnStartEvent, OnReadyEvent, OnConnReadyEvent
+from spanky.plugin.hook import _CommandHook
+from spanky.plugin.hook_logic import CommandHook, find_hooks, find_tables, stored_globals, MISSING_ARG
+from spanky.plugin.event import EventType, OnStartEvent, OnReadyEvent, OnConnReadyEvent, event_args
 from spanky.inputs.console import EventMessage
 from spanky.plugin.hook_parameters import map_params
+from spanky.plugin.regex_matcher import RegexMatcher
+from spanky.plugin.scheduler import PeriodicScheduler
+from spanky.plugin.executor import HookExecutor, WORK_CLASSES
+from spanky.plugin.metrics import MetricsRegistry
+from spanky.plugin.manifest import ManifestCache, LazyCommandHook
 
 logger = logging.getLogger('spanky')
 logger.setLevel(logging.DEBUG)
@@ -26,158 +36,475 @@ class PluginManager():
         self.modules = []
         self.plugins = {}
         self.commands = {}
+        self.server_commands = {}
+        self.global_routes = MappingProxyType({})
+        self.pm_routes = MappingProxyType({})
+        self.server_routes = {}
         self.event_type_hooks = {}
         self.regex_hooks = []
+        self.regex_matcher = RegexMatcher([])
         self.sieves = []
         self.catch_all_triggers = []
         self.run_on_ready = []
         self.run_on_conn_ready = []
-        self.raw_triggers = []
+        self.raw_triggers = {}
         self.bot = bot
         self.db = db
 
+        # Names that hooks can ask for from the backend events
+        self.backend_args = set()
+        for evt_class in ("EventMessage", "EventReact", "EventMember", "EventPeriodic"):
+            if hasattr(bot.input, evt_class):
+                self.backend_args |= event_args(getattr(bot.input, evt_class))
+
         self.loop = asyncio.get_event_loop()
 
+        # Per hook counters and latencies
+        self.metrics = MetricsRegistry()
+
+        # Periodic hooks are run by the scheduler once the bot is ready
+        self.scheduler = PeriodicScheduler(self)
+
+        # Command only plugins found in the manifest are imported on first use
+        self.manifest = ManifestCache(bot.config.get("plugin_manifest", "plugin_manifest.json"))
+        self.lazy_plugins = bot.config.get("lazy_plugins", False)
+
+        # Guards the hook registries and the route tables built from them.
+        # Loading, reloading and unloading plugins, lazy imports and runtime
+        # commands all go through it. Take it before ready_lock.
+        self.lock = threading.RLock()
+
+        # Plugins becoming ready and the bot becoming ready are ordered by this
+        # lock, so that each plugin gets its on_ready hooks run exactly once
+        self.ready_lock = threading.RLock()
+
+        # plugin name -> (seconds spent loading, how it was loaded)
+        self.load_times = {}
+
+        # on_start hooks run in the background, on their own pool
+        start_cfg = bot.config.get("on_start", {})
+        self.start_executor = HookExecutor(name="on_start", workers=start_cfg.get("workers", 8))
+        self.start_timeout = start_cfg.get("timeout", 120)
+
         # Load each path
         for path in path_list:
             self.plugins.update(self.load_plugins(path))
 
-        self.reloader = {}
-        for path in path_list:
-            self.reloader[path] = PluginReloader(self)
-            self.reloader[path].start([path])
+        self.reloader = PluginReloader(self, bot.config.get("reload_delay", 0.2))
+        self.reloader.start(path_list)
 
-        for plugin in self.plugins.values():
+        for plugin in list(self.plugins.values()):
+            started = time.perf_counter()
             self.finalize_plugin(plugin)
+            self._add_load_time(plugin.name, time.perf_counter() - started)
+
+        self.manifest.save()
+        self.log_load_times()
 
     def finalize_plugin(self, plugin):
+        self._check_hook_args(plugin)
         plugin.create_tables(self.db)
 
-        # run on_start hooks
+        # The plugin is warming up until its on_start hooks are done
+        events = []
+        with self.lock, self.ready_lock:
+            plugin.ready = not plugin.run_on_start
+            self._register_hooks(plugin_hooks(plugin))
+
+            if plugin.ready:
+                events = self._plugin_ready(plugin)
+
+        self.launch_all(events)
+
+        if not plugin.ready:
+            self._start_plugin(plugin)
+
+    def _register_hooks(self, hooks):
+        """
+        Add hooks to the dispatch tables. on_start hooks are run, not registered.
+        """
+        with self.lock:
+            for hook in hooks:
+                if hook.type == "command":
+                    self._register_command(hook)
+                elif hook.type == "periodic":
+                    self.scheduler.add(hook)
+                elif hook.type == "msg_raw":
+                    if hook.is_catch_all():
+                        self.catch_all_triggers.append(hook)
+                    else:
+                        for trigger in hook.triggers:
+                            self.raw_triggers.setdefault(trigger, []).append(hook)
+                elif hook.type == "event":
+                    for event_type in hook.types:
+                        self.event_type_hooks.setdefault(event_type, []).append(hook)
+                elif hook.type == "regex":
+                    for regex_match in hook.regexes:
+                        self.regex_hooks.append((regex_match, hook))
+                elif hook.type == "sieve":
+                    self.sieves.append(hook)
+                elif hook.type == "on_ready":
+                    self.run_on_ready.append(hook)
+                elif hook.type == "on_connection_ready":
+                    self.run_on_conn_ready.append(hook)
+                else:
+                    continue
+
+                logger.debug("Loaded {}".format(repr(hook)))
+
+            self._build_routes()
+            self.regex_matcher = RegexMatcher(self.regex_hooks)
+
+            # sort sieve hooks by priority
+            self.sieves.sort(key=lambda x: x.priority)
+
+    def _unregister_hooks(self, hooks):
+        """
+        Remove hooks from the dispatch tables.
+        """
+        with self.lock:
+            for hook in hooks:
+                if hook.type == "command":
+                    self._unregister_command(hook)
+                elif hook.type == "periodic":
+                    self.scheduler.remove(hook)
+                elif hook.type == "msg_raw":
+                    if hook.is_catch_all():
+                        self.catch_all_triggers.remove(hook)
+                    else:
+                        for trigger in hook.triggers:
+                            assert trigger in self.raw_triggers  # this can't be not true
+                            self.raw_triggers[trigger].remove(hook)
+                            if not self.raw_triggers[trigger]:  # if that was the last hook for this trigger
+                                del self.raw_triggers[trigger]
+                elif hook.type == "event":
+                    for event_type in hook.types:
+                        assert event_type in self.event_type_hooks  # this can't be not true
+                        self.event_type_hooks[event_type].remove(hook)
+                        if not self.event_type_hooks[event_type]:  # if that was the last hook for this event type
+                            del self.event_type_hooks[event_type]
+                elif hook.type == "regex":
+                    for regex_match in hook.regexes:
+                        self.regex_hooks.remove((regex_match, hook))
+                elif hook.type == "sieve":
+                    self.sieves.remove(hook)
+                elif hook.type == "on_ready":
+                    self.run_on_ready.remove(hook)
+                elif hook.type == "on_connection_ready":
+                    self.run_on_conn_ready.remove(hook)
+
+            self._build_routes()
+            self.regex_matcher = RegexMatcher(self.regex_hooks)
+
+    def _start_plugin(self, plugin):
+        """
+        Run the on_start hooks of a plugin in the background, all of them at
+        the same time. The plugin is marked as ready when they all succeed
+        and unloaded if any of them fails or times out.
+        """
+        started = time.perf_counter()
+        state = {"remaining": len(plugin.run_on_start), "failed": False}
+        lock = threading.Lock()
+
+        def finish(on_start_hook, success, reason=None):
+            with lock:
+                if state["failed"]:
+                    return
+
+                if not success:
+                    state["failed"] = True
+                else:
+                    state["remaining"] -= 1
+                    if state["remaining"]:
+                        return
+
+            with self.lock:
+                # The plugin was reloaded or unloaded meanwhile
+                if self.plugins.get(plugin.name) is not plugin:
+                    return
+
+                if not success:
+                    logger.warning("Not registering hooks from plugin {}: on_start hook {} {}".format(
+                        plugin.name, on_start_hook.function_name, reason))
+                    self.unload_plugin(plugin.name)
+                    return
+
+                duration = time.perf_counter() - started
+                self._add_load_time(plugin.name, duration)
+                logger.info("Plugin {} ready, on_start took {:.2f}s".format(plugin.name, duration))
+
+            # outside of the manager lock, ready_lock is never held while waiting for it
+            self.launch_all(self._plugin_ready(plugin))
+
         for on_start_hook in plugin.run_on_start:
-            success = self.launch(OnStartEvent(bot=self.bot, hook=on_start_hook))
-            if not success:
-                logger.warning("Not registering hooks from plugin {}: on_start hook errored".format(plugin.name))
+            self._run_on_start(on_start_hook, finish)
 
-                # unregister databases
-                plugin.unregister_tables(self.db)
-                return
+    def _run_on_start(self, on_start_hook, finish):
+        """
+        Run an on_start hook on the startup pool and call finish(hook, success, reason) when
+        it's done or when its timeout expires.
+        """
+        launch_event = OnStartEvent(bot=self.bot, hook=on_start_hook)
 
-        # run on_ready hooks if bot ready
-        if self.bot.is_ready:
-            # Run the on ready hooks per server
-            for server in self.bot.backend.get_servers():
-                for on_ready_hook in plugin.run_on_ready:
-                    self.launch(OnReadyEvent(
-                        bot=self.bot,
-                        hook=on_ready_hook,
-                        permission_mgr=self.bot.get_pmgr(server.id),
-                        server=server))
-
-            # Run connection ready hooks too
-            for on_conn_ready_hook in plugin.run_on_conn_ready:
-                self.launch(OnConnReadyEvent(
+        if on_start_hook.threaded:
+            future = self.start_executor.submit(self.launch, launch_event)
+        else:
+            future = self.run_coroutine(self._launch_async(launch_event))
+
+        timeout = on_start_hook.timeout or self.start_timeout
+        timer = None
+        if timeout:
+            timer = threading.Timer(
+                timeout, finish, (on_start_hook, False, "timed out after {}s".format(timeout)))
+            timer.daemon = True
+            timer.start()
+
+        def done(fut):
+            if timer:
+                timer.cancel()
+
+            if fut.cancelled():
+                finish(on_start_hook, False, "was cancelled")
+            elif fut.exception() is not None or fut.result() is not True:
+                finish(on_start_hook, False, "errored")
+            else:
+                finish(on_start_hook, True)
+
+        future.add_done_callback(done)
+
+    def _plugin_ready(self, plugin):
+        """
+        Mark a plugin as ready. If the bot is ready already, the bot won't
+        run the plugin's on_ready hooks anymore, returns the events that run
+        them. Launch them once the locks are released.
+        """
+        with self.ready_lock:
+            plugin.ready = True
+            if not self.bot.is_ready:
+                return []
+
+            return self.ready_events(plugin.run_on_ready, plugin.run_on_conn_ready)
+
+    def ready_events(self, on_ready_hooks, on_conn_ready_hooks):
+        """
+        Build the events that run on_ready hooks on each server and on_connection_ready hooks.
+        """
+        events = []
+        for server in self.bot.backend.get_servers():
+            for on_ready_hook in on_ready_hooks:
+                events.append(OnReadyEvent(
                     bot=self.bot,
-                    hook=on_conn_ready_hook))
+                    hook=on_ready_hook,
+                    permission_mgr=self.bot.get_pmgr(server.id),
+                    server=server))
 
+        for on_conn_ready_hook in on_conn_ready_hooks:
+            events.append(OnConnReadyEvent(
+                bot=self.bot,
+                hook=on_conn_ready_hook))
 
-        for periodic_hook in plugin.periodic:
-            logger.debug("Loaded {}".format(repr(periodic_hook)))
+        return events
 
-        # register commands
-        for command_hook in plugin.commands:
+    def launch_all(self, events):
+        """
+        Launch events built under a lock. Hooks may register commands, so
+        this must not be called with ready_lock held.
+        """
+        for event in events:
+            self.launch(event)
+
+    def _command_tables(self, command_hook):
+        """
+        Get the command tables a command hook belongs to: the global one
+        or one table for each server the command is scoped to.
+        """
+        if not command_hook.server_id:
+            return [self.commands]
+
+        server_ids = command_hook.server_id
+        if not isinstance(server_ids, list):
+            server_ids = [server_ids]
+
+        return [self.server_commands.setdefault(str(sid), {}) for sid in server_ids]
+
+    def _register_command(self, command_hook):
+        for table in self._command_tables(command_hook):
             for alias in command_hook.aliases:
-                if alias in self.commands:
+                if alias in table:
                     logger.warning(
                         "Plugin {} attempted to register command {} which was already registered by {}. "
-                        "Ignoring new assignment.".format(plugin.name, alias, self.commands[alias].plugin.name))
+                        "Ignoring new assignment.".format(command_hook.plugin.name, alias, table[alias].plugin.name))
                 else:
-                    self.commands[alias] = command_hook
-            logger.debug("Loaded {}".format(repr(command_hook)))
+                    table[alias] = command_hook
+
+    def _unregister_command(self, command_hook):
+        for table in self._command_tables(command_hook):
+            for alias in command_hook.aliases:
+                if alias in table and table[alias] == command_hook:
+                    # we need to make sure that there wasn't a conflict, so we don't delete another plugin's command
+                    del table[alias]
+
+        # drop server tables that no longer hold anything
+        for sid in [sid for sid, table in self.server_commands.items() if not table]:
+            del self.server_commands[sid]
+
+    def _build_routes(self):
+        """
+        Rebuild the immutable command routing tables.
 
-        # register raw hooks
-        for raw_hook in plugin.raw_hooks:
-            if raw_hook.is_catch_all():
-                self.catch_all_triggers.append(raw_hook)
+        Each server that has server-scoped commands gets its own table made
+        of the global commands plus its overrides. PMs get a table with
+        the commands that can be used in PMs.
+        """
+        with self.lock:
+            global_routes = {}
+
+            for alias, command_hook in self.commands.items():
+                if not command_hook.pm_only:
+                    global_routes[alias] = command_hook
+
+            self.global_routes = MappingProxyType(global_routes)
+            self.pm_routes = self._pm_routes()
+            self.server_routes = {sid: self._server_routes(sid) for sid in self.server_commands}
+
+    def _pm_routes(self):
+        """
+        PMs have no server, server-scoped commands that can be used in PMs
+        are added unless a global command or another server took the alias.
+        """
+        routes = {}
+        for alias, command_hook in self.commands.items():
+            if command_hook.can_pm:
+                routes[alias] = command_hook
+
+        for table in self.server_commands.values():
+            for alias, command_hook in table.items():
+                if command_hook.can_pm:
+                    routes.setdefault(alias, command_hook)
+
+        return MappingProxyType(routes)
+
+    def _server_routes(self, sid):
+        routes = dict(self.global_routes)
+        for alias, command_hook in self.server_commands[sid].items():
+            if not command_hook.pm_only:
+                routes[alias] = command_hook
+
+        return MappingProxyType(routes)
+
+    def _build_server_routes(self, sid):
+        """
+        Rebuild the routing table of a single server.
+        """
+        with self.lock:
+            if sid in self.server_commands:
+                self.server_routes[sid] = self._server_routes(sid)
             else:
-                for trigger in raw_hook.triggers:
-                    if trigger in self.raw_triggers:
-                        self.raw_triggers[trigger].append(raw_hook)
-                    else:
-                        self.raw_triggers[trigger] = [raw_hook]
-            logger.debug("Loaded {}".format(repr(raw_hook)))
-
-        # register events
-        for event_hook in plugin.events:
-            for event_type in event_hook.types:
-                if event_type in self.event_type_hooks:
-                    self.event_type_hooks[event_type].append(event_hook)
-                else:
-                    self.event_type_hooks[event_type] = [event_hook]
-            logger.debug("Loaded {}".format(repr(event_hook)))
+                self.server_routes.pop(sid, None)
 
-        # register regexps
-        for regex_hook in plugin.regexes:
-            for regex_match in regex_hook.regexes:
-                self.regex_hooks.append((regex_match, regex_hook))
-            logger.debug("Loaded {}".format(repr(regex_hook)))
+    def register_command(self, plugin_name, function, name, server_id, **kwargs):
+        """
+        Register a command created at runtime for a single server, without
+        reloading its plugin. Takes the same arguments as hook.command.
+        Registering a command with the same name again replaces it.
 
-        # register sieves
-        for sieve_hook in plugin.sieves:
-            self.sieves.append(sieve_hook)
+        Returns the command hook, or None if the plugin isn't loaded.
 
-        # register on connection ready hooks
-        for on_ready_hook in plugin.run_on_ready:
-            self.run_on_ready.append(on_ready_hook)
+        :type plugin_name: str
+        :type function: callable
+        :type name: str
+        """
+        plugin = self.plugins.get(plugin_name)
+        if plugin is None or plugin.lazy:
+            logger.warning("Cannot register command {} from {}: plugin not loaded".format(name, plugin_name))
+            return None
+
+        func_hook = _CommandHook(function)
+        func_hook.add_hook(name, dict(kwargs, server_id=str(server_id)))
+        command_hook = CommandHook(plugin, func_hook)
+        self._check_hook(command_hook)
+
+        with self.lock:
+            key = (command_hook.server_id, command_hook.name)
+            old_hook = plugin.dynamic_commands.pop(key, None)
+            if old_hook is not None:
+                self._unregister_command(old_hook)
+
+            plugin.dynamic_commands[key] = command_hook
+            self._register_command(command_hook)
+            self._build_server_routes(command_hook.server_id)
+            if command_hook.can_pm or (old_hook is not None and old_hook.can_pm):
+                self.pm_routes = self._pm_routes()
+
+        return command_hook
+
+    def unregister_command(self, plugin_name, name, server_id):
+        """
+        Remove a command registered with register_command.
+        Returns True if the command was removed.
+        """
+        plugin = self.plugins.get(plugin_name)
+        if plugin is None:
+            return False
+
+        with self.lock:
+            command_hook = plugin.dynamic_commands.pop((str(server_id), name.lower()), None)
+            if command_hook is None:
+                return False
+
+            self._unregister_command(command_hook)
+            self._build_server_routes(command_hook.server_id)
+            if command_hook.can_pm:
+                self.pm_routes = self._pm_routes()
 
-        # register on ready hooks
-        for on_conn_ready_hook in plugin.run_on_conn_ready:
-            self.run_on_conn_ready.append(on_conn_ready_hook)
+        return True
+
+    def get_routes(self, server_id=None, is_pm=False):
+        """
+        Get the command routing table (alias -> hook) for a server or for PMs.
+        """
+        if is_pm:
+            return self.pm_routes
 
-        # sort sieve hooks by priority
-        self.sieves.sort(key=lambda x: x.priority)
+        return self.server_routes.get(server_id, self.global_routes)
 
     def _prepare_parameters(self, hook, event):
         """
-        Prepares arguments for the given hook
+        Prepares arguments for the given hook using its precompiled injectors
 
         :type hook: cloudbot.plugin.Hook
         :type event: cloudbot.event.Event
         :rtype: list
         """
-        parameters = []
+        parameters = [inject(event) for inject in hook.arg_injectors]
 
-        # Is only none for PMs
-        if hasattr(event, "permission_mgr") and event.permission_mgr:
-            if "storage" in hook.required_args:
-                stor_name = hook.plugin.name.replace(".py", "").replace("/","_")
-                event.storage = event.permission_mgr.get_plugin_storage(stor_name + ".json")
-
-            if "storage_loc" in hook.required_args:
-                event.storage_loc = \
-                    event.permission_mgr.get_data_location(
-                        hook.plugin.name.replace(".py", "").replace("/","_"))
-
-        if "cmd_args" in hook.required_args and hook.param_list is not None:
-            event.cmd_args = map_params(event.text, hook.param_list)
-        else:
-            event.cmd_args = {}
-
-        for required_arg in hook.required_args:
-            if hasattr(event, required_arg):
-                value = getattr(event, required_arg)
-                parameters.append(value)
-            elif hasattr(event.event, required_arg):
-                value = getattr(event.event, required_arg)
-                parameters.append(value)
-            else:
-                logger.error("Plugin {} asked for invalid argument '{}', cancelling execution!"
-                             .format(hook.description, required_arg))
-                print(dir(event))
-                print(dir(event.event))
+        for arg, value in zip(hook.required_args, parameters):
+            if value is MISSING_ARG:
+                # e.g. no storage for PMs or no such attribute on the backend event
+                logger.debug("Cancelling {}: the event has no '{}'".format(hook.description, arg))
                 return None
+
         return parameters
 
+    def _check_hook_args(self, plugin):
+        """
+        Report hook arguments that no event can provide and unknown work classes.
+        """
+        for hooks in (plugin.commands, plugin.regexes, plugin.raw_hooks, plugin.events, plugin.periodic,
+                      plugin.run_on_start, plugin.run_on_ready, plugin.run_on_conn_ready):
+            for hook in hooks:
+                self._check_hook(hook)
+
+    def _check_hook(self, hook):
+        if hook.work_class not in WORK_CLASSES:
+            logger.warning("Unknown work class '{}' for {}, using the default one"
+                           .format(hook.work_class, hook.description))
+
+        for arg in hook.backend_args:
+            if not hook.event_class.has_backend_event or arg not in self.backend_args:
+                logger.error("Plugin {} asked for invalid argument '{}', calls will be cancelled!"
+                             .format(hook.description, arg))
+
     def _execute_hook(self, hook, event):
         event.prepare()
 
@@ -185,84 +512,175 @@ class PluginManager():
         if parameters is None:
             return None
 
-        # shitty workaround
-        async def call_func():
-            try:
-                await hook.function(*parameters)
-            except:
-                import traceback; traceback.print_exc()
+        return hook.function(*parameters)
 
-        if not asyncio.iscoroutinefunction(hook.function):
-            return hook.function(*parameters)
-        else:
-            asyncio.run_coroutine_threadsafe(call_func(), self.bot.loop)
+    def _prepare_async_hook(self, hook, event):
+        """
+        Open the event resources and build the arguments of a coroutine hook.
+        """
+        event.prepare()
+
+        return self._prepare_parameters(hook, event)
+
+    def _handle_output(self, event, out):
+        """
+        Send whatever a hook returned back to the event source.
+
+        Returns the future of the send, if the backend gives one.
+        """
+        if out is None:
             return None
 
+        if isinstance(out, (list, tuple)):
+            # if there are multiple items in the response, return them on multiple lines
+            return event.reply(*out)
+        elif isinstance(out, File):
+            # shitty workaround
+            async def call_func():
+                try:
+                    await event.event.async_send_file(out)
+                except:
+                    import traceback; traceback.print_exc()
+            return self.run_coroutine(call_func())
+        else:
+            return event.reply(str(out))
+
+    def _reply(self, hook, event, out):
+        started = time.perf_counter()
+        self.metrics.timed_reply(hook, started, self._handle_output(event, out))
+
     def execute_hook(self, hook, event):
         """
         Runs the specific hook with the given bot and event.
 
         Returns False if the hook errored, True otherwise.
         """
+        started = time.perf_counter()
+        try:
+            out = self._execute_hook(hook, event)
+        except:
+            self.metrics.call(hook, time.perf_counter() - started, error=True)
+            import traceback; traceback.print_exc()
+            return False
 
-        out = self._execute_hook(hook, event)
-        
-        if out is not None:
-            if isinstance(out, (list, tuple)):
-                # if there are multiple items in the response, return them on multiple lines
-                event.reply(*out)
-            elif isinstance(out, File):
-                # shitty workaround
-                async def call_func():
-                    try:
-                        await event.event.async_send_file(out)
-                    except:
-                        import traceback; traceback.print_exc()
-                asyncio.run_coroutine_threadsafe(call_func(), self.bot.loop)
-            else:
-                event.reply(str(out))
+        self.metrics.call(hook, time.perf_counter() - started)
+        self._reply(hook, event, out)
+
+        return True
 
-        return (True)
+    async def execute_async_hook(self, hook, event, parameters):
+        """
+        Runs the specific coroutine hook on the event loop, with the
+        arguments from _prepare_async_hook.
+
+        Returns False if the hook errored, True otherwise.
+        """
+        started = time.perf_counter()
+        try:
+            out = await hook.function(*parameters)
+        except:
+            self.metrics.call(hook, time.perf_counter() - started, error=True)
+            import traceback; traceback.print_exc()
+            return False
+
+        self.metrics.call(hook, time.perf_counter() - started)
+        self._reply(hook, event, out)
+
+        return True
+
+    def run_coroutine(self, coro):
+        """
+        Schedule a coroutine on the bot loop. If called from the loop thread
+        the coroutine is turned directly into a task, otherwise it's handed
+        over thread-safely.
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.bot.loop:
+            return self.bot.loop.create_task(coro)
+
+        return asyncio.run_coroutine_threadsafe(coro, self.bot.loop)
 
     def correct_format(self, hook, text):
         """Check if the request has the required format"""
-        if hook.format:
-            if len(hook.format.split()) == len(text.split()):
-                return True
-            else:
-                return False
-        else:
+        if hook.format_len is None:
             return True
 
-        return False
+        return hook.format_len == len(text.split())
 
-    def launch(self, launch_event):
+    def dispatch(self, launch_event):
         """
-        Dispatch a given event to a given hook using a given bot object.
-        Returns False if the hook didn't run successfully, and True if it ran successfully.
+        Run a given event through its hook without blocking the caller.
+
+        Coroutine hooks become tasks on the bot loop, blocking hooks are
+        queued on the bot's hook executor under the hook's work class.
+        Returns the future of the launch.
         """
+        queued_at = time.perf_counter()
+
+        if launch_event.hook.lazy:
+            return self.bot.executor.submit(
+                self._launch_lazy, launch_event, queued_at, work_class=launch_event.hook.work_class)
 
+        if launch_event.hook.threaded:
+            return self.bot.executor.submit(
+                self.launch, launch_event, queued_at, work_class=launch_event.hook.work_class)
+
+        return self.run_coroutine(self._launch_async(launch_event, queued_at))
+
+    def _timed_can_launch(self, launch_event, queued_at):
+        """
+        can_launch, recording how long the event waited to be run and how long the checks took.
+        """
         hook = launch_event.hook
+        started = time.perf_counter()
+        if queued_at is not None:
+            self.metrics.observe(hook, "queue_wait", started - queued_at)
 
-        if hook.type in ("command") and not launch_event.event.is_pm:
-            # Run hooks on only the servers where they should run
-            if launch_event.hook.server_id and not launch_event.hook.has_server_id(str(launch_event.event.server.id)):
-                return
+        allowed = self.can_launch(launch_event)
 
-            # Ask the sieves to validate our command
-            for sieve in self.sieves:
-                args = {"bot": self.bot, "bot_event":launch_event}
-                if "storage" in sieve.required_args:
-                    stor_name = sieve.plugin.name.replace(".py", "").replace("/","_")
-                    storage = launch_event.permission_mgr.get_plugin_storage(stor_name + ".json")
-                    args["storage"] = storage
-                can_run, msg = sieve.function(**args)
-                if msg:
-                    launch_event.event.reply(msg, timeout=15)
-                if not can_run:
-                    return
+        self.metrics.observe(hook, "sieve", time.perf_counter() - started)
+        if not allowed:
+            self.metrics.reject(hook)
+
+        return allowed
+
+    def can_launch(self, launch_event):
+        """
+        Check server filters, sieves and command format for a given event.
+        Returns True if the hook is allowed to run.
+        """
+
+        hook = launch_event.hook
+
+        # Nothing but on_start runs while the plugin is warming up
+        warming_up = not hook.plugin.ready and hook.type != "on_start"
+        if warming_up and hook.type != "command":
+            return False
+
+        if hook.type in ("command"):
+            if not launch_event.event.is_pm:
+                # Ask the sieves to validate our command
+                for sieve in self.sieves:
+                    args = {"bot": self.bot, "bot_event":launch_event}
+                    if "storage" in sieve.required_args:
+                        storage = launch_event.permission_mgr.get_plugin_storage(sieve.storage_name + ".json")
+                        args["storage"] = storage
+                    can_run, msg = sieve.function(**args)
+                    if msg:
+                        launch_event.event.reply(msg, timeout=15)
+                    if not can_run:
+                        return False
+
+            # Only tell about warming up where the sieves allow the command
+            if warming_up:
+                launch_event.event.reply("`%s` is warming up, try again in a bit." % launch_event.triggered_command, timeout=15)
+                return False
 
-            if not self.correct_format(hook, launch_event.text):
+            if not launch_event.event.is_pm and not self.correct_format(hook, launch_event.text):
                 func_doc = hook.function.__doc__
 
                 msg = "Invalid format"
@@ -270,27 +688,68 @@ class PluginManager():
                 if func_doc:
                     msg += ": " + "\n`" + hook.function.__doc__.strip() + "`"
                 launch_event.event.reply(msg, timeout=15)
-                return
+                return False
 
         elif hook.type == "on_ready":
             if launch_event.hook.server_id and not launch_event.hook.has_server_id(launch_event.server.id):
-                return
+                return False
 
         elif hook.type == "event" and launch_event.event.type == EventType.message:
             if launch_event.event.is_pm:
-                return
+                return False
             if launch_event.hook.server_id and not launch_event.hook.has_server_id(launch_event.event.server.id):
-                return
+                return False
 
-        if hook.single_thread:
-            # TODO
-            pass
-        else:
-            # Run the plugin with the message, and wait for it to finish
-            result = self.execute_hook(hook, launch_event)
+        return True
+
+    def launch(self, launch_event, queued_at=None):
+        """
+        Dispatch a given event to a given hook using a given bot object.
+        Returns False if the hook didn't run successfully, and True if it ran successfully.
+
+        Coroutine hooks are only scheduled on the bot loop, in which case True
+        is returned once scheduled.
+        """
+
+        hook = launch_event.hook
+
+        if not hook.threaded:
+            self.run_coroutine(self._launch_async(launch_event, queued_at))
+            return True
+
+        if not self._timed_can_launch(launch_event, queued_at):
+            return None
+
+        # Run the plugin with the message, and wait for it to finish
+        return self.execute_hook(hook, launch_event)
+
+    def _prepare_launch(self, launch_event, queued_at):
+        """
+        Run the checks of a coroutine hook and build its arguments.
+        Returns the arguments, None if the hook must not run or False if preparing it failed.
+        """
+        if not self._timed_can_launch(launch_event, queued_at):
+            return None
+
+        hook = launch_event.hook
+        try:
+            return self._prepare_async_hook(hook, launch_event)
+        except:
+            self.metrics.call(hook, 0, error=True)
+            import traceback; traceback.print_exc()
+            return False
+
+    async def _launch_async(self, launch_event, queued_at=None):
+        """
+        Same as launch, but for coroutine hooks. The sieves and arguments
+        are prepared inline on the loop, only threaded hooks go through the
+        hook executor.
+        """
+        parameters = self._prepare_launch(launch_event, queued_at)
+        if parameters is None or parameters is False:
+            return parameters
 
-        # Return the result
-        return result
+        return await self.execute_async_hook(launch_event.hook, launch_event, parameters)
 
     def unload_plugin(self, path):
         """
@@ -301,73 +760,185 @@ class PluginManager():
         :type path: str
         :rtype: bool
         """
+        with self.lock:
+            # make sure this plugin is actually loaded
+            if not path in self.plugins:
+                print("No such plugin found to unload: %s" % path)
+                return False
 
-        # make sure this plugin is actually loaded
-        if not path in self.plugins:
-            print("No such plugin found to unload: %s" % path)
-            return False
+            # get the loaded plugin
+            plugin = self.plugins[path]
 
-        # get the loaded plugin
-        plugin = self.plugins[path]
+            # drop the commands the plugin created at runtime, the routes are
+            # rebuilt once the other hooks are unregistered
+            for command_hook in plugin.dynamic_commands.values():
+                self._unregister_command(command_hook)
+            plugin.dynamic_commands.clear()
 
-        # unregister commands
-        for command_hook in plugin.commands:
-            for alias in command_hook.aliases:
-                if alias in self.commands and self.commands[alias] == command_hook:
-                    # we need to make sure that there wasn't a conflict, so we don't delete another plugin's command
-                    del self.commands[alias]
+            self._unregister_hooks(plugin_hooks(plugin))
 
-        # unregister raw hooks
-        for raw_hook in plugin.raw_hooks:
-            if raw_hook.is_catch_all():
-                self.catch_all_triggers.remove(raw_hook)
-            else:
-                for trigger in raw_hook.triggers:
-                    assert trigger in self.raw_triggers  # this can't be not true
-                    self.raw_triggers[trigger].remove(raw_hook)
-                    if not self.raw_triggers[trigger]:  # if that was the last hook for this trigger
-                        del self.raw_triggers[trigger]
+            # unregister databases
+            plugin.unregister_tables(self.db)
 
-        # unregister events
-        for event_hook in plugin.events:
-            for event_type in event_hook.types:
-                assert event_type in self.event_type_hooks  # this can't be not true
-                self.event_type_hooks[event_type].remove(event_hook)
-                if not self.event_type_hooks[event_type]:  # if that was the last hook for this event type
-                    del self.event_type_hooks[event_type]
+            # remove last reference to plugin
+            del self.plugins[plugin.name]
 
-        # unregister regexps
-        for regex_hook in plugin.regexes:
-            for regex_match in regex_hook.regexes:
-                self.regex_hooks.remove((regex_match, regex_hook))
+            logger.info("Unloaded all plugins from {}.py".format(plugin.name))
 
-        # unregister sieves
-        for sieve_hook in plugin.sieves:
-            self.sieves.remove(sieve_hook)
+            return True
 
-        # unregister databases
-        plugin.unregister_tables(self.db)
+    def load_plugin(self, fname):
+        """
+        Load a whole plugin file
+        :param fname: file name to load
+        """
+        with self.lock:
+            old_plugin = self.plugins.get(fname)
+            if old_plugin is not None and not old_plugin.lazy:
+                self.reload_plugin(old_plugin)
+                return
 
-        # remove last reference to plugin
-        del self.plugins[plugin.name]
+            # Try unloading the file first
+            self.unload_plugin(fname)
+            plugin = self._load_plugin(fname)
 
-        logger.info("Unloaded all plugins from {}.py".format(plugin.name))
+            if plugin:
+                self.plugins[fname] = Plugin(fname, plugin)
+                self.manifest.update(fname, self.plugins[fname])
+                self.manifest.save()
+                self.finalize_plugin(self.plugins[fname])
 
-        return True
+    def reload_plugin(self, old_plugin):
+        """
+        Reimport a loaded plugin and only swap the hooks that changed.
 
-    def load_plugin(self, fname):
+        Unchanged hooks are carried over, so periodic hooks keep their
+        schedule. on_start hooks are run again only if one of them changed
+        or if the reload reset a global they set.
         """
-        Load a whole plugin file
-        :param fname: file name to load
+        with self.lock:
+            fname = old_plugin.name
+            module = sys.modules.get(module_name(fname))
+            old_globals = dict(vars(module)) if module else {}
+
+            # Tables are defined again by the import, keep their names to skip the existence checks
+            old_plugin.unregister_tables(self.db)
+            old_tables = set(table.name for table in old_plugin.tables)
+
+            module = self._load_plugin(fname)
+            if not module:
+                logger.warning("Could not reload {}, unloading it".format(fname))
+                self.unload_plugin(fname)
+                return
+
+            plugin = Plugin(fname, module)
+            self.plugins[fname] = plugin
+            self.manifest.update(fname, plugin)
+            self.manifest.save()
+
+            old_hooks = {(hook.type, hook.function_name): hook for hook in plugin_hooks(old_plugin)}
+            kept = {}
+            added = []
+            for hook in plugin_hooks(plugin):
+                old_hook = old_hooks.get((hook.type, hook.function_name))
+                if old_hook is not None and old_hook.fingerprint == hook.fingerprint:
+                    del old_hooks[(hook.type, hook.function_name)]
+                    old_hook.plugin = plugin
+                    kept[id(hook)] = old_hook
+                else:
+                    added.append(hook)
+            removed = list(old_hooks.values())
+
+            for attr in HOOK_LISTS:
+                setattr(plugin, attr, [kept.get(id(hook), hook) for hook in getattr(plugin, attr)])
+
+            # Commands created at runtime stay registered
+            plugin.dynamic_commands = old_plugin.dynamic_commands
+            for command_hook in plugin.dynamic_commands.values():
+                command_hook.plugin = plugin
+
+            self._check_hook_args(plugin)
+            for table in plugin.tables:
+                if table.name not in old_tables and not table.exists(self.db.db_engine):
+                    logger.info("Registering table {} for {}".format(table.name, fname))
+                    table.create(self.db.db_engine)
+
+            self._unregister_hooks(removed)
+            self._register_hooks(added)
+
+            restart = not old_plugin.ready or any(hook.type == "on_start" for hook in added + removed)
+            for on_start_hook in plugin.run_on_start:
+                for name in stored_globals(on_start_hook.function):
+                    if vars(module).get(name) is not old_globals.get(name):
+                        restart = True
+
+            logger.info("Reloaded {}: {} hooks kept, {} added, {} removed".format(
+                fname, len(kept), len(added), len(removed)))
+
+            if restart and plugin.run_on_start:
+                plugin.ready = False
+                self._start_plugin(plugin)
+                return
+
+            events = []
+            with self.ready_lock:
+                plugin.ready = True
+
+                # Only the new on_ready hooks still have to run
+                if self.bot.is_ready:
+                    events = self.ready_events(
+                        [hook for hook in added if hook.type == "on_ready"],
+                        [hook for hook in added if hook.type == "on_connection_ready"])
+
+        self.launch_all(events)
+
+    def _add_load_time(self, name, seconds, how=None):
+        prev_seconds, prev_how = self.load_times.get(name, (0, "imported"))
+        self.load_times[name] = (prev_seconds + seconds, how or prev_how)
+
+    def log_load_times(self):
         """
+        Log how long each plugin took to load, slowest first.
+        """
+        total = sum(seconds for seconds, _ in self.load_times.values())
+        logger.info("Loaded {} plugins in {:.2f}s".format(len(self.load_times), total))
+
+        for name, (seconds, how) in sorted(self.load_times.items(), key=lambda item: item[1][0], reverse=True):
+            logger.info("  {:8.3f}s {:9} {}".format(seconds, how, name))
 
-        # Try unloading the file first
-        self.unload_plugin(fname)
-        plugin = self._load_plugin(fname)
+    def resolve_lazy_hook(self, lazy_hook):
+        """
+        Import the plugin of a lazy command and return the real command hook,
+        or None if the plugin could not be loaded.
+        """
+        name = lazy_hook.plugin.name
 
-        if plugin:
-            self.plugins[fname] = Plugin(fname, plugin)
-            self.finalize_plugin(self.plugins[fname])
+        with self.lock:
+            if self.plugins.get(name) is lazy_hook.plugin:
+                started = time.perf_counter()
+                self.load_plugin(name)
+                self._add_load_time(name, time.perf_counter() - started, "on use")
+                logger.info("Imported {} on first use in {:.3f}s".format(name, self.load_times[name][0]))
+
+            plugin = self.plugins.get(name)
+
+        if plugin is None or plugin.lazy:
+            return None
+
+        for command_hook in plugin.commands:
+            if command_hook.function_name == lazy_hook.function_name:
+                return command_hook
+
+        return None
+
+    def _launch_lazy(self, launch_event, queued_at=None):
+        hook = self.resolve_lazy_hook(launch_event.hook)
+        if hook is None:
+            logger.warning("Command {} is no longer available".format(launch_event.hook.description))
+            return None
+
+        launch_event.hook = hook
+        return self.launch(launch_event, queued_at)
 
     def _load_plugin(self, fname):
         """
@@ -377,7 +948,7 @@ class PluginManager():
         basename = os.path.basename(fname)
 
         # Build file name
-        plugin_name = fname.replace("/", ".").replace(".py", "")
+        plugin_name = module_name(fname)
 
         try:
             # Import the file
@@ -404,14 +975,43 @@ class PluginManager():
         plugins = glob.iglob(os.path.join(path, '*.py'))
         plugin_dict = {}
         for file in plugins:
+            started = time.perf_counter()
+
+            entry = self.manifest.get(file)
+            if self.lazy_plugins and entry and entry["lazy"]:
+                plugin_dict[file] = LazyPlugin(file, entry)
+                self._add_load_time(file, time.perf_counter() - started, "lazy")
+                continue
+
             plugin_data = self._load_plugin(file)
 
             if plugin_data:
                 plugin_dict[file] = Plugin(file, plugin_data)
+                self.manifest.update(file, plugin_dict[file])
+                self._add_load_time(file, time.perf_counter() - started, "imported")
 
         return plugin_dict
 
+# Hook lists of a plugin
+HOOK_LISTS = ("commands", "regexes", "raw_hooks", "sieves", "events", "periodic",
+              "run_on_start", "run_on_ready", "run_on_conn_ready")
+
+
+def plugin_hooks(plugin):
+    """
+    All the hooks of a plugin.
+    """
+    return [hook for attr in HOOK_LISTS for hook in getattr(plugin, attr)]
+
+
+def module_name(fname):
+    return fname.replace("/", ".").replace(".py", "")
+
+
 class Plugin():
+    lazy = False
+    ready = False
+
     def __init__(self, name, module):
         self.name = name
         self.file_name = name # Compat with spanky/plugin/hook_logic code
@@ -428,6 +1028,9 @@ class Plugin():
 
         self.tables = find_tables(module)
 
+        # (server id, name) -> command registered at runtime with PluginManager.register_command
+        self.dynamic_commands = {}
+
     def create_tables(self, db_data):
 
         if self.tables:
@@ -447,3 +1050,35 @@ class Plugin():
 
             for table in self.tables:
                 db_data.db_metadata.remove(table)
+
+
+class LazyPlugin():
+    """
+    Plugin registered from its manifest entry, without importing it.
+    It only has commands, which are replaced by the real ones on first use.
+    """
+    lazy = True
+    ready = True
+
+    def __init__(self, name, entry):
+        self.name = name
+        self.file_name = name
+
+        self.commands = [LazyCommandHook(self, cmd) for cmd in entry["commands"]]
+        self.regexes = []
+        self.raw_hooks = []
+        self.sieves = []
+        self.events = []
+        self.periodic = []
+        self.run_on_start = []
+        self.run_on_ready = []
+        self.run_on_conn_ready = []
+
+        self.tables = []
+        self.dynamic_commands = {}
+
+    def create_tables(self, db_data):
+        pass
+
+    def unregister_tables(self, db_data):
+        pass
@@ -0,0 +1,122 @@
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+_ZERO_WIDTH = (sre_parse.AT,)
+
+# Non-ascii characters that an IGNORECASE regex matches with an ascii
+# letter, but that str.lower() doesn't turn into that letter
+_ASCII_FOLDS = str.maketrans({
+    "\u0130": "i",  # LATIN CAPITAL LETTER I WITH DOT ABOVE
+    "\u0131": "i",  # LATIN SMALL LETTER DOTLESS I
+    "\u017f": "s",  # LATIN SMALL LETTER LONG S
+    "\u212a": "k",  # KELVIN SIGN
+})
+
+class RegexMatcher():
+    """
+    Matches a text against all regex hooks, searching only the regexes
+    that can possibly match.
+
+    For each hook regex, a literal that any match must contain is extracted
+    at build time (e.g. "://" for r"(.*:)//xkcd.com"). A message is lowered
+    once and checked for the literals with plain substring tests, which are
+    much cheaper than a regex search. Only the hooks whose literal is in the
+    text get an actual search, so texts that match nothing (the common
+    case) never reach the regex engine. Non-ascii texts first have the
+    characters that case-insensitively match an ascii letter replaced by it.
+
+    Regexes without a usable literal are always searched.
+    """
+
+    def __init__(self, regex_hooks):
+        """
+        :type regex_hooks: list[(re.Pattern, RegexHook)]
+        """
+        self.regex_hooks = list(regex_hooks)
+
+        # (index in regex_hooks, lowercase literal) for prefiltered regexes
+        self.literals = []
+        # indexes in regex_hooks that are searched on every text
+        self.standalone = []
+
+        for idx, (regex, _) in enumerate(self.regex_hooks):
+            literal = self.required_literal(regex)
+            if literal:
+                self.literals.append((idx, literal.lower()))
+            else:
+                self.standalone.append(idx)
+
+    @staticmethod
+    def _literal_runs(parsed, runs):
+        """
+        Walk the mandatory part of a parsed regex, collecting runs of
+        consecutive literal characters into `runs`.
+        """
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                runs[-1].append(chr(av))
+            elif op == sre_parse.SUBPATTERN:
+                # (group, add_flags, del_flags, pattern)
+                RegexMatcher._literal_runs(av[-1], runs)
+            elif op in _ZERO_WIDTH:
+                continue
+            else:
+                runs.append([])
+
+    @staticmethod
+    def required_literal(regex):
+        """
+        Returns the longest literal that every match of the regex contains,
+        or None if there isn't one that can be used for prefiltering.
+        """
+        if not isinstance(regex.pattern, str):
+            return None
+
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except Exception:
+            return None
+
+        runs = [[]]
+        RegexMatcher._literal_runs(parsed, runs)
+
+        literal = max(("".join(run) for run in runs), key=len)
+
+        # Case folding of non-ascii characters doesn't always map one to one
+        if not literal or not literal.isascii():
+            return None
+
+        return literal
+
+    def _candidates(self, text):
+        """
+        Indexes of the hooks that need an actual search on the text.
+        """
+        if text.isascii():
+            lowered = text.lower()
+        else:
+            lowered = text.translate(_ASCII_FOLDS).lower()
+        hits = [idx for idx, lit in self.literals if lit in lowered]
+        if not hits:
+            return self.standalone
+
+        if self.standalone:
+            return sorted(hits + self.standalone)
+        return hits
+
+    def matches(self, text):
+        """
+        Returns a list of (match, hook) for each regex hook that matches the text,
+        in hook registration order.
+        """
+        results = []
+
+        for idx in self._candidates(text):
+            regex, regex_hook = self.regex_hooks[idx]
+            regex_match = regex.search(text)
+            if regex_match:
+                results.append((regex_match, regex_hook))
+
+        return results
@@ -1,21 +1,34 @@
+import logging
 import os.path
+import threading
+import time
 
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
+logger = logging.getLogger("spanky")
+
 
 class PluginReloader(object):
-    def __init__(self, mgr):
+    def __init__(self, mgr, delay=0.2):
         """
         :type bot: spanky.plugin.plugin_manager.PluginManager
+        :type delay: float
         """
         self.observer = Observer()
         self.mgr = mgr
-        self.reloading = set()
+        self.delay = delay
         self.event_handler = PluginEventHandler(self, patterns=["*.py"])
 
+        # path -> (timer, action, time of the first change)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        # Reloads of different files must not register hooks at the same time
+        self.reload_lock = threading.Lock()
+
     def start(self, module_paths):
-        """Starts the plugin reloader
+        """Starts the plugin reloader, using one observer for all paths
         :type module_path: list of strings
         """
         for path in module_paths:
@@ -26,19 +39,20 @@ class PluginReloader(object):
         """Stops the plugin reloader"""
         self.observer.stop()
 
+        with self.pending_lock:
+            for timer, _, _ in self.pending.values():
+                timer.cancel()
+            self.pending.clear()
+
     def reload(self, path):
         """
         Loads or reloads a module, given its file path. Thread safe.
 
         :type path: str
         """
-        if not os.path.isfile(path):
-            # we check if the file still exists here because some programs modify a file before deleting
-            return
-
         if isinstance(path, bytes):
             path = path.decode()
-        self._reload(path)
+        self._schedule(path, self._reload)
 
     def unload(self, path):
         """
@@ -48,19 +62,54 @@ class PluginReloader(object):
         """
         if isinstance(path, bytes):
             path = path.decode()
-        self._unload(path)
+        self._schedule(path, self._unload)
 
+    def _schedule(self, path, action):
+        """
+        Run the action for a path once it stops changing for `delay` seconds.
+        Editors fire several events for one save, only the last action is run.
+        """
+        path = os.path.relpath(path)
+
+        with self.pending_lock:
+            first_change = time.perf_counter()
+            if path in self.pending:
+                timer, _, first_change = self.pending[path]
+                timer.cancel()
+
+            timer = threading.Timer(self.delay, self._run, (path,))
+            timer.daemon = True
+            self.pending[path] = (timer, action, first_change)
+            timer.start()
+
+    def _run(self, path):
+        with self.pending_lock:
+            if path not in self.pending:
+                return
+            timer, action, first_change = self.pending[path]
+            if timer is not threading.current_thread():
+                # a newer change rescheduled the action
+                return
+            del self.pending[path]
+
+        with self.reload_lock:
+            started = time.perf_counter()
+            try:
+                action(path)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finished = time.perf_counter()
+
+        logger.info("Handled change of %s in %.3fs (%.3fs after the first change)" %
+                    (path, finished - started, finished - first_change))
 
     def _reload(self, path):
-        if path in self.reloading:
-            # we already have a coroutine reloading
+        if not os.path.isfile(path):
+            # we check if the file still exists here because some programs modify a file before deleting
             return
-        self.reloading.add(path)
-        # we don't want to reload more than once every 200 milliseconds, so wait that long to make sure there
-        # are no other file changes in that time.
-        self.reloading.remove(path)
-        self.mgr.load_plugin(path)
 
+        self.mgr.load_plugin(path)
 
     def _unload(self, path):
         self.mgr.unload_plugin(path)
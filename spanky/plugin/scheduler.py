@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from spanky.plugin.event import TimeEvent
+
+logger = logging.getLogger("spanky")
+
+class PeriodicStats():
+    """
+    Timing statistics for one periodic hook.
+
+    Drift is how late a run was started compared to its deadline. A run
+    overruns when it takes longer than the hook interval. Runs of single
+    threaded hooks that are due while the previous run is still going
+    are skipped.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.missed = 0
+
+        self.total_drift = 0.0
+        self.max_drift = 0.0
+
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def avg_drift(self):
+        if not self.runs:
+            return 0.0
+        return self.total_drift / self.runs
+
+    def __str__(self):
+        return "runs: %d, skipped: %d, overruns: %d, missed: %d, drift avg/max: %.3f/%.3fs, duration last/max: %.3f/%.3fs" % (
+            self.runs, self.skipped, self.overruns, self.missed,
+            self.avg_drift, self.max_drift,
+            self.last_duration, self.max_duration)
+
+
+class PeriodicScheduler():
+    """
+    Runs periodic hooks from a timer heap.
+
+    A single thread sleeps until the closest deadline, hands the due hooks
+    over to the plugin manager and puts them back in the heap with their
+    next deadline. Hooks marked as `singlethread` never have two runs
+    going at the same time.
+    """
+
+    def __init__(self, plugin_manager):
+        self.plugin_manager = plugin_manager
+
+        # (deadline, sequence, hook)
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+        self.stats = {}
+        self.running = set()
+
+        self.thread = None
+
+    def add(self, hook):
+        """
+        Schedule a periodic hook. The first run happens after its initial interval.
+        """
+        with self.cond:
+            self.stats[hook] = PeriodicStats()
+            if self.thread:
+                self._push(time.time() + hook.initial_interval, hook)
+                self.cond.notify()
+
+    def remove(self, hook):
+        """
+        Stop scheduling a periodic hook. Its heap entry is dropped when it comes up.
+        """
+        with self.cond:
+            self.stats.pop(hook, None)
+            self.running.discard(hook)
+
+    def get_stats(self):
+        """
+        Get (hook, stats) for each scheduled hook, hooks may be added or removed meanwhile.
+        """
+        with self.cond:
+            return list(self.stats.items())
+
+    def start(self):
+        """
+        Start the scheduler thread, counting the initial intervals from now.
+        """
+        with self.cond:
+            if self.thread:
+                return
+
+            now = time.time()
+            for hook in self.stats:
+                self._push(now + hook.initial_interval, hook)
+
+            self.thread = threading.Thread(target=self._run, name="periodic-scheduler", daemon=True)
+            self.thread.start()
+
+    def _push(self, deadline, hook):
+        heapq.heappush(self.heap, (deadline, next(self.seq), hook))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                while not self.heap or self.heap[0][0] > now:
+                    timeout = self.heap[0][0] - now if self.heap else None
+                    self.cond.wait(timeout)
+                    now = time.time()
+
+                deadline, _, hook = heapq.heappop(self.heap)
+
+                # Unloaded hook
+                if hook not in self.stats:
+                    continue
+
+                self._reschedule(deadline, now, hook)
+
+            try:
+                self._fire(hook, deadline, now)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def _reschedule(self, deadline, now, hook):
+        next_deadline = deadline + hook.interval
+
+        # Don't try to catch up on runs that were missed, skip to the next one
+        if next_deadline <= now:
+            missed = int((now - deadline) // hook.interval)
+            self.stats[hook].missed += missed
+            next_deadline = deadline + (missed + 1) * hook.interval
+
+        self._push(next_deadline, hook)
+
+    def _fire(self, hook, deadline, now):
+        stats = self.stats.get(hook)
+        if stats is None:
+            return
+
+        if hook.single_thread:
+            with self.cond:
+                if hook in self.running:
+                    stats.skipped += 1
+                    logger.debug("Skipping {}, previous run still going".format(hook.description))
+                    return
+                self.running.add(hook)
+
+        drift = now - deadline
+        stats.runs += 1
+        stats.total_drift += drift
+        stats.max_drift = max(stats.max_drift, drift)
+        hook.last_time = now
+
+        bot = self.plugin_manager.bot
+        event = TimeEvent(bot=bot, hook=hook, event=bot.input.EventPeriodic())
+
+        future = self.plugin_manager.dispatch(event)
+        future.add_done_callback(lambda _: self._done(hook, stats, now))
+
+    def _done(self, hook, stats, started):
+        duration = time.time() - started
+
+        stats.last_duration = duration
+        stats.max_duration = max(stats.max_duration, duration)
+        if duration > hook.interval:
+            stats.overruns += 1
+            logger.warning("{} took {:.2f}s, longer than its {}s interval".format(
+                hook.description, duration, hook.interval))
+
+        with self.cond:
+            self.running.discard(hook)
@@ -5,20 +5,13 @@ def get_user_by_id(server, uid):
     return server.get_user(uid)
 
 def get_user_by_name(server, name):
-    for u in server.get_users():
-        if u.name == name:
-            return u
-    return None
+    return server.get_user_by_name(name)
 
 def get_role_by_id(server, rid):
     return server.get_role(rid)
 
 def get_role_by_name(server, rname):
-    for r in server.get_roles():
-        if r.name == rname:
-            return r
-
-    return None
+    return server.get_role_by_name(rname)
 
 def get_channel_by_id(server, cid):
     return server.get_chan(cid)
@@ -156,11 +156,12 @@ class SetClearFactory():
         for order, element in enumerate(text):
             valid_data[self.format[order]] = self.kwargs[self.format[order]].validate(element)
 
-        # Save before and after for comparison
-        data_before = json.dumps(self.data[self.name])
-        # Do the assignment by using the validated data, given hierarchy and root element
-        self.assign_rec(valid_data, self.hierarchy, self.data[self.name])
-        data_after = json.dumps(self.data[self.name])
+        with self.data.lock:
+            # Save before and after for comparison
+            data_before = json.dumps(self.data[self.name])
+            # Do the assignment by using the validated data, given hierarchy and root element
+            self.assign_rec(valid_data, self.hierarchy, self.data[self.name])
+            data_after = json.dumps(self.data[self.name])
 
         # Check if something was added
         if data_before != data_after:
@@ -186,9 +187,10 @@ class SetClearFactory():
         for order, element in enumerate(text):
             valid_data[self.format[order]] = self.kwargs[self.format[order]].validate(element)
 
-        data_before = json.dumps(self.data[self.name])
-        self.remove_rec(valid_data, self.hierarchy, self.data[self.name])
-        data_after = json.dumps(self.data[self.name])
+        with self.data.lock:
+            data_before = json.dumps(self.data[self.name])
+            self.remove_rec(valid_data, self.hierarchy, self.data[self.name])
+            data_after = json.dumps(self.data[self.name])
 
         # Check if something was added
         if data_before != data_after:
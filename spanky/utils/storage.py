@@ -1,8 +1,16 @@
 import os
 import json
+import atexit
+import sqlite3
 import collections
+import contextlib
+import heapq
+import itertools
 import logging
+import marshal
 import platform
+import threading
+import time
 
 from pathlib import Path
 from shutil import copyfile
@@ -15,41 +23,259 @@ logger.addHandler(fh)
 
 DS_LOC = Path("storage_data/")
 
+# Seconds without changes before a dirty store is written
+FLUSH_DELAY = 1.0
+# A store that keeps changing is still written at least this often
+MAX_FLUSH_DELAY = 5.0
+# Number of older versions kept in the backup folder
+BACKUP_COUNT = 3
+
+# Journal changes written before the log is compacted into the snapshot,
+# the log may also grow up to the size of the last snapshot
+JOURNAL_COMPACT_OPS = 1000
+
+# "json" keeps one file per store, "sqlite" keeps all stores in one database
+ENGINE = "json"
+SQLITE_PATH = DS_LOC / "storage.db"
+
+# Stores with changes that are not on disk yet, by id (UserDict is not hashable)
+dirty_stores = {}
+dirty_lock = threading.Lock()
+
+# (deadline, seq, store) of the dirty stores, written by a single flusher thread.
+# A store has one entry at most, its deadline may move later meanwhile.
+flush_queue = []
+flush_seq = itertools.count()
+flush_cond = threading.Condition(dirty_lock)
+flusher = None
+
+# Guards opening journals
+journal_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Apply the "storage" section of the bot config.
+    """
+    global FLUSH_DELAY, MAX_FLUSH_DELAY, BACKUP_COUNT, ENGINE, SQLITE_PATH
+
+    FLUSH_DELAY = config.get("flush_delay", FLUSH_DELAY)
+    MAX_FLUSH_DELAY = config.get("max_flush_delay", MAX_FLUSH_DELAY)
+    BACKUP_COUNT = config.get("backups", BACKUP_COUNT)
+    ENGINE = config.get("engine", ENGINE)
+    SQLITE_PATH = Path(config.get("sqlite_path", SQLITE_PATH))
+
+    if ENGINE not in ("json", "sqlite"):
+        raise ValueError("Unknown storage engine %s" % ENGINE)
+
+
+def open_store(parent, name):
+    """
+    Open a dict store with the configured engine.
+    """
+    if ENGINE == "sqlite":
+        return sqldict(parent, name)
+
+    return dsdict(parent, name)
+
+
+def flush_all():
+    """
+    Write all dirty stores to disk.
+    """
+    with dirty_lock:
+        stores = list(dirty_stores.values())
+
+    for store in stores:
+        store.flush()
+
+atexit.register(flush_all)
+
+
+def flush_loop():
+    """
+    Write each dirty store once its deadline passes.
+    """
+    while True:
+        with flush_cond:
+            now = time.monotonic()
+            if not flush_queue:
+                flush_cond.wait()
+                continue
+
+            deadline, _, store = flush_queue[0]
+            if deadline > now:
+                flush_cond.wait(deadline - now)
+                continue
+
+            heapq.heappop(flush_queue)
+            if store.first_change is not None and store.deadline > now:
+                # changed again since it was queued
+                heapq.heappush(flush_queue, (store.deadline, next(flush_seq), store))
+                continue
+
+            store.queued = False
+
+        store.flush()
+
+
+def start_flusher():
+    """
+    Start the flusher thread, called with dirty_lock held.
+    """
+    global flusher
+
+    if flusher is None:
+        flusher = threading.Thread(target=flush_loop, name="storage-flusher", daemon=True)
+        flusher.start()
+
+
+def rotate_backups(backup_loc, count):
+    """
+    Shift backup -> backup.1 -> ... -> backup.<count - 1>, dropping the oldest.
+    """
+    for idx in range(count - 1, 0, -1):
+        src = backup_loc if idx == 1 else Path("%s.%d" % (backup_loc, idx - 1))
+        if src.exists():
+            os.replace(src, "%s.%d" % (backup_loc, idx))
+
 
 class dstype():
     def __init__(self, parent, name):
         parent = Path(parent)
         logger.debug("Initializing %s, %s" % (parent, name))
-        os.system("mkdir -p %s" % DS_LOC / parent / "backup")
+        os.makedirs(DS_LOC / parent / "backup", exist_ok=True)
 
         self.location = parent / name
         self.backup_name = parent / "backup" / name
 
+        self.init_write_behind()
+        self.journals = {}
+        # Only back up the file on disk if it was loaded without errors
+        self.file_ok = True
+        # Size of the file, as a measure of the memory used by the store
+        self.disk_size = 0
+
         data_obj = self.get_obj(self.location)
         if data_obj:
             self.data = data_obj
 
-    def do_sync(self, obj, name, backup_name):
-        try:
-            logger.debug("Do sync on " + str(name))
+    def init_write_behind(self):
+        # Held by writers and while a flush copies the data
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.first_change = None
+        # when the store is due to be written and if it's in flush_queue
+        self.deadline = None
+        self.queued = False
 
-            # Check if the current file is valid
-            json.load(open(DS_LOC / name, "r"))
-            # If yes, do a backup
-            os.system("cp %s %s" % (DS_LOC / name, DS_LOC / backup_name))
-            logger.debug("Load/sync OK")
-        except:
-            print("File at %s is not valid" % (DS_LOC / name))
-            logger.debug("Sync error - file invalid")
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Make a group of changes without other threads changing the store
+        in between. The store is synced at the end.
+        """
+        with self.lock:
+            try:
+                yield self
+            finally:
+                self.sync()
+
+    def snapshot(self):
+        """
+        Copy of the data to write, taken under the store lock.
+        marshal copies plain data many times faster than deepcopy or the
+        json encoder, the json text is made off the lock.
+        """
+        return marshal.dumps(self.data)
 
-        logger.debug("Open file")
-        file = open(DS_LOC / name, "w")
+    def do_sync(self, snapshot, name, backup_name):
+        logger.debug("Do sync on " + str(name))
 
-        json.dump(obj, file, indent=4, sort_keys=True)
+        file_loc = DS_LOC / name
+        tmp_loc = Path("%s.tmp" % file_loc)
+
+        text = json.dumps(marshal.loads(snapshot), indent=4, sort_keys=True)
+        with open(tmp_loc, "w") as file:
+            file.write(text)
+            self.disk_size = file.tell()
+            file.flush()
+            os.fsync(file.fileno())
+
+        # Keep the current version as backup, a broken file would overwrite good backups
+        if self.file_ok and file_loc.exists():
+            rotate_backups(DS_LOC / backup_name, BACKUP_COUNT)
+            os.replace(file_loc, DS_LOC / backup_name)
+
+        os.replace(tmp_loc, file_loc)
+        self.file_ok = True
         logger.debug("Sync finished")
 
     def sync(self):
-        self.do_sync(self.data, self.location, self.backup_name)
+        """
+        Mark the store as changed. It's written once it has been idle for
+        FLUSH_DELAY seconds, at most MAX_FLUSH_DELAY after the first change.
+        """
+        with flush_cond:
+            now = time.monotonic()
+            if self.first_change is None:
+                self.first_change = now
+                dirty_stores[id(self)] = self
+
+            self.deadline = min(now + FLUSH_DELAY, self.first_change + MAX_FLUSH_DELAY)
+            if not self.queued:
+                self.queued = True
+                heapq.heappush(flush_queue, (self.deadline, next(flush_seq), self))
+                start_flusher()
+                flush_cond.notify()
+
+    def flush(self):
+        """
+        Write the store to disk now, if it has pending changes.
+        """
+        with self.flush_lock:
+            with dirty_lock:
+                if self.first_change is None:
+                    return
+
+                # an entry left in flush_queue is dropped by the flusher
+                self.first_change = None
+                dirty_stores.pop(id(self), None)
+
+            try:
+                # writers only wait for the copy, not for the file write
+                with self.lock:
+                    snapshot = self.snapshot()
+                self.do_sync(snapshot, self.location, self.backup_name)
+            except:
+                logger.exception("Sync error for " + str(self.location))
+                # try again later
+                self.sync()
+
+    def size_estimate(self):
+        return self.disk_size
+
+    def journal(self, key):
+        """
+        Get the list under `key` as a journaled collection. A list already
+        stored under the key is moved into the journal the first time.
+        """
+        with journal_lock:
+            if key in self.journals:
+                return self.journals[key]
+
+            jour = dsjournal(self.location.parent, "%s.%s" % (self.location.stem, key))
+            with self.lock:
+                if not jour.exists() and self.data.get(key) is not None:
+                    jour.reset(self.data[key])
+
+                # the journal has the data now
+                if key in self.data:
+                    del self.data[key]
+                    self.sync()
+
+            self.journals[key] = jour
+            return jour
 
     def get_obj(self, location):
         """
@@ -64,9 +290,13 @@ class dstype():
 
         try:
             logger.info("Load file %s" % location)
-            return json.load(open(file_loc, "r"))
+            with open(file_loc, "r") as file:
+                data = json.load(file)
+                self.disk_size = file.tell()
+            return data
         except:
             logger.error("Trying backup %s" % location)
+            self.file_ok = False
             try:
                 # Try the backup
                 data = json.load(open(backup_loc, "r"))
@@ -86,6 +316,346 @@ class dsdict(dstype, collections.UserDict):
         return self.data.get(key, None)
 
     def __setitem__(self, key, value):
-        collections.UserDict.__setitem__(self, key, value)
+        with self.lock:
+            collections.UserDict.__setitem__(self, key, value)
+        self.sync()
+        return self.data
+
+    def __delitem__(self, key):
+        with self.lock:
+            collections.UserDict.__delitem__(self, key)
         self.sync()
+
+
+class sqlitedb():
+    """
+    Connection to the storage database, shared by all threads.
+    """
+    def __init__(self, path):
+        os.makedirs(Path(path).parent, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS store (
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL CHECK (json_valid(value)),
+                PRIMARY KEY (parent, name, key)
+            ) WITHOUT ROWID""")
+
+    def load(self, parent, name):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM store WHERE parent = ? AND name = ?", (parent, name)).fetchall()
+
+        return {key: value for key, value in rows}
+
+    def write(self, parent, name, changed, removed):
+        """
+        Update the given keys of a store in one transaction.
+        `changed` maps keys to json text.
+        """
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO store (parent, name, key, value) VALUES (?, ?, ?, ?)",
+                    [(parent, name, key, value) for key, value in changed.items()])
+                self.conn.executemany(
+                    "DELETE FROM store WHERE parent = ? AND name = ? AND key = ?",
+                    [(parent, name, key) for key in removed])
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def stores(self):
+        with self.lock:
+            return self.conn.execute("SELECT DISTINCT parent, name FROM store").fetchall()
+
+db = None
+db_lock = threading.Lock()
+
+
+def encode_value(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def get_db():
+    global db
+
+    with db_lock:
+        if db is None:
+            db = sqlitedb(SQLITE_PATH)
+        return db
+
+
+class sqltype(dstype):
+    """
+    A store kept as one row per top level key in the storage database.
+    Only keys that changed since the last flush are written.
+    """
+    def __init__(self, parent, name):
+        logger.debug("Initializing sqlite %s, %s" % (parent, name))
+        self.parent = str(parent)
+        self.name = name
+        self.location = Path(self.parent) / name
+        self.backup_name = None
+        self.db = get_db()
+
+        self.init_write_behind()
+        self.journals = {}
+        # json text of each key, as it is in the database
+        self.stored = self.db.load(self.parent, self.name)
+        self.stored_size = sum(len(key) + len(value) for key, value in self.stored.items())
+        # keys set through the dict interface since the last flush
+        self.changed_keys = set()
+        # nested values may have changed, compare all keys on flush
+        self.check_all = False
+
+        self.data = {key: json.loads(value) for key, value in self.stored.items()}
+
+    def size_estimate(self):
+        return self.stored_size
+
+    def sync(self, key=None):
+        with dirty_lock:
+            if key is None:
+                self.check_all = True
+            else:
+                self.changed_keys.add(str(key))
+
+        dstype.sync(self)
+
+    def snapshot(self):
+        """
+        Copy of the values of the keys that may have changed, and the keys
+        that were removed.
+        """
+        with dirty_lock:
+            check_all, changed_keys = self.check_all, self.changed_keys
+            self.check_all, self.changed_keys = False, set()
+
+        # keys are strings in the database, like in json files
+        current = {str(key): key for key in self.data.keys()}
+        keys = current.keys() if check_all else changed_keys & current.keys()
+
+        values = marshal.dumps({key: self.data[current[key]] for key in keys})
+        removed = [key for key in self.stored if key not in current]
+
+        return values, removed
+
+    def do_sync(self, snapshot, name, backup_name):
+        logger.debug("Do sync on " + str(name))
+
+        values, removed = snapshot
+        changed = {}
+        for key, value in marshal.loads(values).items():
+            value = encode_value(value)
+            if self.stored.get(key) != value:
+                changed[key] = value
+
+        if not changed and not removed:
+            return
+
+        try:
+            self.db.write(self.parent, self.name, changed, removed)
+        except:
+            # write everything again on retry
+            self.check_all = True
+            raise
+
+        for key, value in changed.items():
+            self.stored_size += len(value) - len(self.stored.get(key, "")) + (0 if key in self.stored else len(key))
+            self.stored[key] = value
+        for key in removed:
+            self.stored_size -= len(key) + len(self.stored.pop(key))
+        logger.debug("Sync finished, %d keys written" % len(changed))
+
+
+class sqldict(sqltype, collections.UserDict):
+    def __init__(self, parent, name):
+        collections.UserDict.__init__(self)
+        sqltype.__init__(self, parent, name)
+
+    def __getitem__(self, key):
+        return self.data.get(key, None)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            collections.UserDict.__setitem__(self, key, value)
+        self.sync(key)
         return self.data
+
+    def __delitem__(self, key):
+        with self.lock:
+            collections.UserDict.__delitem__(self, key)
+        self.sync(key)
+
+
+class dsjournal():
+    """
+    A list stored as a snapshot plus an append-only log of changes.
+
+    Each change costs one line in the log instead of rewriting the whole
+    collection. Once the log holds more than JOURNAL_COMPACT_OPS changes
+    (and more than the items in the snapshot) it's compacted into a new
+    snapshot.
+    Loading replays the log over the snapshot, a torn last line from a crash
+    is dropped.
+
+    Changes have to go through the journal methods, elements edited in
+    place are not logged, assign them back with journal[idx] = value.
+    """
+    def __init__(self, parent, name):
+        folder = DS_LOC / parent
+        os.makedirs(folder, exist_ok=True)
+
+        self.name = name
+        self.snapshot_loc = folder / (name + ".snapshot")
+        self.log_loc = folder / (name + ".log")
+
+        self.lock = threading.RLock()
+        self.items = []
+        # sequence number of the last change
+        self.seq = 0
+        # changes in the log since the last snapshot
+        self.log_ops = 0
+        # items in the last snapshot
+        self.snapshot_size = 0
+
+        self.load()
+        self.log = open(self.log_loc, "a")
+
+    def exists(self):
+        return self.snapshot_loc.exists() or self.log_loc.stat().st_size > 0
+
+    def load(self):
+        snap_seq = 0
+        if self.snapshot_loc.exists():
+            with open(self.snapshot_loc, "r") as file:
+                snapshot = json.load(file)
+            self.items = snapshot["items"]
+            self.snapshot_size = len(self.items)
+            snap_seq = self.seq = snapshot["seq"]
+
+        if not self.log_loc.exists():
+            return
+
+        good = 0
+        with open(self.log_loc, "rb") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.error("Dropping the log of %s from offset %d" % (self.name, good))
+                    break
+
+                good += len(line)
+                # already in the snapshot if compaction stopped before truncating the log
+                if entry["seq"] <= snap_seq:
+                    continue
+
+                self.apply(entry)
+                self.seq = entry["seq"]
+                self.log_ops += 1
+
+        if good != self.log_loc.stat().st_size:
+            os.truncate(self.log_loc, good)
+
+    def apply(self, entry):
+        op = entry["op"]
+        if op == "append":
+            self.items.append(entry["value"])
+        elif op == "set":
+            self.items[entry["index"]] = entry["value"]
+        elif op == "del":
+            del self.items[entry["index"]]
+        elif op == "clear":
+            self.items = []
+
+    def record(self, op, **fields):
+        """
+        Apply a change and append it to the log.
+        """
+        with self.lock:
+            entry = dict(fields, op=op, seq=self.seq + 1)
+            line = json.dumps(entry, sort_keys=True) + "\n"
+
+            self.apply(entry)
+            self.seq += 1
+            self.log.write(line)
+            self.log.flush()
+            self.log_ops += 1
+
+            if self.log_ops > max(JOURNAL_COMPACT_OPS, self.snapshot_size):
+                self.compact()
+
+    def compact(self):
+        """
+        Write the collection to a new snapshot and empty the log.
+        """
+        with self.lock:
+            tmp_loc = Path("%s.tmp" % self.snapshot_loc)
+            with open(tmp_loc, "w") as file:
+                json.dump({"seq": self.seq, "items": self.items}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_loc, self.snapshot_loc)
+
+            self.log.truncate(0)
+            self.log_ops = 0
+            self.snapshot_size = len(self.items)
+            logger.debug("Compacted %s at %d" % (self.name, self.seq))
+
+    def reset(self, items):
+        """
+        Replace the whole collection.
+        """
+        with self.lock:
+            self.items = list(items)
+            self.seq += 1
+            self.compact()
+
+    def append(self, value):
+        self.record("append", value=value)
+
+    def remove(self, value):
+        with self.lock:
+            self.record("del", index=self.items.index(value))
+
+    def pop(self, index=-1):
+        with self.lock:
+            value = self.items[index]
+            self.record("del", index=index % len(self.items))
+            return value
+
+    def clear(self):
+        self.record("clear")
+
+    def __setitem__(self, index, value):
+        with self.lock:
+            # IndexError, like a list
+            self.items[index]
+            self.record("set", index=index % len(self.items), value=value)
+
+    def __delitem__(self, index):
+        self.pop(index)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        # iterate over a copy, so that it's safe to change the journal in a loop
+        with self.lock:
+            return iter(list(self.items))
+
+    def __contains__(self, value):
+        return value in self.items
@@ -0,0 +1,95 @@
+"""
+Import the json storage tree into the sqlite storage database.
+
+Every storage_data/<parent>/<name>.json file becomes one store in the
+database, with a row for each top level key. Stores that already exist in
+the database are skipped unless --overwrite is given. Files are left in
+place, switch "storage" -> "engine" to "sqlite" in bot_config.json once the
+import is done.
+
+Run from the repository root:
+    python -m spanky.utils.storage_migrate [--db storage_data/storage.db] [--overwrite]
+"""
+import argparse
+import json
+import os
+
+from pathlib import Path
+
+from spanky.utils import storage
+
+
+def json_stores(root):
+    """
+    Yield (parent, name, path) for every store file under root.
+    Backups and plugin data folders are not stores.
+    """
+    for parent in sorted(os.listdir(root)):
+        folder = root / parent
+        if not folder.is_dir():
+            continue
+
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(".json") and (folder / name).is_file():
+                yield parent, name, folder / name
+
+
+def migrate(root, db, overwrite=False):
+    existing = set(db.stores())
+    imported = skipped = failed = 0
+
+    for parent, name, path in json_stores(root):
+        if (parent, name) in existing and not overwrite:
+            print("Skip %s/%s, already in the database" % (parent, name))
+            skipped += 1
+            continue
+
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except ValueError:
+            print("Could not parse %s" % path)
+            failed += 1
+            continue
+
+        if not isinstance(data, dict):
+            print("Skip %s, not a dict store" % path)
+            skipped += 1
+            continue
+
+        changed = {str(key): storage.encode_value(value) for key, value in data.items()}
+        removed = [key for key in db.load(parent, name) if key not in changed]
+        db.write(parent, name, changed, removed)
+
+        # read it back through the database to make sure nothing was lost
+        stored = {key: json.loads(value) for key, value in db.load(parent, name).items()}
+        if stored != json.loads(json.dumps(data)):
+            print("Mismatch after importing %s" % path)
+            failed += 1
+            continue
+
+        imported += 1
+
+    print("Imported %d stores, skipped %d, failed %d" % (imported, skipped, failed))
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import json storage files into the sqlite storage database")
+    parser.add_argument("--root", default=str(storage.DS_LOC), help="storage folder")
+    parser.add_argument("--db", default=None, help="database path, default from bot_config.json")
+    parser.add_argument("--overwrite", action="store_true", help="replace stores that are already imported")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if db_path is None and os.path.exists("bot_config.json"):
+        with open("bot_config.json") as data_file:
+            db_path = json.load(data_file).get("storage", {}).get("sqlite_path")
+
+    db = storage.sqlitedb(db_path or storage.SQLITE_PATH)
+    if not migrate(Path(args.root), db, args.overwrite):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()